@@ -3,7 +3,8 @@ import os
 from flask import Flask
 
 from .api import api
-from . import db
+from .api.export import export_readings_command
+from . import aio, cache, db, hotstore, ingest, instrumentation, parallel
 
 
 def create_app(test_config=None):
@@ -11,6 +12,43 @@ def create_app(test_config=None):
     app = Flask(__name__)
     app.config.from_mapping(
         DATABASE=os.path.abspath('test_database.db'),
+        DB_POOL_SIZE=8,
+        DB_BUSY_TIMEOUT=5000,
+        DB_JOURNAL_MODE='WAL',
+        DB_SYNCHRONOUS='NORMAL',
+        DB_MMAP_SIZE=268435456,
+        DB_CACHE_SIZE=-20000,
+        DB_PARTITION_BY_MONTH=False,
+        DB_SHARDS=1,
+        DB_TRACE=False,
+        DB_SLOW_QUERY_MS=100,
+        DB_TRACE_PATH=os.path.abspath('query_stats.db'),
+        MAX_BATCH_SIZE=10000,
+        STREAM_CHUNK_SIZE=1000,
+        EXPORT_CHUNK_SIZE=1000,
+        MAX_PAGE_SIZE=10000,
+        SKETCH_K=200,
+        SUMMARY_WORKERS=0,
+        HOT_STORE=False,
+        HOT_STORE_RETENTION=604800,
+        METRICS_CACHE='local',
+        METRICS_CACHE_SIZE=10000,
+        METRICS_CACHE_TTL=5,
+        METRICS_CACHE_PATH=os.path.abspath('metrics_cache.db'),
+        WRITE_BEHIND=False,
+        WRITE_BEHIND_QUEUE_SIZE=100000,
+        WRITE_BEHIND_FLUSH_SIZE=500,
+        WRITE_BEHIND_FLUSH_INTERVAL=50,
+        WRITE_BEHIND_DURABLE_TIMEOUT=10,
+        WRITE_BEHIND_RETRIES=3,
+        INSTRUMENTATION=True,
+        JSON_LOGS=False,
+        AIO_DB_WORKERS=8,
+        AIO_WSGI_WORKERS=8,
+        AIO_MAX_CONNECTIONS=10000,
+        AIO_READ_TIMEOUT=60,
+        AIO_MAX_HEADER_SIZE=65536,
+        AIO_MAX_BODY_SIZE=16777216,
     )
 
     if test_config is None:
@@ -24,7 +62,14 @@ def create_app(test_config=None):
         pass
 
     db.init_app(app)
+    cache.init_app(app)
+    hotstore.init_app(app)
+    ingest.init_app(app)
+    instrumentation.init_app(app)
+    parallel.init_app(app)
     app.register_blueprint(api)
+    app.cli.add_command(aio.run_aio_command)
+    app.cli.add_command(export_readings_command)
 
     return app
 
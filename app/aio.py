@@ -0,0 +1,577 @@
+"""
+asyncio front end for the readings API.
+
+Devices on cellular links trickle their uploads, and a sync worker holds a
+thread for as long as one takes. Here a single event loop reads every
+connection and only hands complete requests to threads:
+
+- POSTs of a reading or a batch are parsed and validated with
+  ReadingSerializer on the loop, and written by a dedicated executor of
+  AIO_DB_WORKERS threads, each holding a pooled connection while it writes.
+- Any other request runs through the Flask app on AIO_WSGI_WORKERS threads,
+  its response streamed back by the loop.
+
+    flask run-aio --host 0.0.0.0 --port 8000
+
+This is a minimal HTTP/1.1 server: keep-alive, Content-Length and chunked
+bodies, and `Expect: 100-continue`. It is meant to sit behind a proxy
+handling TLS, like the Flask server.
+"""
+import asyncio
+import io
+import json
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl, unquote, unquote_to_bytes
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from marshmallow import ValidationError
+
+from app.api.serializers import QueryReadingsSerializer, ReadingSerializer
+from app.db import FrozenPartition, get_db, get_router
+from app.ingest import (POST_FIELDS, BatchError, notify_written, parse_batch,
+                        validate_readings, write_readings)
+
+ROUTES = (
+    (re.compile(r'/devices/(?P<uuid>[^/]+)/readings'), 'api.readings',
+     'post_reading'),
+    (re.compile(r'/devices/(?P<uuid>[^/]+)/readings/batch'),
+     'api.device_batch', 'post_batch'),
+    (re.compile(r'/readings/batch'), 'api.fleet_batch', 'post_batch'),
+)
+
+# Chunks of a bridged response buffered ahead of a slow client
+STREAM_BUFFER = 8
+
+# Most bytes of a body taken per read
+READ_SIZE = 65536
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Request():
+    __slots__ = ('method', 'path', 'query', 'version', 'headers', 'body',
+                 'peer')
+
+    def __init__(self, method, path, query, version, headers, peer):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.version = version
+        # Lower case names -> values
+        self.headers = headers
+        self.body = b''
+        self.peer = peer
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+class AioServer():
+    def __init__(self, app):
+        self.app = app
+        config = app.config
+        self.read_timeout = config['AIO_READ_TIMEOUT']
+        self.max_body_size = config['AIO_MAX_BODY_SIZE']
+        self.max_header_size = config['AIO_MAX_HEADER_SIZE']
+        self.max_connections = config['AIO_MAX_CONNECTIONS']
+        self.db_executor = ThreadPoolExecutor(config['AIO_DB_WORKERS'],
+                                              thread_name_prefix='aio-db')
+        self.wsgi_executor = ThreadPoolExecutor(config['AIO_WSGI_WORKERS'],
+                                                thread_name_prefix='aio-wsgi')
+        self.connections = 0
+        self.rejected = 0
+        self.requests = 0
+
+    async def start(self, host='127.0.0.1', port=8000):
+        """
+        Starts listening and returns the asyncio server.
+        """
+        return await asyncio.start_server(self.handle, host, port,
+                                          limit=self.max_header_size)
+
+    def close(self):
+        """
+        Waits for the executors. Their threads need the loop to hand their
+        responses over, so it must not be called from the loop.
+        """
+        self.db_executor.shutdown(wait=True)
+        self.wsgi_executor.shutdown(wait=True)
+
+    async def handle(self, reader, writer):
+        if self.connections >= self.max_connections:
+            self.rejected += 1
+            self.write_response(writer, 503, [], json_body(dict(
+                error='Too many connections')), keep_alive=False)
+            await close(writer)
+            return
+
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader, writer)
+                except HTTPError as e:
+                    self.write_response(writer, e.status, [], json_body(dict(
+                        error=e.message)), keep_alive=False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                self.requests += 1
+                await self.dispatch(request, writer)
+                if not request.keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # The server is shutting down. The stream protocol logs a
+            # handler ending cancelled, so this one ends quietly.
+            pass
+        finally:
+            self.connections -= 1
+            await close(writer)
+
+    async def read_request(self, reader, writer):
+        """
+        Reads the next request of a connection, body included. Returns None
+        once the client closed the connection between two requests.
+        """
+        try:
+            head = await self.read(reader.readuntil(b'\r\n\r\n'))
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise HTTPError(400, 'Incomplete request')
+            return None
+        except asyncio.LimitOverrunError:
+            raise HTTPError(431, 'Request header too large')
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise HTTPError(400, 'Invalid request line')
+        if version not in ('HTTP/1.0', 'HTTP/1.1'):
+            raise HTTPError(505, 'HTTP version not supported')
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise HTTPError(400, 'Invalid header line')
+            name = name.strip().lower()
+            value = value.strip()
+            headers[name] = (headers[name] + ', ' + value if name in headers
+                             else value)
+
+        path, _, query = target.partition('?')
+        peer = writer.get_extra_info('peername')
+        request = Request(method, path, query, version, headers, peer)
+        request.body = await self.read_body(request, reader, writer)
+        return request
+
+    async def read(self, awaitable):
+        """
+        Awaits one read of a connection. The timeout is an idle timeout:
+        it applies to each read, so a large body arriving slowly but
+        steadily is never cut off.
+        """
+        try:
+            return await asyncio.wait_for(awaitable, self.read_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPError(408, 'Request timeout')
+
+    async def read_exactly(self, reader, size):
+        data = bytearray()
+        while len(data) < size:
+            piece = await self.read(reader.read(min(size - len(data),
+                                                    READ_SIZE)))
+            if not piece:
+                raise asyncio.IncompleteReadError(bytes(data), size)
+            data += piece
+        return bytes(data)
+
+    async def read_body(self, request, reader, writer):
+        headers = request.headers
+        chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        length = headers.get('content-length')
+        if not chunked and not length:
+            return b''
+        if length and not chunked:
+            try:
+                length = int(length)
+            except ValueError:
+                length = -1
+            if length < 0:
+                raise HTTPError(400, 'Invalid Content-Length')
+            if length > self.max_body_size:
+                raise HTTPError(413, 'Body exceeds {} bytes'.format(
+                    self.max_body_size))
+
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        try:
+            if not chunked:
+                return await self.read_exactly(reader, length)
+            return await self.read_chunked(reader)
+        except asyncio.IncompleteReadError:
+            raise HTTPError(400, 'Incomplete body')
+
+    async def read_chunked(self, reader):
+        body = bytearray()
+        while True:
+            line = await self.read(reader.readline())
+            try:
+                size = int(line.split(b';')[0], 16)
+            except ValueError:
+                raise HTTPError(400, 'Invalid chunk size')
+            if size == 0:
+                # Trailers, up to the empty line
+                while (await self.read(reader.readline())).strip():
+                    pass
+                return bytes(body)
+            if len(body) + size > self.max_body_size:
+                raise HTTPError(413, 'Body exceeds {} bytes'.format(
+                    self.max_body_size))
+            body += await self.read_exactly(reader, size)
+            await self.read_exactly(reader, 2)
+
+    async def dispatch(self, request, writer):
+        if request.method == 'POST':
+            path = unquote(request.path)
+            for pattern, endpoint, handler in ROUTES:
+                match = pattern.fullmatch(path)
+                if match is None:
+                    continue
+                started = time.perf_counter()
+                try:
+                    status, data = await getattr(self, handler)(
+                        request, match.groupdict().get('uuid'))
+                except Exception:
+                    self.app.logger.exception('Error handling %s %s',
+                                              request.method, request.path)
+                    status, data = 500, dict(error='Internal server error')
+                self.write_response(writer, status, [], json_body(data),
+                                    request.keep_alive)
+                await writer.drain()
+                self.observe(endpoint, request.method, status,
+                             time.perf_counter() - started)
+                return
+        await self.bridge(request, writer)
+
+    def observe(self, endpoint, method, status, seconds):
+        instrumentation = self.app.extensions.get('instrumentation')
+        if instrumentation is not None:
+            instrumentation.requests.observe((endpoint, method, str(status)),
+                                             seconds)
+
+    async def post_reading(self, request, device_uuid):
+        """
+        Same contract as RootDeviceView.post.
+        """
+        try:
+            data = json.loads(request.body)
+        except ValueError as e:
+            return 400, dict(error='Invalid JSON: {}'.format(e))
+        if not data:
+            return 400, dict(error="Body can't be empty")
+        if not isinstance(data, dict):
+            return 400, dict(error='Reading must be a JSON object')
+        data['device_uuid'] = device_uuid
+        try:
+            valid_data = ReadingSerializer().load(data)
+            args = QueryReadingsSerializer().load(dict(
+                parse_qsl(request.query)))
+        except ValidationError as e:
+            return 400, str(e)
+
+        row = [valid_data[e] for e in POST_FIELDS]
+        row.append(int(time.time()))
+
+        buffer = self.app.extensions.get('write_behind')
+        if buffer is not None:
+            return await self.post_write_behind(buffer, row, data,
+                                                args.get('durable', False))
+
+        try:
+            await self.run_db(self.write, [row])
+        except FrozenPartition as e:
+            return 409, dict(error=str(e))
+        return 201, dict(data=data)
+
+    async def post_write_behind(self, buffer, row, data, durable):
+        try:
+            future = buffer.submit(row)
+        except queue.Full:
+            return 503, dict(error='Write buffer is full')
+        if not durable:
+            return 202, dict(data=data)
+
+        try:
+            await asyncio.wait_for(
+                asyncio.wrap_future(future),
+                self.app.config['WRITE_BEHIND_DURABLE_TIMEOUT'])
+        except FrozenPartition as e:
+            return 409, dict(error=str(e))
+        except asyncio.TimeoutError:
+            return 503, dict(error='Write not confirmed in time')
+        except sqlite3.Error as e:
+            return 503, dict(error='Write failed: {}'.format(e))
+        return 201, dict(data=data)
+
+    async def post_batch(self, request, device_uuid):
+        """
+        Same contract as BatchDeviceView.post.
+        """
+        try:
+            items = parse_batch(request.body,
+                                request.headers.get('content-type'))
+        except BatchError as e:
+            return 400, dict(error=str(e))
+
+        max_size = self.app.config['MAX_BATCH_SIZE']
+        if len(items) > max_size:
+            return 413, dict(error='Batch exceeds {} readings'.format(
+                max_size))
+
+        rows, errors = validate_readings(items, device_uuid)
+        try:
+            inserted = await self.run_db(self.write, rows)
+        except FrozenPartition as e:
+            return 409, dict(error=str(e))
+        data = dict(inserted=inserted, rejected=len(errors), errors=errors)
+        return 201 if inserted else 400, data
+
+    async def run_db(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_executor, function, *args)
+
+    def write(self, rows):
+        with self.app.app_context():
+            inserted = write_readings(get_db(), rows, get_router())
+            notify_written(self.app, rows)
+        return inserted
+
+    async def bridge(self, request, writer):
+        """
+        Runs the request through the Flask app on a WSGI thread, streaming
+        the response back as the thread produces it.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(maxsize=STREAM_BUFFER)
+        aborted = threading.Event()
+
+        def send(item):
+            if aborted.is_set() and item is not None:
+                raise ConnectionAbortedError
+            asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+        loop.run_in_executor(self.wsgi_executor, self.run_wsgi,
+                             self.environ(request), send)
+        finished = False
+        try:
+            head = await chunks.get()
+            if isinstance(head, BaseException):
+                self.write_response(writer, 500, [], json_body(dict(
+                    error='Internal server error')), keep_alive=False)
+                request.headers['connection'] = 'close'
+                return
+            status, headers = head
+            code = int(status.split(' ', 1)[0])
+            names = {name.lower() for name, _ in headers}
+            bodyless = request.method == 'HEAD' or code in (204, 304)
+            chunked = (not bodyless and 'content-length' not in names
+                       and request.version == 'HTTP/1.1')
+            keep_alive = request.keep_alive and (
+                chunked or bodyless or 'content-length' in names)
+            if chunked:
+                headers = headers + [('Transfer-Encoding', 'chunked')]
+            if not keep_alive:
+                request.headers['connection'] = 'close'
+            self.write_head(writer, status, headers, keep_alive)
+
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    finished = True
+                    break
+                if isinstance(chunk, BaseException):
+                    # Headers are gone, the client can only see a cut body
+                    request.headers['connection'] = 'close'
+                    return
+                if bodyless:
+                    continue
+                if chunked:
+                    writer.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+                else:
+                    writer.write(chunk)
+                await writer.drain()
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            if not finished:
+                aborted.set()
+                loop.create_task(drain(chunks))
+
+    def run_wsgi(self, environ, send):
+        head = []
+        # Whether the head went out, before the first write() or chunk
+        started = []
+
+        def send_head():
+            if not started:
+                started.append(True)
+                send(tuple(head))
+
+        def start_response(status, headers, exc_info=None):
+            head[:] = [status, list(headers)]
+
+            def write(data):
+                send_head()
+                if data:
+                    send(data)
+            return write
+
+        try:
+            iterable = self.app(environ, start_response)
+            try:
+                send_head()
+                for chunk in iterable:
+                    if chunk:
+                        send(chunk)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        except ConnectionAbortedError:
+            pass
+        except Exception as e:
+            self.app.logger.exception('Error bridging a request')
+            try:
+                send(e)
+            except ConnectionAbortedError:
+                pass
+        finally:
+            send(None)
+
+    def environ(self, request):
+        host, port = (request.peer or ('', 0))[:2]
+        server_name, _, server_port = request.headers.get(
+            'host', 'localhost').partition(':')
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote_to_bytes(request.path).decode('latin-1'),
+            'QUERY_STRING': request.query,
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': server_port or '80',
+            'SERVER_PROTOCOL': request.version,
+            'REMOTE_ADDR': host,
+            'REMOTE_PORT': str(port),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(request.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers.items():
+            if name in ('content-type', 'content-length'):
+                environ[name.upper().replace('-', '_')] = value
+            elif name != 'transfer-encoding':
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+        if request.body:
+            environ['CONTENT_LENGTH'] = str(len(request.body))
+        return environ
+
+    def write_head(self, writer, status, headers, keep_alive):
+        lines = ['HTTP/1.1 ' + status]
+        lines += ['{}: {}'.format(name, value) for name, value in headers]
+        if not keep_alive:
+            lines.append('Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    def write_response(self, writer, code, headers, body, keep_alive):
+        status = '{} {}'.format(code, HTTPStatus(code).phrase.upper())
+        headers = headers + [('Content-Type', 'application/json'),
+                             ('Content-Length', str(len(body)))]
+        self.write_head(writer, status, headers, keep_alive)
+        writer.write(body)
+
+    def stats(self):
+        return dict(
+            connections=self.connections,
+            max_connections=self.max_connections,
+            rejected_connections=self.rejected,
+            requests=self.requests,
+        )
+
+
+def json_body(data):
+    return (json.dumps(data) + '\n').encode('utf8')
+
+
+async def close(writer):
+    """
+    Closes a connection. A shutdown cancelling the wait is not an error:
+    the transport is closed either way.
+    """
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def drain(chunks):
+    """
+    Consumes what an aborted WSGI thread still sends, so it can finish.
+    """
+    while await chunks.get() is not None:
+        pass
+
+
+def serve(app, host='127.0.0.1', port=8000):
+    async def run():
+        server = AioServer(app)
+        app.extensions['aio'] = server
+        listening = await server.start(host, port)
+        try:
+            async with listening:
+                await listening.serve_forever()
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None,
+                                                             server.close)
+
+    asyncio.run(run())
+
+
+@click.command('run-aio')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', type=int, default=8000)
+@with_appcontext
+def run_aio_command(host, port):
+    """
+    Serves the API from the asyncio front end.
+    """
+    click.echo('Serving on http://{}:{}'.format(host, port))
+    serve(current_app._get_current_object(), host, port)
@@ -0,0 +1,151 @@
+import gzip
+import json
+import os
+
+import click
+from flask import (Response, current_app, jsonify, request,
+                   stream_with_context, url_for)
+from flask.cli import with_appcontext
+from marshmallow import ValidationError
+
+from app import export
+from app.api import api
+from app.api.readings import DeviceView
+from app.api.serializers import ExportSerializer, encode_cursor
+from app.db import get_partition_db, get_router
+
+
+class ExportView(DeviceView):
+    def export(self, valid_data):
+        """
+        Returns the Export of the queried readings of every device.
+        """
+        lo, hi = self.date_range(valid_data)
+        router = get_router()
+        if router is None:
+            partitions = [(('', 0), self.db)]
+        else:
+            partitions = [(key, get_partition_db(key))
+                          for key in router.route(None, lo, hi)]
+        return export.Export(partitions, valid_data.get('type'), lo, hi,
+                             valid_data.get('after'),
+                             current_app.config['EXPORT_CHUNK_SIZE'])
+
+    def get(self):
+        """
+        Streams the readings as CSV or NDJSON. With `limit`, the token
+        resuming after the last row is sent in the Link and X-Next-Cursor
+        headers, found up front from the index alone, and the page is
+        streamed up to that token. Without a next page, every row left is
+        streamed.
+        """
+        valid_data = ExportSerializer().load(request.args)
+        fmt = valid_data.get('format', 'csv')
+        compress = valid_data.get('gzip', False)
+        limit = valid_data.get('limit')
+        job = self.export(valid_data)
+        next_token = job.boundary(limit) if limit else None
+
+        def texts():
+            if fmt == 'csv':
+                yield export.csv_header()
+            for rows, _ in job.chunks(next_token):
+                yield export.format_rows(rows, fmt)
+
+        response = Response(
+            stream_with_context(export.encode(texts(), compress)),
+            mimetype=export.MIMETYPES[fmt])
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+        if next_token is not None:
+            cursor = encode_cursor(next_token)
+            args = request.args.to_dict()
+            args['after'] = cursor
+            next_url = url_for('api.export', **args)
+            response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+            response.headers['X-Next-Cursor'] = cursor
+        return response
+
+
+@api.route('/readings/export', endpoint='export', methods=['GET'])
+def export_readings():
+    view = ExportView()
+    try:
+        return view.get()
+    except ValidationError as e:
+        return jsonify(str(e)), 400
+
+
+@click.command('export-readings')
+@click.argument('output', type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(export.FORMATS),
+              default='csv')
+@click.option('--gzip', 'compress', is_flag=True,
+              help='Gzip the output.')
+@click.option('--type', 'sensor_type', help='Only readings of this type.')
+@click.option('--date-from', help='First day, YYYY-MM-DD.')
+@click.option('--date-to', help='Last day, YYYY-MM-DD.')
+@click.option('--resume', is_flag=True,
+              help='Continue an interrupted export into OUTPUT.')
+@with_appcontext
+def export_readings_command(output, fmt, compress, sensor_type, date_from,
+                            date_to, resume):
+    """
+    Exports every reading to OUTPUT ('-' for stdout).
+
+    The token and file size after each chunk are kept in OUTPUT.cursor, so
+    --resume drops any partial chunk and carries on after the last one.
+    Gzipped chunks are separate gzip members, which concatenate into a
+    valid file.
+    """
+    args = dict(type=sensor_type, date_from=date_from, date_to=date_to)
+    try:
+        valid_data = ExportSerializer().load(
+            {k: v for k, v in args.items() if v is not None})
+    except ValidationError as e:
+        raise click.UsageError(str(e))
+
+    progress_path = output + '.cursor'
+    if output == '-':
+        if resume:
+            raise click.UsageError("Can't resume an export to stdout.")
+        out = click.get_binary_stream('stdout')
+    elif resume:
+        try:
+            with open(progress_path) as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            raise click.UsageError(
+                'No export to resume in {}.'.format(output))
+        valid_data['after'] = progress['token']
+        out = open(output, 'r+b')
+        out.truncate(progress['offset'])
+        out.seek(progress['offset'])
+    else:
+        out = open(output, 'wb')
+
+    def write(text):
+        data = text.encode('utf8')
+        out.write(gzip.compress(data) if compress else data)
+
+    exported = 0
+    try:
+        if fmt == 'csv' and not resume:
+            write(export.csv_header())
+        for rows, token in ExportView().export(valid_data).chunks():
+            write(export.format_rows(rows, fmt))
+            exported += len(rows)
+            if output == '-':
+                continue
+            out.flush()
+            with open(progress_path + '.tmp', 'w') as f:
+                json.dump(dict(token=token, offset=out.tell()), f)
+            os.replace(progress_path + '.tmp', progress_path)
+    finally:
+        if output != '-':
+            out.close()
+
+    if output != '-':
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        click.echo('Exported {} readings to {}.'.format(exported, output))
@@ -1,15 +1,35 @@
+import hashlib
+import json
+import queue
 import sqlite3
 import statistics
 import time
-from datetime import datetime, timedelta
+from concurrent import futures
+from datetime import timedelta
+from operator import itemgetter
 
-from flask import request, jsonify
+from flask import (Response, current_app, jsonify, make_response, request,
+                   stream_with_context, url_for)
 from marshmallow import ValidationError
-import numpy as np
 
+from app import histograms, rollups, sketches, summaries, versions
 from app.api import api
-from app.api.serializers import ReadingSerializer, QueryReadingsSerializer
-from app.db import get_db
+from app.api.serializers import (ReadingSerializer, QueryReadingsSerializer,
+                                 QuerySummarySerializer, RowEncoder,
+                                 encode_cursor)
+from app.cache import MISS, get_cache
+from app.db import FrozenPartition, get_db, get_partition_db, get_router
+from app.hotstore import get_hot_store
+from app.instrumentation import phase
+from app.ingest import (BatchError, get_write_behind, notify_written,
+                        parse_batch, validate_readings, write_readings)
+from app.parallel import fleet_devices, get_summary_pool
+from app.stats import (mean_from_sum, median_from_counts, mode_of_ties,
+                       modes_from_counts, percentile_from_counts,
+                       summarize_counts)
+
+
+ROW_ENCODER = RowEncoder()
 
 
 class DeviceView():
@@ -19,11 +39,13 @@ class DeviceView():
         self.db = get_db()
 
         self.get_sentence = '''
-            SELECT date_created, device_uuid, type, value
+            SELECT {}
             FROM readings
-            WHERE device_uuid = "{}"
+            WHERE {}
         '''
 
+        self.GET_FIELDS = 'date_created, device_uuid, type, value'
+
         self.POST_FIELDS = ['device_uuid', 'type', 'value']
 
         self.post_sentence = '''
@@ -36,37 +58,133 @@ class DeviceView():
             VALUES (?,?,?,?)
         '''
 
-    def get_queried_data(self, device_uuid):
-        valid_data = QueryReadingsSerializer().load(request.args)
-
-        query = self.get_sentence.format(device_uuid)
-
-        if 'type' in valid_data:
-            query += ' AND type = "{}"'.format(valid_data['type'])
+    def date_range(self, valid_data):
+        """
+        Returns the half-open [lo, hi) range of date_created timestamps
+        matching the date filters, with None for an open end.
+        """
+        lo = None
+        hi = None
 
         if 'date_to' in valid_data:
             plus_day = valid_data['date_to'] + timedelta(days=1)
-            ts = int(time.mktime(plus_day.timetuple()))
-            query += ' AND date_created < {}'.format(ts)
+            hi = int(time.mktime(plus_day.timetuple()))
 
         if 'date_from' in valid_data:
             plus_day = valid_data['date_from'] - timedelta(days=1)
-            ts = int(time.mktime(plus_day.timetuple()))
-            query += ' AND date_created > {}'.format(ts)
+            lo = int(time.mktime(plus_day.timetuple())) + 1
 
-        cur = self.db.execute(query)
-        rows = cur.fetchall()
-        rows_dict = []
+        return lo, hi
 
-        for row in rows:
-            row_dict = dict()
-            for r in self.POST_FIELDS:
-                row_dict[r] = row[r]
-            row_dict['date_created'] = datetime.fromtimestamp(
-                row['date_created'])
-            rows_dict.append(row_dict)
+    def build_query(self, device_uuid, valid_data, fields=None):
+        """
+        Returns the SQL sentence and its parameters selecting `fields` from
+        the device readings that match the query filters. A device_uuid of
+        None selects the readings of every device.
+        """
+        conditions = []
+        params = []
 
-        return ReadingSerializer(many=True).dump(rows_dict)
+        if device_uuid is not None:
+            conditions.append('device_uuid = ?')
+            params.append(device_uuid)
+
+        if 'type' in valid_data:
+            conditions.append('type = ?')
+            params.append(valid_data['type'])
+
+        lo, hi = self.date_range(valid_data)
+        if hi is not None:
+            conditions.append('date_created < ?')
+            params.append(hi)
+
+        if lo is not None:
+            conditions.append('date_created >= ?')
+            params.append(lo)
+
+        query = self.get_sentence.format(fields or self.GET_FIELDS,
+                                         ' AND '.join(conditions) or '1')
+        return query, params
+
+    def partitions(self, device_uuid, lo=None, hi=None):
+        """
+        Returns the databases that can hold readings of the device, or of
+        every device when device_uuid is None, in [lo, hi), in time order.
+        """
+        router = get_router()
+        if router is None:
+            return [self.db]
+        return [get_partition_db(key)
+                for key in router.route(device_uuid, lo, hi)]
+
+    def hot_store(self, lo):
+        """
+        Returns the hot store when it holds every reading from lo on.
+        """
+        store = get_hot_store()
+        if store is None or get_router() is not None:
+            return None
+        store.refresh(self.db)
+        return store if store.covers(lo) else None
+
+    def get_queried_data(self, device_uuid):
+        valid_data = QueryReadingsSerializer().load(request.args)
+
+        lo, hi = self.date_range(valid_data)
+        store = self.hot_store(lo)
+        if store is not None:
+            with phase('hot_store') as timed:
+                rows = store.rows(device_uuid, valid_data.get('type'), lo, hi)
+                timed.rows = len(rows)
+            with phase('serialize'):
+                return self.serialize_rows(rows)
+
+        query, params = self.build_query(device_uuid, valid_data)
+        rows = []
+        with phase('sql') as timed:
+            for db in self.partitions(device_uuid, lo, hi):
+                cur = db.cursor()
+                cur.row_factory = None
+                rows.extend(cur.execute(query, params))
+            timed.rows = len(rows)
+        with phase('serialize'):
+            return ROW_ENCODER.encode_many(rows)
+
+    def etag(self, device_uuid):
+        """
+        Returns the ETag of a GET: the write version of the device, or of
+        the fleet when device_uuid is None, and a digest of the URL.
+        """
+        version = 0
+        for db in self.partitions(device_uuid):
+            if device_uuid is None:
+                version += versions.fleet_version(db)
+            else:
+                version += versions.device_version(db, device_uuid)
+        digest = hashlib.sha1(request.full_path.encode('utf8')).hexdigest()
+        return '{}-{}'.format(version, digest[:16])
+
+    def conditional(self, device_uuid, respond):
+        """
+        Answers a GET with a 304 when If-None-Match holds the current ETag,
+        before any reading is queried. The version is read first, so a
+        write landing meanwhile can only make the ETag older than the data.
+        """
+        etag = self.etag(device_uuid)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(respond())
+        response.set_etag(etag)
+        return response
+
+    def serialize_rows(self, rows, many=True):
+        """
+        Dumps readings given as mappings, like sqlite3.Row or dicts.
+        """
+        if not many:
+            return ROW_ENCODER.encode_mapping(rows[0])
+        return [ROW_ENCODER.encode_mapping(row) for row in rows]
 
 
 class RootDeviceView(DeviceView):
@@ -82,107 +200,446 @@ class RootDeviceView(DeviceView):
         model_data = [valid_data[e] for e in self.POST_FIELDS]
         model_data.append(int(time.time()))
 
-        self.db.row_factory = sqlite3.Row
-        cur = self.db.cursor()
-        cur.execute(self.post_sentence, model_data)
-        self.db.commit()
+        buffer = get_write_behind()
+        if buffer is not None:
+            return self._post_write_behind(buffer, model_data, data)
+
+        router = get_router()
+        if router is not None:
+            try:
+                write_readings(self.db, [model_data], router)
+            except FrozenPartition as e:
+                return jsonify(dict(error=str(e))), 409
+        else:
+            self.db.row_factory = sqlite3.Row
+            cur = self.db.cursor()
+            cur.execute(self.post_sentence, model_data)
+            self.db.commit()
+        notify_written(current_app, [model_data])
+
+        return jsonify(dict(data=data)), 201
+
+    def _post_write_behind(self, buffer, model_data, data):
+        valid_args = QueryReadingsSerializer().load(request.args)
+        durable = valid_args.get('durable', False)
+        try:
+            future = buffer.submit(model_data)
+        except queue.Full:
+            return jsonify(dict(error='Write buffer is full')), 503
 
+        if not durable:
+            return jsonify(dict(data=data)), 202
+
+        try:
+            future.result(current_app.config['WRITE_BEHIND_DURABLE_TIMEOUT'])
+        except FrozenPartition as e:
+            return jsonify(dict(error=str(e))), 409
+        except futures.TimeoutError:
+            return jsonify(dict(error='Write not confirmed in time')), 503
+        except sqlite3.Error as e:
+            return jsonify(dict(error='Write failed: {}'.format(e))), 503
         return jsonify(dict(data=data)), 201
 
     def get(self, *args, **kwargs):
-        return jsonify(self.get_queried_data(kwargs.get('uuid')))
+        valid_data = QueryReadingsSerializer().load(request.args)
+        if 'limit' in valid_data:
+            return self.page_queried_data(kwargs.get('uuid'), valid_data)
+        if 'stream' in valid_data:
+            return self.stream_queried_data(kwargs.get('uuid'), valid_data)
+        data = self.get_queried_data(kwargs.get('uuid'))
+        with phase('jsonify'):
+            return jsonify(data)
+
+    def page_queried_data(self, device_uuid, valid_data):
+        """
+        Returns one page of readings in (date_created, rowid) order, seeking
+        past the cursor through the readings_device_date index. The cursor
+        of the next page is sent in the Link and X-Next-Cursor headers.
+
+        A device lives in one shard and months don't overlap, so partitions
+        are read one after the other in time order.
+        """
+        limit = min(valid_data['limit'], current_app.config['MAX_PAGE_SIZE'])
+        query, params = self.build_query(device_uuid, valid_data,
+                                         self.GET_FIELDS + ', rowid')
+        lo, hi = self.date_range(valid_data)
+        if 'cursor' in valid_data:
+            query += ' AND (date_created, rowid) > (?, ?)'
+            params.extend(valid_data['cursor'])
+            lo = max(lo or 0, valid_data['cursor'][0])
+        query += ' ORDER BY date_created, rowid LIMIT ?'
+
+        rows = []
+        with phase('sql') as timed:
+            for db in self.partitions(device_uuid, lo, hi):
+                cur = db.cursor()
+                cur.row_factory = None
+                rows += cur.execute(query, params + [limit + 1 - len(rows)])
+                if len(rows) > limit:
+                    break
+            timed.rows = len(rows)
+        with phase('serialize'):
+            data = ROW_ENCODER.encode_many(row[:4] for row in rows[:limit])
+        with phase('jsonify'):
+            response = jsonify(data)
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            cursor = encode_cursor((last[0], last[4]))
+            args = request.args.to_dict()
+            args['cursor'] = cursor
+            next_url = url_for('api.readings', uuid=device_uuid, **args)
+            response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+            response.headers['X-Next-Cursor'] = cursor
+        return response
+
+    def stream_queried_data(self, device_uuid, valid_data):
+        """
+        Streams the readings as a JSON array or as NDJSON, serializing
+        STREAM_CHUNK_SIZE rows at a time straight from the cursor.
+        """
+        ndjson = valid_data['stream'] == 'ndjson'
+        chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+        query, params = self.build_query(device_uuid, valid_data)
+        lo, hi = self.date_range(valid_data)
+        dbs = self.partitions(device_uuid, lo, hi)
+
+        def chunks():
+            for db in dbs:
+                cur = db.cursor()
+                cur.row_factory = None
+                with phase('sql'):
+                    cur.execute(query, params)
+                while True:
+                    with phase('sql') as timed:
+                        rows = cur.fetchmany(chunk_size)
+                        timed.rows = len(rows)
+                    if not rows:
+                        break
+                    yield rows
+
+        def generate():
+            separator = '\n' if ndjson else ','
+            first = True
+            if not ndjson:
+                yield '['
+            for rows in chunks():
+                with phase('serialize'):
+                    chunk = separator.join(
+                        json.dumps(r) for r in ROW_ENCODER.encode_many(rows))
+                if ndjson:
+                    yield chunk + '\n'
+                else:
+                    yield chunk if first else ',' + chunk
+                first = False
+            if not ndjson:
+                yield ']'
+
+        mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+        return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+class BatchDeviceView(DeviceView):
+    def post(self, *args, **kwargs):
+        try:
+            items = parse_batch(request.get_data(), request.content_type)
+        except BatchError as e:
+            return jsonify(dict(error=str(e))), 400
+
+        max_size = current_app.config['MAX_BATCH_SIZE']
+        if len(items) > max_size:
+            return jsonify(dict(
+                error='Batch exceeds {} readings'.format(max_size))), 413
+
+        rows, errors = validate_readings(items, kwargs.get('uuid'))
+        try:
+            inserted = write_readings(self.db, rows, get_router())
+        except FrozenPartition as e:
+            return jsonify(dict(error=str(e))), 409
+        notify_written(current_app, rows)
+
+        data = dict(inserted=inserted, rejected=len(errors), errors=errors)
+        return jsonify(data), 201 if inserted else 400
 
 
 class MetricsDeviceView(DeviceView):
+    METRICS = ('max', 'min', 'count', 'mean', 'median', 'mode', 'quartiles',
+               'summary')
 
-    def _metric_to_query(self, uuid, func, queried=None):
-        if not queried:
-            queried = self.get_queried_data(uuid)
-        value = None
-        values = [r['value'] for r in queried]
-        if values:
-            value = func(values)
-        return {'value': value}
+    def _histogram_to_query(self, uuid):
+        """
+        Returns the (values, counts) histogram of the queried readings.
+        """
+        valid_data = QueryReadingsSerializer().load(request.args)
+        lo, hi = self.date_range(valid_data)
+        store = self.hot_store(lo)
+        if store is not None:
+            with phase('hot_store'):
+                return store.value_counts(uuid, valid_data.get('type'), lo,
+                                          hi)
+
+        merged = {}
+        with phase('sql') as timed:
+            for db in self.partitions(uuid, lo, hi):
+                values, counts = histograms.value_counts(
+                    db, uuid, valid_data.get('type'), lo, hi)
+                for value, count in zip(values, counts):
+                    merged[value] = merged.get(value, 0) + count
+            timed.rows = len(merged)
+        values = sorted(merged)
+        return values, [merged[v] for v in values]
+
+    def _first_seen(self, uuid, valid_data):
+        """
+        Returns rollups.first_seen for the queried readings, answered from
+        the hot store when it can tell.
+        """
+        lo, hi = self.date_range(valid_data)
+        in_sql = rollups.first_seen(self.partitions(uuid, lo, hi), uuid,
+                                    valid_data.get('type'), lo, hi)
+
+        def first_seen(ties):
+            with phase('sql'):
+                return in_sql(ties)
+
+        store = self.hot_store(lo)
+        if store is None:
+            return first_seen
+        in_memory = store.first_seen(uuid, valid_data.get('type'), lo, hi)
+
+        def hot_first_seen(ties):
+            value = in_memory(ties)
+            return first_seen(ties) if value is None else value
+
+        return hot_first_seen
+
+    def _rollup_to_query(self, uuid):
+        """
+        Returns the Aggregate of the queried readings, read from the
+        rollups with raw readings only at the edges of the range.
+        """
+        valid_data = QueryReadingsSerializer().load(request.args)
+        lo, hi = self.date_range(valid_data)
+        store = self.hot_store(lo)
+        if store is not None:
+            with phase('hot_store'):
+                return store.aggregate(uuid, valid_data.get('type'), lo, hi)
+
+        aggregate = rollups.Aggregate(0, 0, None, None)
+        with phase('sql'):
+            for db in self.partitions(uuid, lo, hi):
+                aggregate = rollups.merge(aggregate, rollups.aggregate(
+                    db, uuid, valid_data.get('type'), lo, hi))
+        return aggregate
+
+    def _extreme_to_query(self, uuid, extreme):
+        """
+        Returns the full reading holding the max or min value.
+        """
+        valid_data = QueryReadingsSerializer().load(request.args)
+        lo, hi = self.date_range(valid_data)
+        value = getattr(self._rollup_to_query(uuid), extreme)
+        if value is None:
+            return {'value': None}
+        store = self.hot_store(lo)
+        if store is not None:
+            with phase('hot_store'):
+                row = store.find_reading(uuid, valid_data.get('type'), lo,
+                                         hi, [value])
+        else:
+            with phase('sql'):
+                for db in self.partitions(uuid, lo, hi):
+                    row = rollups.find_reading(
+                        db, uuid, valid_data.get('type'), lo, hi, value,
+                        self.GET_FIELDS)
+                    if row is not None:
+                        break
+        with phase('serialize'):
+            return self.serialize_rows([row], many=False)
 
     def max(self, *args, **kwargs):
-        return jsonify(self._metric_to_query(kwargs['uuid'], max))
+        return self._extreme_to_query(kwargs['uuid'], 'max')
 
     def min(self, *args, **kwargs):
-        return jsonify(self._metric_to_query(kwargs['uuid'], min))
+        return self._extreme_to_query(kwargs['uuid'], 'min')
+
+    def count(self, *args, **kwargs):
+        aggregate = self._rollup_to_query(kwargs['uuid'])
+        return {'value': aggregate.count}
+
+    def _sketch_to_query(self, uuid):
+        """
+        Returns the merged quantile sketch of the queried readings.
+        """
+        valid_data = QueryReadingsSerializer().load(request.args)
+        lo, hi = self.date_range(valid_data)
+        k = current_app.config['SKETCH_K']
+        sketch = sketches.KLLSketch(k)
+        with phase('sql'):
+            for db in self.partitions(uuid, lo, hi):
+                sketch.merge(sketches.range_sketch(
+                    db, uuid, valid_data.get('type'), lo, hi, k))
+        return sketch
+
+    def _approx(self):
+        valid_data = QueryReadingsSerializer().load(request.args)
+        return valid_data.get('approx', False)
 
     def quartiles(self, *args, **kwargs):
-        queried = self.get_queried_data(kwargs.get('uuid'))
+        if self._approx():
+            sketch = self._sketch_to_query(kwargs.get('uuid'))
+            with phase('stats'):
+                return dict(quartile_1=sketch.quantile(0.25),
+                            quartile_3=sketch.quantile(0.75))
+
         quartile_1 = None
         quartile_3 = None
-        values = [r['value'] for r in queried]
+        values, counts = self._histogram_to_query(kwargs.get('uuid'))
         if values:
-            quartile_1 = np.percentile(values, 25)
-            quartile_3 = np.percentile(values, 75)
+            with phase('stats'):
+                quartile_1 = percentile_from_counts(values, counts, 25)
+                quartile_3 = percentile_from_counts(values, counts, 75)
         data = dict(quartile_1=quartile_1, quartile_3=quartile_3)
         return data
 
     def median(self, *args, **kwargs):
-        return jsonify(self._metric_to_query(kwargs['uuid'],
-                                             statistics.median))
+        if self._approx():
+            sketch = self._sketch_to_query(kwargs['uuid'])
+            with phase('stats'):
+                return {'value': sketch.quantile(0.5)}
+
+        value = None
+        values, counts = self._histogram_to_query(kwargs['uuid'])
+        if values:
+            with phase('stats'):
+                value = median_from_counts(values, counts)
+        return {'value': value}
 
     def mean(self, *args, **kwargs):
-        return jsonify(self._metric_to_query(kwargs['uuid'], statistics.mean))
+        aggregate = self._rollup_to_query(kwargs['uuid'])
+        return {'value': mean_from_sum(aggregate.sum, aggregate.count)}
 
     def mode(self, *args, **kwargs):
-        try:
-            return self._metric_to_query(kwargs['uuid'], statistics.mode)
-        except statistics.StatisticsError:
-            return jsonify({"value": "Multiple Modes"})
-
-    def summary(self, *args, **kwargs):
-        return_data = []
-
-        cur = self.db.execute('SELECT device_uuid FROM readings'
-                              + ' GROUP BY device_uuid')
-        rows = cur.fetchall()
-        devices_ids = [r['device_uuid'] for r in rows]
-
-        for device_uuid in devices_ids:
-            queried = self.get_queried_data(device_uuid)
-            number_of_readings = len(queried)
-
-            max_reading_value = self._metric_to_query(device_uuid,
-                                                      max,
-                                                      queried)['value']
-            min_reading_value = self._metric_to_query(device_uuid,
-                                                      min,
-                                                      queried)['value']
-            median_reading_value = self._metric_to_query(device_uuid,
-                                                         statistics.median,
-                                                         queried)['value']
+        value = None
+        values, counts = self._histogram_to_query(kwargs['uuid'])
+        if values:
+            with phase('stats'):
+                ties = modes_from_counts(values, counts)
+            valid_data = QueryReadingsSerializer().load(request.args)
+            first_seen = self._first_seen(kwargs['uuid'], valid_data)
             try:
-                mode_reading_value = self._metric_to_query(device_uuid,
-                                                           statistics.mode,
-                                                           queried)['value']
+                value = mode_of_ties(ties, first_seen)
             except statistics.StatisticsError:
-                mode_reading_value = 'Multiple Modes'
-            mean_reading_value = self._metric_to_query(device_uuid,
-                                                       statistics.mean,
-                                                       queried)['value']
-
-            quartiles = self.quartiles(*args, **kwargs)
-            quartile_1_value = quartiles['quartile_1']
-            quartile_3_value = quartiles['quartile_3']
-
-            data = {
-                'device_uuid': device_uuid,
-                'number_of_readings': number_of_readings,
-                'max_reading_value': max_reading_value,
-                'min_reading_value': min_reading_value,
-                'median_reading_value': median_reading_value,
-                'mode_reading_value': mode_reading_value,
-                'mean_reading_value': mean_reading_value,
-                'quartile_1_value': quartile_1_value,
-                'quartile_3_value': quartile_3_value,
-            }
+                value = "Multiple Modes"
+        return {'value': value}
+
+    def _summarize(self, valid_data, devices=None):
+        """
+        Summarizes every device, or the sorted list of `devices`, from the
+        value histograms, streamed in device order so one device is held
+        in memory at a time, or on the summary worker processes when there
+        are some.
+        """
+        lo, hi = self.date_range(valid_data)
+        pool = get_summary_pool()
+        if pool is not None:
+            router = get_router()
+            paths = ([current_app.config['DATABASE']] if router is None
+                     else [router.path(key)
+                           for key in router.route(None, lo, hi)])
+            if devices is None:
+                with phase('sql'):
+                    devices = fleet_devices(self.partitions(None, lo, hi))
+            with phase('stats'):
+                return pool.summarize(paths, devices, valid_data.get('type'),
+                                      lo, hi)
+
+        stream = histograms.device_value_counts(
+            self.partitions(None, lo, hi), valid_data.get('type'), lo, hi,
+            devices=devices)
+
+        return_data = []
+        while True:
+            with phase('sql'):
+                device = next(stream, None)
+            if device is None:
+                break
+            device_uuid, values, counts = device
+            data = dict(device_uuid=device_uuid)
+            first_seen = self._first_seen(device_uuid, valid_data)
+            with phase('stats'):
+                data.update(summarize_counts(values, counts, first_seen))
             return_data.append(data)
 
-        return jsonify(return_data)
+        return_data.sort(key=itemgetter('number_of_readings'), reverse=True)
+        return return_data
+
+    def summary(self, *args, **kwargs):
+        valid_data = QuerySummarySerializer().load(request.args)
+        if 'top' in valid_data or 'limit' in valid_data:
+            return self.page_summary(valid_data, kwargs)
+        return self._summarize(valid_data)
+
+    def page_summary(self, valid_data, kwargs):
+        """
+        Returns the `top` devices with the most readings, or one page of
+        `limit` devices in the same order, past the cursor. Devices are
+        ranked on their counts through a heap holding one page, and only
+        the devices of the page are summarized. The cursor of the next
+        page is sent in the Link and X-Next-Cursor headers.
+        """
+        if 'top' in valid_data and ('limit' in valid_data or
+                                    'cursor' in valid_data):
+            raise ValidationError("top can't be combined with limit or "
+                                  "cursor.")
+        size = min(valid_data.get('top') or valid_data['limit'],
+                   current_app.config['MAX_PAGE_SIZE'])
+        lo, hi = self.date_range(valid_data)
+        with phase('sql') as timed:
+            counts = summaries.device_counts(self.partitions(None, lo, hi),
+                                             valid_data.get('type'), lo, hi)
+            # One more tells whether there is a next page
+            page = summaries.top_devices(
+                counts, size if 'top' in valid_data else size + 1,
+                valid_data.get('cursor'))
+            timed.rows = len(page)
+
+        data = []
+        if page:
+            data = self._summarize(valid_data, sorted(
+                device_uuid for device_uuid, _ in page[:size]))
+        with phase('jsonify'):
+            response = jsonify(data)
+        if len(page) > size:
+            device_uuid, count = page[size - 1]
+            cursor = encode_cursor((count, device_uuid))
+            args = request.args.to_dict()
+            args['cursor'] = cursor
+            next_url = url_for('api.root_device', uuid=kwargs['uuid'],
+                               metrics='summary', **args)
+            response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+            response.headers['X-Next-Cursor'] = cursor
+        return response
+
+    def cached(self, metric, *args, **kwargs):
+        """
+        Returns the metric data, from the metrics cache when it holds it.
+        Summaries span every device and are not cached.
+        """
+        method = getattr(self, metric)
+        cache = get_cache()
+        if cache is None or metric == 'summary':
+            return method(*args, **kwargs)
+
+        uuid = kwargs['uuid']
+        valid_data = QueryReadingsSerializer().load(request.args)
+        key = json.dumps([uuid, metric, valid_data], sort_keys=True,
+                         default=str)
+        data = cache.get(uuid, key)
+        if data is MISS:
+            generation = cache.generation(uuid)
+            data = method(*args, **kwargs)
+            cache.set(uuid, key, data, generation)
+        return data
 
 
 @api.route('/devices/<uuid>/readings', endpoint='readings',
@@ -191,19 +648,41 @@ def root_device(*args, **kwargs):
     view = RootDeviceView()
     method = getattr(view, request.method.lower())
     try:
+        if request.method == 'GET':
+            return view.conditional(kwargs.get('uuid'),
+                                    lambda: method(*args, **kwargs))
         return method(*args, **kwargs)
     except ValidationError as e:
         return jsonify(str(e)), 400
 
 
+@api.route('/devices/<uuid>/readings/batch', endpoint='device_batch',
+           methods=['POST'])
+@api.route('/readings/batch', endpoint='fleet_batch', methods=['POST'])
+def batch(*args, **kwargs):
+    view = BatchDeviceView()
+    return view.post(*args, **kwargs)
+
+
 @api.route('/devices/<uuid>/readings/<metrics>', methods=['POST', 'GET'])
 def root_device(*args, **kwargs):
-    view = MetricsDeviceView()
-    try:
-        method = getattr(view, kwargs.get('metrics'))
-    except AttributeError:
+    metric = kwargs.get('metrics')
+    if metric not in MetricsDeviceView.METRICS:
         return jsonify('Not found'), 404
+    view = MetricsDeviceView()
+
+    def respond():
+        data = view.cached(metric, *args, **kwargs)
+        if isinstance(data, Response):
+            return data
+        with phase('jsonify'):
+            return jsonify(data)
+
     try:
-        return method(*args, **kwargs)
+        if request.method == 'GET':
+            # Summaries span every device
+            device_uuid = None if metric == 'summary' else kwargs.get('uuid')
+            return view.conditional(device_uuid, respond)
+        return respond()
     except ValidationError as e:
         return jsonify(str(e)), 400
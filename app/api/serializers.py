@@ -1,4 +1,44 @@
-from marshmallow import Schema, fields, validate
+import base64
+import json
+import time
+from datetime import date, timedelta
+
+from marshmallow import Schema, ValidationError, fields, validate
+
+
+def encode_cursor(key):
+    raw = json.dumps(list(key), separators=(',', ':')).encode('utf8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+class Cursor(fields.Field):
+    """
+    Opaque pagination cursor wrapping the key of the last row returned.
+    With `types`, every element of the key must be of the given type.
+    """
+
+    def __init__(self, length, types=None, **kwargs):
+        super().__init__(**kwargs)
+        self.length = length
+        self.types = types
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        if value is None:
+            return None
+        return encode_cursor(value)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        try:
+            padded = value + '=' * (-len(value) % 4)
+            key = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        except (ValueError, TypeError, AttributeError):
+            raise ValidationError('Invalid cursor.')
+        if not isinstance(key, list) or len(key) != self.length:
+            raise ValidationError('Invalid cursor.')
+        if self.types is not None and not all(
+                type(item) is kind for item, kind in zip(key, self.types)):
+            raise ValidationError('Invalid cursor.')
+        return tuple(key)
 
 
 class ReadingSerializer(Schema):
@@ -14,3 +54,82 @@ class QueryReadingsSerializer(Schema):
     type = fields.String()
     date_from = fields.Date()
     date_to = fields.Date()
+    durable = fields.Boolean()
+    stream = fields.String(validate=validate.OneOf(["json", "ndjson"]))
+    limit = fields.Integer(validate=validate.Range(min=1))
+    cursor = Cursor(length=2, types=(int, int))
+    approx = fields.Boolean()
+
+
+class QuerySummarySerializer(QueryReadingsSerializer):
+    top = fields.Integer(validate=validate.Range(min=1))
+    cursor = Cursor(length=2, types=(int, str))
+
+
+class ExportSerializer(Schema):
+    type = fields.String()
+    date_from = fields.Date()
+    date_to = fields.Date()
+    format = fields.String(validate=validate.OneOf(["csv", "ndjson"]))
+    gzip = fields.Boolean()
+    limit = fields.Integer(validate=validate.Range(min=1))
+    after = Cursor(length=5, types=(str, int, str, int, int))
+
+
+class RowEncoder():
+    """
+    Dumps readings exactly as ReadingSerializer does, straight from
+    (date_created, device_uuid, type, value) tuples, without building a
+    dict and a datetime per row and going through marshmallow for each.
+
+    The schema is checked once, when the encoder is built, so a change to
+    ReadingSerializer can't silently make both paths disagree.
+    """
+
+    FIELDS = ('date_created', 'device_uuid', 'type', 'value')
+
+    SCHEMA = {
+        'type': fields.String,
+        'device_uuid': fields.String,
+        'value': fields.Number,
+        'date_created': fields.Date,
+    }
+
+    def __init__(self, schema=None):
+        dump_fields = (schema or ReadingSerializer()).dump_fields
+        if (set(dump_fields) != set(self.SCHEMA) or any(
+                type(dump_fields[name]) is not kind
+                for name, kind in self.SCHEMA.items())):
+            raise TypeError("ReadingSerializer doesn't match RowEncoder")
+        self.number = dump_fields['value'].num_type
+        # Local day of the last timestamp: (start, end, isoformat)
+        self.day = (0, 0, None)
+
+    def date(self, timestamp):
+        """
+        Returns the local date of a unix timestamp as ISO 8601, reusing the
+        last day found since readings mostly come in date order.
+        """
+        start, end, day = self.day
+        if start <= timestamp < end:
+            return day
+        created = date.fromtimestamp(timestamp)
+        start = time.mktime(created.timetuple())
+        end = time.mktime((created + timedelta(days=1)).timetuple())
+        self.day = (start, end, created.isoformat())
+        return self.day[2]
+
+    def encode(self, row):
+        date_created, device_uuid, sensor_type, value = row
+        return {
+            'type': sensor_type,
+            'device_uuid': device_uuid,
+            'value': self.number(value),
+            'date_created': self.date(date_created),
+        }
+
+    def encode_many(self, rows):
+        return [self.encode(row) for row in rows]
+
+    def encode_mapping(self, row):
+        return self.encode([row[name] for name in self.FIELDS])
@@ -0,0 +1,22 @@
+from flask import Response, current_app, jsonify
+
+from app.api import api
+from app.instrumentation import get_instrumentation
+
+
+@api.route('/stats', methods=['GET'])
+def stats():
+    data = dict()
+    for name, extension in current_app.extensions.items():
+        if hasattr(extension, 'stats'):
+            data[name] = extension.stats()
+    return jsonify(data)
+
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    instrumentation = get_instrumentation()
+    if instrumentation is None:
+        return jsonify('Not found'), 404
+    return Response(instrumentation.render(),
+                    mimetype='text/plain; version=0.0.4')
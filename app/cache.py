@@ -0,0 +1,270 @@
+"""
+Cache of metrics responses keyed by device and query.
+
+Every entry belongs to a device, and writing readings for a device drops
+only that device's entries. Each device also has a generation, bumped on
+every invalidation, so a response computed while a write was landing is
+never stored over the fresh data.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+MISS = object()
+
+
+class LocalCache():
+    """
+    In-process LRU cache with a TTL, for single-worker deployments.
+
+    Only the devices with entries have a set of keys, and only the
+    `max_size` devices invalidated last keep their own generation. An
+    invalidation takes the next value of a global counter, and the epoch,
+    the generation of every other device, is raised to the generation of
+    any device dropped. Generations never go back, so a result computed
+    before an invalidation is still never stored, whatever the fleet size.
+    """
+
+    def __init__(self, max_size=10000, ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.device_keys = {}
+        self.generations = OrderedDict()
+        self.counter = 0
+        self.epoch = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self, device_uuid):
+        return self.generations.get(device_uuid, self.epoch)
+
+    def get(self, device_uuid, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return MISS
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, device_uuid, key, value, generation):
+        with self.lock:
+            if generation != self.generation(device_uuid):
+                return
+            self.entries[key] = (device_uuid, time.monotonic() + self.ttl,
+                                 value)
+            self.entries.move_to_end(key)
+            self.device_keys.setdefault(device_uuid, set()).add(key)
+            while len(self.entries) > self.max_size:
+                old_key, (old_device, _, _) = self.entries.popitem(last=False)
+                keys = self.device_keys[old_device]
+                keys.discard(old_key)
+                if not keys:
+                    del self.device_keys[old_device]
+                self.evictions += 1
+
+    def invalidate(self, device_uuids):
+        with self.lock:
+            for device_uuid in device_uuids:
+                self.counter += 1
+                self.generations[device_uuid] = self.counter
+                self.generations.move_to_end(device_uuid)
+                for key in self.device_keys.pop(device_uuid, ()):
+                    self.entries.pop(key, None)
+                    self.invalidations += 1
+            while len(self.generations) > self.max_size:
+                _, generation = self.generations.popitem(last=False)
+                self.epoch = max(self.epoch, generation)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.device_keys.clear()
+            self.generations.clear()
+            # A result computed before the reset is never stored
+            self.counter += 1
+            self.epoch = self.counter
+
+    def readings_written(self, rows):
+        self.invalidate({row[0] for row in rows})
+
+    def readings_reset(self):
+        self.clear()
+
+    def stats(self):
+        return dict(
+            backend='local',
+            size=len(self.entries),
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+        )
+
+
+class SqliteCache():
+    """
+    Cache shared by every worker of a host through a SQLite file, so a
+    write served by one worker invalidates the entries of all of them.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS metrics_cache(
+            key TEXT PRIMARY KEY,
+            device_uuid TEXT NOT NULL,
+            value TEXT NOT NULL,
+            expires REAL NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS metrics_cache_device
+            ON metrics_cache(device_uuid);
+        CREATE INDEX IF NOT EXISTS metrics_cache_accessed
+            ON metrics_cache(accessed);
+        CREATE TABLE IF NOT EXISTS metrics_cache_generations(
+            device_uuid TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL
+        );
+    '''
+
+    def __init__(self, path, max_size=10000, ttl=5):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.local = threading.local()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.failed_invalidations = 0
+
+    @property
+    def db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=1.0,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = OFF')
+            db.executescript(self.SCHEMA)
+            self.local.db = db
+        return db
+
+    def generation(self, device_uuid):
+        row = self.db.execute(
+            'SELECT generation FROM metrics_cache_generations'
+            ' WHERE device_uuid = ?', (device_uuid,)).fetchone()
+        return row[0] if row else 0
+
+    def get(self, device_uuid, key):
+        now = time.time()
+        row = self.db.execute(
+            'SELECT value FROM metrics_cache WHERE key = ? AND expires > ?',
+            (key, now)).fetchone()
+        if row is None:
+            self.misses += 1
+            return MISS
+        self.db.execute('UPDATE metrics_cache SET accessed = ? WHERE key = ?',
+                        (now, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, device_uuid, key, value, generation):
+        now = time.time()
+        db = self.db
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            if generation != self.generation(device_uuid):
+                db.execute('ROLLBACK')
+                return
+            db.execute('INSERT OR REPLACE INTO metrics_cache'
+                       ' VALUES (?, ?, ?, ?, ?)',
+                       (key, device_uuid, json.dumps(value), now + self.ttl,
+                        now))
+            cur = db.execute(
+                'DELETE FROM metrics_cache WHERE key IN ('
+                ' SELECT key FROM metrics_cache ORDER BY accessed'
+                ' LIMIT MAX(0, (SELECT COUNT(*) FROM metrics_cache) - ?))',
+                (self.max_size,))
+            self.evictions += cur.rowcount
+            db.execute('COMMIT')
+        except sqlite3.OperationalError:
+            # A busy cache only loses this entry
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+
+    def invalidate(self, device_uuids):
+        db = self.db
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            for device_uuid in device_uuids:
+                db.execute(
+                    'INSERT INTO metrics_cache_generations VALUES (?, 1)'
+                    ' ON CONFLICT (device_uuid) DO UPDATE'
+                    ' SET generation = generation + 1', (device_uuid,))
+                cur = db.execute(
+                    'DELETE FROM metrics_cache WHERE device_uuid = ?',
+                    (device_uuid,))
+                self.invalidations += cur.rowcount
+            db.execute('COMMIT')
+        except sqlite3.OperationalError:
+            # The readings are already committed, a busy cache must not
+            # fail the write. Its entries expire within the TTL anyway.
+            self.failed_invalidations += 1
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+
+    def clear(self):
+        self.db.execute('DELETE FROM metrics_cache')
+        self.db.execute('DELETE FROM metrics_cache_generations')
+
+    def readings_written(self, rows):
+        self.invalidate({row[0] for row in rows})
+
+    def readings_reset(self):
+        self.clear()
+
+    def stats(self):
+        size = self.db.execute('SELECT COUNT(*) FROM metrics_cache')
+        return dict(
+            backend='sqlite',
+            size=size.fetchone()[0],
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+            failed_invalidations=self.failed_invalidations,
+        )
+
+
+BACKENDS = {
+    'local': LocalCache,
+    'sqlite': SqliteCache,
+}
+
+
+def get_cache():
+    return current_app.extensions.get('metrics_cache')
+
+
+def init_app(app):
+    backend = app.config['METRICS_CACHE']
+    if not backend:
+        return
+    kwargs = dict(max_size=app.config['METRICS_CACHE_SIZE'],
+                  ttl=app.config['METRICS_CACHE_TTL'])
+    if backend == 'sqlite':
+        kwargs['path'] = app.config['METRICS_CACHE_PATH']
+    app.extensions['metrics_cache'] = BACKENDS[backend](**kwargs)
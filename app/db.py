@@ -1,26 +1,347 @@
+import calendar
+import os
+import queue
+import re
 import sqlite3
+import stat
+import threading
+import time
+import zlib
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
+from app import tracing
+from app.histograms import rebuild_histograms
+from app.instrumentation import phase
+from app.rollups import rebuild_rollups
+from app.summaries import diff_summaries, rebuild_summaries
+
+
+class ConnectionPool():
+    """
+    Per-process pool of pre-configured SQLite connections.
+
+    Connections are handed to one thread at a time, so they are opened with
+    check_same_thread=False and can be returned from any worker thread.
+    A pool inherited through fork() is discarded, never shared.
+    Given a QueryTracer, connections are TracedConnections timing every
+    statement.
+    """
+
+    def __init__(self, database, size=8, busy_timeout=5000,
+                 journal_mode='WAL', synchronous='NORMAL',
+                 mmap_size=268435456, cache_size=-20000, read_only=False,
+                 tracer=None):
+        self.database = database
+        self.read_only = read_only
+        self.tracer = tracer
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.created = 0
+        self.in_use = 0
+
+    def connect(self):
+        database = self.database
+        if self.read_only:
+            database = 'file:{}?mode=ro'.format(database)
+        conn = sqlite3.connect(
+            database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=self.busy_timeout / 1000.0,
+            check_same_thread=False,
+            uri=self.read_only,
+            factory=sqlite3.Connection if self.tracer is None
+            else tracing.TracedConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA busy_timeout = {:d}'.format(self.busy_timeout))
+        if self.read_only:
+            conn.execute('PRAGMA query_only = ON')
+        elif self.journal_mode:
+            conn.execute('PRAGMA journal_mode = {}'.format(self.journal_mode))
+        if self.synchronous and not self.read_only:
+            conn.execute('PRAGMA synchronous = {}'.format(self.synchronous))
+        conn.execute('PRAGMA mmap_size = {:d}'.format(self.mmap_size))
+        conn.execute('PRAGMA cache_size = {:d}'.format(self.cache_size))
+        if self.tracer is not None:
+            self.tracer.attach(conn)
+        with self.lock:
+            self.created += 1
+        return conn
+
+    def _check_pid(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                # Connections opened by the parent must not be used here
+                self.idle = queue.LifoQueue(maxsize=self.size)
+                self.created = 0
+                self.in_use = 0
+                self.pid = os.getpid()
+
+    def acquire(self):
+        self._check_pid()
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+        with self.lock:
+            self.in_use += 1
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            self.in_use -= 1
+        if conn.in_transaction:
+            conn.rollback()
+        conn.row_factory = sqlite3.Row
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def stats(self):
+        return dict(
+            size=self.size,
+            idle=self.idle.qsize(),
+            in_use=self.in_use,
+            created=self.created,
+        )
+
+
+class FrozenPartition(ValueError):
+    pass
+
+
+class PartitionRouter():
+    """
+    Spreads the readings across SQLite files by month of date_created
+    and/or by a hash of device_uuid, with one ConnectionPool each.
+
+    Partitions are named after the main database, test_database.202610.s0.db
+    holding October 2026 (UTC) for the devices of shard 0. Each one has the
+    full schema, so its rollups, histograms and versions cover its own
+    readings. A partition whose file is not writable is frozen: it is opened
+    read-only and writes to it are rejected.
+    """
+
+    NAME = re.compile(r'\.(?:(\d{6})\.)?s(\d+)\.db$')
+
+    def __init__(self, database, root_path, by_month=True, shards=1,
+                 **pool_options):
+        self.base = os.path.splitext(database)[0]
+        self.root_path = root_path
+        self.by_month = by_month
+        self.shards = shards
+        self.pool_options = pool_options
+        self.lock = threading.Lock()
+        self.pools = {}
+
+    def shard(self, device_uuid):
+        return zlib.crc32(device_uuid.encode('utf8')) % self.shards
+
+    def key(self, device_uuid, date_created):
+        month = ''
+        if self.by_month:
+            month = time.strftime('%Y%m', time.gmtime(date_created))
+        return month, self.shard(device_uuid)
+
+    def path(self, key):
+        month, shard = key
+        return '{}.{}s{:d}.db'.format(self.base,
+                                      month + '.' if month else '', shard)
+
+    def keys(self):
+        """
+        Lists the (month, shard) of every partition on disk.
+        """
+        directory, prefix = os.path.split(self.base)
+        keys = []
+        for filename in os.listdir(directory or '.'):
+            if not filename.startswith(prefix + '.'):
+                continue
+            match = self.NAME.match(filename[len(prefix):])
+            if match:
+                keys.append((match.group(1) or '', int(match.group(2))))
+        return sorted(keys)
+
+    def route(self, device_uuid, lo, hi):
+        """
+        Returns the partitions that can hold readings of the device, or of
+        every device when device_uuid is None, in [lo, hi), in time order.
+        """
+        shard = None if device_uuid is None else self.shard(device_uuid)
+        keys = []
+        for month, key_shard in self.keys():
+            if shard is not None and key_shard != shard:
+                continue
+            if month:
+                year, number = int(month[:4]), int(month[4:])
+                start = calendar.timegm((year, number, 1, 0, 0, 0))
+                if number == 12:
+                    year, number = year + 1, 0
+                end = calendar.timegm((year, number + 1, 1, 0, 0, 0))
+                if ((hi is not None and start >= hi)
+                        or (lo is not None and end <= lo)):
+                    continue
+            keys.append((month, key_shard))
+        return keys
+
+    def is_frozen(self, key):
+        path = self.path(key)
+        return (os.path.exists(path)
+                and not os.stat(path).st_mode & stat.S_IWUSR)
+
+    def pool(self, key):
+        pool = self.pools.get(key)
+        if pool is not None:
+            return pool
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                frozen = self.is_frozen(key)
+                pool = ConnectionPool(self.path(key), read_only=frozen,
+                                      **self.pool_options)
+                if not frozen:
+                    conn = pool.acquire()
+                    try:
+                        apply_migrations(conn, self.root_path)
+                    finally:
+                        pool.release(conn)
+                self.pools[key] = pool
+            return pool
+
+    def split(self, rows):
+        """
+        Groups model rows by partition. Returns (pool, rows) pairs, or
+        raises FrozenPartition before anything is written.
+        """
+        groups = {}
+        for row in rows:
+            groups.setdefault(self.key(row[0], row[3]), []).append(row)
+        for key in groups:
+            if self.is_frozen(key):
+                raise FrozenPartition(
+                    'Partition {} is read-only'.format(self.path(key)))
+        return [(self.pool(key), group) for key, group in groups.items()]
+
+    def freeze(self, key):
+        """
+        Checkpoints a partition into a single read-only file.
+        """
+        with self.lock:
+            pool = self.pools.pop(key, None)
+            if pool is not None:
+                pool.close()
+            conn = sqlite3.connect(self.path(key))
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            conn.execute('PRAGMA journal_mode = DELETE')
+            conn.close()
+            os.chmod(self.path(key), 0o444)
+
+    def drop(self):
+        """
+        Deletes every partition.
+        """
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+            self.pools = {}
+            for key in self.keys():
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(self.path(key) + suffix):
+                        os.remove(self.path(key) + suffix)
+
+    def stats(self):
+        keys = self.keys()
+        return dict(
+            partitions=len(keys),
+            frozen=sum(1 for key in keys if self.is_frozen(key)),
+            open=len(self.pools),
+        )
+
+
+_pool_lock = threading.Lock()
+
+
+def get_pool(app=None):
+    app = app or current_app
+    pool = app.extensions.get('db_pool')
+    if pool is not None and pool.database == app.config['DATABASE']:
+        return pool
+
+    with _pool_lock:
+        pool = app.extensions.get('db_pool')
+        if pool is not None and pool.database == app.config['DATABASE']:
+            return pool
+        pool = ConnectionPool(
+            app.config['DATABASE'],
+            size=app.config['DB_POOL_SIZE'],
+            busy_timeout=app.config['DB_BUSY_TIMEOUT'],
+            journal_mode=app.config['DB_JOURNAL_MODE'],
+            synchronous=app.config['DB_SYNCHRONOUS'],
+            mmap_size=app.config['DB_MMAP_SIZE'],
+            cache_size=app.config['DB_CACHE_SIZE'],
+            tracer=app.extensions.get('query_tracer'),
+        )
+        app.extensions['db_pool'] = pool
+        return pool
+
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db_pool = get_pool()
+        with phase('db_connect'):
+            g.db = g.db_pool.acquire()
 
     return g.db
 
 
+def get_router(app=None):
+    app = app or current_app
+    return app.extensions.get('db_router')
+
+
+def get_partition_db(key):
+    """
+    Returns this request's connection to a partition.
+    """
+    if 'partitions' not in g:
+        g.partitions = {}
+    if key not in g.partitions:
+        pool = get_router().pool(key)
+        with phase('db_connect'):
+            g.partitions[key] = (pool, pool.acquire())
+    return g.partitions[key][1]
+
+
 def close_db(e=None):
     db = g.pop('db', None)
+    pool = g.pop('db_pool', None)
 
     if db is not None:
-        db.close()
+        pool.release(db)
+
+    for pool, conn in g.pop('partitions', {}).values():
+        pool.release(conn)
 
 
 def init_db():
@@ -29,6 +350,61 @@ def init_db():
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
 
+    router = get_router()
+    if router is not None:
+        router.drop()
+
+    for extension in list(current_app.extensions.values()):
+        if hasattr(extension, 'readings_reset'):
+            extension.readings_reset()
+
+
+def list_migrations(root_path=None):
+    """
+    Returns (version, filename) for every script in migrations/, where the
+    version is the number the filename starts with.
+    """
+    path = os.path.join(root_path or current_app.root_path, 'migrations')
+    migrations = []
+    for filename in os.listdir(path):
+        if filename.endswith('.sql'):
+            migrations.append((int(filename.split('_', 1)[0]), filename))
+    return sorted(migrations)
+
+
+def apply_migrations(db, root_path):
+    """
+    Applies the migrations newer than the database's user_version, each
+    one in its own transaction, and returns the versions applied. A new
+    empty database gets schema.sql instead.
+    """
+    current = db.execute('PRAGMA user_version').fetchone()[0]
+    if not current and not db.execute(
+            'SELECT COUNT(*) FROM sqlite_master').fetchone()[0]:
+        with open(os.path.join(root_path, 'schema.sql'), encoding='utf8') as f:
+            db.executescript(f.read())
+        return []
+
+    applied = []
+    for version, filename in list_migrations(root_path):
+        if version <= current:
+            continue
+        path = os.path.join(root_path, 'migrations', filename)
+        with open(path, encoding='utf8') as f:
+            script = f.read()
+        db.executescript('BEGIN;\n{}\nPRAGMA user_version = {:d};\nCOMMIT;'
+                         .format(script, version))
+        applied.append(version)
+
+    return applied
+
+
+def migrate_db():
+    """
+    Migrates the main database. Partitions are migrated when opened.
+    """
+    return apply_migrations(get_db(), current_app.root_path)
+
 
 @click.command('init-db')
 @with_appcontext
@@ -37,6 +413,137 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+def rebuild_derived(db):
+    """
+    Rebuilds every table derived from the readings of one database.
+    """
+    rebuild_rollups(db)
+    rebuild_histograms(db)
+    rebuild_summaries(db)
+    with db:
+        db.execute('DELETE FROM reading_sketches')
+
+
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+    """
+    Recomputes the rollups, histograms and device summaries from the raw
+    readings and drops the stored sketches, rebuilt on demand. With
+    partitions, every one of them but the frozen ones is rebuilt.
+    """
+    router = get_router()
+    if router is None:
+        rebuild_derived(get_db())
+        click.echo('Rebuilt the readings rollups, histograms and device'
+                   ' summaries, and dropped the sketches.')
+        return
+
+    rebuilt = skipped = 0
+    for key in router.keys():
+        if router.is_frozen(key):
+            skipped += 1
+            continue
+        rebuild_derived(get_partition_db(key))
+        rebuilt += 1
+    click.echo('Rebuilt the readings rollups, histograms and device'
+               ' summaries, and dropped the sketches, of {} partitions'
+               ' ({} frozen skipped).'.format(rebuilt, skipped))
+
+
+@click.command('check-summaries')
+@click.option('--repair', is_flag=True,
+              help='Rebuild the summaries found inconsistent.')
+@click.option('--show', type=int, default=10,
+              help='Differences printed per database.')
+@with_appcontext
+def check_summaries_command(repair, show):
+    """
+    Recomputes the device summaries from the raw readings and reports the
+    rows that differ. Exits with 1 on differences left unrepaired.
+    """
+    router = get_router()
+    if router is None:
+        databases = [('main', get_db(), False)]
+    else:
+        databases = [(os.path.basename(router.path(key)),
+                      get_partition_db(key),
+                      router.is_frozen(key)) for key in router.keys()]
+
+    unrepaired = 0
+    for name, db, frozen in databases:
+        differences = 0
+        for table, key, stored, expected in diff_summaries(db):
+            differences += 1
+            if differences <= show:
+                click.echo('{} {} {}: stored {}, expected {}'.format(
+                    name, table, list(key), stored, expected))
+        if not differences:
+            continue
+        if repair and not frozen:
+            rebuild_summaries(db)
+            click.echo('{}: rebuilt, {} rows differed.'.format(
+                name, differences))
+        else:
+            unrepaired += differences
+            click.echo('{}: {} rows differ{}.'.format(
+                name, differences, ' (frozen)' if repair else ''))
+
+    if unrepaired:
+        raise click.exceptions.Exit(1)
+    click.echo('The device summaries match the readings.')
+
+
+@click.command('freeze-partitions')
+@click.argument('before')
+@with_appcontext
+def freeze_partitions_command(before):
+    """
+    Makes the partitions of the months before BEFORE (YYYY-MM) read-only.
+    """
+    router = get_router()
+    if router is None or not router.by_month:
+        raise click.UsageError('Readings are not partitioned by month.')
+    month = before.replace('-', '')
+    frozen = 0
+    for key in router.keys():
+        if key[0] < month and not router.is_frozen(key):
+            router.freeze(key)
+            frozen += 1
+    click.echo('Froze {} partitions.'.format(frozen))
+
+
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    applied = migrate_db()
+    if applied:
+        click.echo('Applied migrations {}.'.format(
+            ', '.join(str(v) for v in applied)))
+    else:
+        click.echo('The database is up to date.')
+
+
 def init_app(app):
+    tracer = tracing.init_app(app)
+    if app.config['DB_PARTITION_BY_MONTH'] or app.config['DB_SHARDS'] > 1:
+        app.extensions['db_router'] = PartitionRouter(
+            app.config['DATABASE'],
+            app.root_path,
+            by_month=app.config['DB_PARTITION_BY_MONTH'],
+            shards=app.config['DB_SHARDS'],
+            size=app.config['DB_POOL_SIZE'],
+            busy_timeout=app.config['DB_BUSY_TIMEOUT'],
+            journal_mode=app.config['DB_JOURNAL_MODE'],
+            synchronous=app.config['DB_SYNCHRONOUS'],
+            mmap_size=app.config['DB_MMAP_SIZE'],
+            cache_size=app.config['DB_CACHE_SIZE'],
+            tracer=tracer,
+        )
     app.teardown_appcontext(close_db)
-    app.cli.add_command(init_db_command)
\ No newline at end of file
+    app.cli.add_command(check_summaries_command)
+    app.cli.add_command(freeze_partitions_command)
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(tracing.query_stats_command)
+    app.cli.add_command(rebuild_rollups_command)
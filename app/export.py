@@ -0,0 +1,175 @@
+"""
+Bulk export of readings as CSV or NDJSON.
+
+Readings are read in the order of the readings_device_date index,
+(device_uuid, date_created, rowid), through a cursor fetching a chunk at
+a time, so memory stays flat whatever the size of the export.
+Partitions are read one after the other.
+
+A continuation token holds the partition and index key of the last row
+exported. An export given a token resumes right after that row. A page
+is streamed up to its boundary token rather than for a number of rows,
+so a reading committed meanwhile before the boundary lengthens the page
+instead of pushing a row past both pages.
+"""
+import csv
+import io
+import json
+import zlib
+
+FIELDS = ('device_uuid', 'type', 'date_created', 'value')
+
+KEY = ('device_uuid', 'date_created', 'rowid')
+
+SELECT_FIELDS = ', '.join(FIELDS + ('rowid',))
+
+FORMATS = ('csv', 'ndjson')
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class Export():
+    """
+    Readings of every device in [lo, hi), optionally of one type, from
+    `partitions`: a list of (partition_key, db) pairs in time order.
+    """
+
+    def __init__(self, partitions, sensor_type=None, lo=None, hi=None,
+                 after=None, chunk_size=1000):
+        self.partitions = partitions
+        self.sensor_type = sensor_type
+        self.lo = lo
+        self.hi = hi
+        self.after = after
+        self.chunk_size = chunk_size
+
+    def _query(self, fields, key=None, ordered=True, until=None):
+        conditions = []
+        params = []
+        if self.sensor_type is not None:
+            conditions.append('type = ?')
+            params.append(self.sensor_type)
+        if self.lo is not None:
+            conditions.append('date_created >= ?')
+            params.append(self.lo)
+        if self.hi is not None:
+            conditions.append('date_created < ?')
+            params.append(self.hi)
+        if key is not None:
+            conditions.append('({}) > ({})'.format(
+                ', '.join(KEY), ', '.join('?' * len(KEY))))
+            params.extend(key)
+        if until is not None:
+            conditions.append('({}) <= ({})'.format(
+                ', '.join(KEY), ', '.join('?' * len(KEY))))
+            params.extend(until)
+        query = 'SELECT {} FROM readings WHERE {}'.format(
+            fields, ' AND '.join(conditions) or '1')
+        if ordered:
+            query += ' ORDER BY ' + ', '.join(KEY)
+        return query, params
+
+    def _remaining(self):
+        """
+        Yields (partition_key, db, key) for the partitions left to read,
+        key being where to resume in that partition.
+        """
+        resume = None
+        if self.after is not None:
+            resume = tuple(self.after[:2])
+        for partition_key, db in self.partitions:
+            partition_key = tuple(partition_key)
+            if resume is None or partition_key > resume:
+                yield partition_key, db, None
+            elif partition_key == resume:
+                yield partition_key, db, list(self.after[2:])
+
+    def _token(self, partition_key, row):
+        device_uuid, _, date_created, _, rowid = row
+        return list(partition_key) + [device_uuid, date_created, rowid]
+
+    def chunks(self, until=None):
+        """
+        Yields (rows, token) per chunk of at most chunk_size rows, token
+        resuming after the last row of the chunk. Stops after the row of
+        the token `until`, when given.
+        """
+        for partition_key, db, key in self._remaining():
+            end = None
+            if until is not None:
+                if partition_key > tuple(until[:2]):
+                    break
+                if partition_key == tuple(until[:2]):
+                    end = list(until[2:])
+            cur = db.cursor()
+            cur.row_factory = None
+            cur.execute(*self._query(SELECT_FIELDS, key, until=end))
+            while True:
+                rows = cur.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                yield ([row[:len(FIELDS)] for row in rows],
+                       self._token(partition_key, rows[-1]))
+            cur.close()
+
+    def boundary(self, limit):
+        """
+        Returns the token after the first `limit` rows when more rows
+        follow, None otherwise. Only the index is read.
+        """
+        remaining = limit
+        found = None
+        for partition_key, db, key in self._remaining():
+            query, params = self._query(SELECT_FIELDS, key)
+            if found is not None:
+                if db.execute(query + ' LIMIT 1', params).fetchone():
+                    return found
+                continue
+            rows = db.execute(query + ' LIMIT 2 OFFSET ?',
+                              params + [remaining - 1]).fetchall()
+            if len(rows) == 2:
+                return self._token(partition_key, rows[0])
+            if len(rows) == 1:
+                found = self._token(partition_key, rows[0])
+                continue
+            count = db.execute(*self._query('COUNT(*)', key, ordered=False))
+            remaining -= count.fetchone()[0]
+        return None
+
+
+def csv_header():
+    return ','.join(FIELDS) + '\r\n'
+
+
+def format_rows(rows, fmt):
+    """
+    Formats rows of FIELDS, date_created as a unix timestamp.
+    """
+    if fmt == 'ndjson':
+        return ''.join(json.dumps(dict(zip(FIELDS, row))) + '\n'
+                       for row in rows)
+    out = io.StringIO()
+    csv.writer(out).writerows(rows)
+    return out.getvalue()
+
+
+def encode(texts, compress=False):
+    """
+    Encodes a stream of text as UTF-8 bytes, gzipped on the fly when
+    `compress` is set. Every chunk is flushed so it reaches the client.
+    """
+    if not compress:
+        for text in texts:
+            yield text.encode('utf8')
+        return
+
+    compressor = zlib.compressobj(wbits=31)
+    for text in texts:
+        data = compressor.compress(text.encode('utf8'))
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
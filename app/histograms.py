@@ -0,0 +1,130 @@
+"""
+Value histograms of the readings table.
+
+reading_histograms keeps, per (device_uuid, type) and hour or day bucket,
+how many readings had each value. Readings are validated to 0-100, so a
+bucket holds at most 101 rows for integer readings. It is maintained by
+the readings_histograms trigger.
+
+Order statistics over a date range are computed exactly from the merged
+counts of its whole buckets plus the raw readings at its partial edges.
+Without a date range they are read from device_summary_values, the whole
+history histogram of each device.
+"""
+import heapq
+import itertools
+import json
+from operator import itemgetter
+
+from app.rollups import DAY, HOUR, split_range
+
+RESOLUTIONS = (DAY, HOUR)
+
+# The piece covering the whole history
+WHOLE = ('whole', None, None)
+
+REBUILD_SENTENCE = '''
+    INSERT INTO reading_histograms (
+        resolution, device_uuid, type, bucket, value, count
+    )
+    SELECT ?, device_uuid, type, date_created / ?, value, COUNT(*)
+    FROM readings
+    GROUP BY device_uuid, type, date_created / ?, value
+'''
+
+
+def _piece_conditions(piece, device_uuid, sensor_type):
+    """
+    Returns the table, count expression and conditions reading one piece
+    of a split range: histogram buckets or raw readings at the edges.
+    """
+    resolution, start, end = piece
+    if piece == WHOLE:
+        table, count, column = 'device_summary_values', 'count', None
+        conditions, params = [], []
+    elif resolution is None:
+        table, count, column = 'readings', '1', 'date_created'
+        conditions, params = [], []
+    else:
+        table, count, column = 'reading_histograms', 'count', 'bucket'
+        conditions, params = ['resolution = ?'], [resolution]
+
+    if device_uuid is not None:
+        conditions.append('device_uuid = ?')
+        params.append(device_uuid)
+    if sensor_type is not None:
+        conditions.append('type = ?')
+        params.append(sensor_type)
+    if start is not None:
+        conditions.append('{} >= ?'.format(column))
+        params.append(start)
+    if end is not None:
+        conditions.append('{} < ?'.format(column))
+        params.append(end)
+
+    return table, count, ' AND '.join(conditions) or '1', params
+
+
+def _pieces(lo, hi):
+    if lo is None and hi is None:
+        return [WHOLE]
+    return split_range(lo, hi, RESOLUTIONS)
+
+
+def value_counts(db, device_uuid, sensor_type, lo, hi):
+    """
+    Returns the (values, counts) histogram of the device readings in
+    [lo, hi), values sorted ascending.
+    """
+    merged = {}
+    for piece in _pieces(lo, hi):
+        table, count, where, params = _piece_conditions(piece, device_uuid,
+                                                        sensor_type)
+        query = ('SELECT value, SUM({}) FROM {} WHERE {}'
+                 ' GROUP BY value').format(count, table, where)
+        for value, n in db.execute(query, params):
+            merged[value] = merged.get(value, 0) + n
+
+    values = sorted(merged)
+    return values, [merged[v] for v in values]
+
+
+def device_value_counts(dbs, sensor_type, lo, hi, devices=None):
+    """
+    Yields (device_uuid, values, counts) for every device with readings
+    in [lo, hi) in any of the databases `dbs`, in device order. Each piece
+    of the range is streamed in device order and merged, so one device is
+    held in memory at a time.
+
+    Given a list of `devices`, only those are read, with index seeks.
+    """
+    streams = []
+    for db, piece in itertools.product(dbs, _pieces(lo, hi)):
+        table, count, where, params = _piece_conditions(piece, None,
+                                                        sensor_type)
+        if devices is not None:
+            where += ' AND device_uuid IN (SELECT value FROM json_each(?))'
+            params.append(json.dumps(devices))
+        query = ('SELECT device_uuid, value, {} FROM {} WHERE {}'
+                 ' ORDER BY device_uuid').format(count, table, where)
+        cur = db.cursor()
+        cur.row_factory = None
+        streams.append(cur.execute(query, params))
+
+    rows = heapq.merge(*streams, key=itemgetter(0))
+    for device_uuid, group in itertools.groupby(rows, key=itemgetter(0)):
+        merged = {}
+        for _, value, n in group:
+            merged[value] = merged.get(value, 0) + n
+        values = sorted(merged)
+        yield device_uuid, values, [merged[v] for v in values]
+
+
+def rebuild_histograms(db):
+    """
+    Recomputes every histogram from the raw readings.
+    """
+    with db:
+        db.execute('DELETE FROM reading_histograms')
+        for resolution in RESOLUTIONS:
+            db.execute(REBUILD_SENTENCE, (resolution, resolution, resolution))
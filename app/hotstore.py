@@ -0,0 +1,299 @@
+"""
+In-memory columnar store of the recent readings.
+
+The hot store keeps, per (device_uuid, type), the date_created and value
+of every reading newer than HOT_STORE_RETENTION seconds in two NumPy
+arrays sorted by (date_created, value), the order of the
+readings_device_type_date index. A reading takes 16 bytes, 8 for its
+timestamp and 8 for its value, plus up to 25% of growth headroom: about
+20 MB per million readings.
+
+Before answering, the store catches up with the readings committed since
+its last look, by rowid, so it sees every write path and every worker.
+Queries whose date range lies entirely in the retention window are
+answered by binary search over the arrays; any other query falls back to
+SQLite.
+"""
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+
+from app.rollups import Aggregate
+
+GROWTH = 1.25
+
+# Expired readings are dropped at most once per this many seconds
+EVICT_EVERY = 60
+
+
+def _number(value):
+    """
+    Types a stored value as SQLite returns it from an INTEGER column.
+    """
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+class Series():
+    """
+    Timestamps and values of one (device_uuid, type), sorted by
+    (date_created, value) and grown in place with some headroom.
+    """
+
+    __slots__ = ('dates', 'values', 'n')
+
+    def __init__(self):
+        self.dates = np.empty(0, dtype=np.int64)
+        self.values = np.empty(0, dtype=np.float64)
+        self.n = 0
+
+    def extend(self, dates, values):
+        order = np.lexsort((values, dates))
+        dates = dates[order]
+        values = values[order]
+        n = self.n
+
+        if n and (dates[0], values[0]) < (self.dates[n - 1],
+                                           self.values[n - 1]):
+            # Late readings, merge them in
+            dates = np.concatenate((self.dates[:n], dates))
+            values = np.concatenate((self.values[:n], values))
+            order = np.lexsort((values, dates))
+            dates = dates[order]
+            values = values[order]
+            n = 0
+            self.n = 0
+
+        end = n + len(dates)
+        if end > len(self.dates):
+            capacity = max(end, int(len(self.dates) * GROWTH))
+            self.dates = np.resize(self.dates, capacity)
+            self.values = np.resize(self.values, capacity)
+        self.dates[n:end] = dates
+        self.values[n:end] = values
+        self.n = end
+
+    def window(self, lo, hi):
+        """
+        Returns the (start, end) slice of the readings in [lo, hi).
+        """
+        dates = self.dates[:self.n]
+        start = 0 if lo is None else int(np.searchsorted(dates, lo))
+        end = self.n if hi is None else int(np.searchsorted(dates, hi))
+        return start, end
+
+    def evict(self, since):
+        start, _ = self.window(since, None)
+        self.dates = self.dates[start:self.n].copy()
+        self.values = self.values[start:self.n].copy()
+        self.n = len(self.dates)
+
+    def nbytes(self):
+        return self.dates.nbytes + self.values.nbytes
+
+
+class HotStore():
+    """
+    Readings newer than `retention` seconds, by device and type.
+    """
+
+    def __init__(self, retention=7 * 86400):
+        self.retention = retention
+        self.lock = threading.RLock()
+        self.readings_reset()
+
+        self.hits = 0
+        self.misses = 0
+
+    def readings_reset(self):
+        with self.lock:
+            self.devices = {}
+            self.since = None
+            self.watermark = 0
+            self.evicted_at = 0
+
+    def add(self, rows):
+        """
+        Adds (device_uuid, type, date_created, value) rows.
+        """
+        groups = {}
+        for device_uuid, sensor_type, date_created, value in rows:
+            group = groups.setdefault((device_uuid, sensor_type), ([], []))
+            group[0].append(date_created)
+            group[1].append(value)
+
+        with self.lock:
+            for (device_uuid, sensor_type), (dates, values) in groups.items():
+                series = self.devices.setdefault(device_uuid, {}).setdefault(
+                    sensor_type, Series())
+                series.extend(np.array(dates, dtype=np.int64),
+                              np.array(values, dtype=np.float64))
+
+    def refresh(self, db):
+        """
+        Loads the readings committed since the last refresh.
+        """
+        with self.lock:
+            now = int(time.time())
+            last = db.execute('SELECT MAX(rowid) FROM readings').fetchone()[0]
+            last = last or 0
+            if last < self.watermark:
+                # The readings table was recreated
+                self.readings_reset()
+
+            if self.since is None:
+                self.since = now - self.retention
+                self.evicted_at = now
+            elif now - self.evicted_at >= EVICT_EVERY:
+                self.since = now - self.retention
+                self.evicted_at = now
+                for types in self.devices.values():
+                    for series in types.values():
+                        series.evict(self.since)
+
+            if last > self.watermark:
+                cur = db.execute(
+                    'SELECT device_uuid, type, date_created, value'
+                    ' FROM readings WHERE rowid > ? AND rowid <= ?'
+                    ' AND date_created >= ?',
+                    (self.watermark, last, self.since))
+                cur.row_factory = None
+                self.add(cur.fetchall())
+                self.watermark = last
+
+    def covers(self, lo):
+        """
+        Tells whether every reading from lo on is held in the store.
+        """
+        covered = (self.since is not None and lo is not None
+                   and lo >= self.since)
+        if covered:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return covered
+
+    def _windows(self, device_uuid, sensor_type, lo, hi):
+        """
+        Yields (type, dates, values) of the readings in [lo, hi), types
+        in index order.
+        """
+        types = self.devices.get(device_uuid, {})
+        names = sorted(types) if sensor_type is None else [sensor_type]
+        for name in names:
+            series = types.get(name)
+            if series is None:
+                continue
+            start, end = series.window(lo, hi)
+            if start < end:
+                yield (name, series.dates[start:end],
+                       series.values[start:end])
+
+    def _values(self, device_uuid, sensor_type, lo, hi):
+        windows = self._windows(device_uuid, sensor_type, lo, hi)
+        return np.concatenate([np.empty(0)] + [v for _, _, v in windows])
+
+    def rows(self, device_uuid, sensor_type, lo, hi):
+        """
+        Returns the readings in [lo, hi) as dicts, in index order.
+        """
+        with self.lock:
+            rows = []
+            for name, dates, values in self._windows(device_uuid,
+                                                     sensor_type, lo, hi):
+                for date_created, value in zip(dates.tolist(),
+                                               values.tolist()):
+                    rows.append(dict(date_created=date_created,
+                                     device_uuid=device_uuid, type=name,
+                                     value=_number(value)))
+            return rows
+
+    def aggregate(self, device_uuid, sensor_type, lo, hi):
+        with self.lock:
+            values = self._values(device_uuid, sensor_type, lo, hi)
+        if not len(values):
+            return Aggregate(0, 0, None, None)
+        total = values.sum()
+        total = int(total) if np.all(values % 1 == 0) else float(total)
+        return Aggregate(len(values), total, _number(values.min()),
+                         _number(values.max()))
+
+    def value_counts(self, device_uuid, sensor_type, lo, hi):
+        with self.lock:
+            values = self._values(device_uuid, sensor_type, lo, hi)
+        values, counts = np.unique(values, return_counts=True)
+        return [_number(v) for v in values], counts.tolist()
+
+    def find_reading(self, device_uuid, sensor_type, lo, hi, ties):
+        """
+        Returns the earliest reading in [lo, hi) whose value is one of
+        `ties`.
+        """
+        first = None
+        with self.lock:
+            for name, dates, values in self._windows(device_uuid,
+                                                     sensor_type, lo, hi):
+                found = np.flatnonzero(np.isin(values, ties))
+                if not len(found):
+                    continue
+                index = found[0]
+                if first is None or dates[index] < first['date_created']:
+                    first = dict(date_created=int(dates[index]),
+                                 device_uuid=device_uuid, type=name,
+                                 value=_number(values[index]))
+        return first
+
+    def first_seen(self, device_uuid, sensor_type, lo, hi):
+        """
+        Returns a function telling which of some values is met first by
+        date_created. It returns None when several of them share the
+        earliest second, as only SQLite knows their insertion order.
+        """
+        def first_seen(ties):
+            first = None
+            seen = set()
+            with self.lock:
+                for _, dates, values in self._windows(device_uuid,
+                                                      sensor_type, lo, hi):
+                    found = np.flatnonzero(np.isin(values, ties))
+                    if not len(found) or (first is not None
+                                          and dates[found[0]] > first):
+                        continue
+                    if first is None or dates[found[0]] < first:
+                        first = dates[found[0]]
+                        seen = set()
+                    same = found[dates[found] == first]
+                    seen.update(values[same].tolist())
+            if len(seen) == 1:
+                return _number(seen.pop())
+            return None
+        return first_seen
+
+    def memory_bytes(self):
+        with self.lock:
+            return sum(series.nbytes() for types in self.devices.values()
+                       for series in types.values())
+
+    def stats(self):
+        with self.lock:
+            readings = sum(series.n for types in self.devices.values()
+                           for series in types.values())
+        return dict(
+            readings=readings,
+            memory_bytes=self.memory_bytes(),
+            since=self.since,
+            hits=self.hits,
+            misses=self.misses,
+        )
+
+
+def get_hot_store():
+    return current_app.extensions.get('hot_store')
+
+
+def init_app(app):
+    if not app.config['HOT_STORE']:
+        return
+    app.extensions['hot_store'] = HotStore(app.config['HOT_STORE_RETENTION'])
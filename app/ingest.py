@@ -0,0 +1,333 @@
+import atexit
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+from marshmallow import ValidationError
+
+from app.api.serializers import ReadingSerializer
+from app.db import FrozenPartition, get_pool, get_router
+
+logger = logging.getLogger('app.ingest')
+
+POST_FIELDS = ['device_uuid', 'type', 'value']
+
+INSERT_SENTENCE = '''
+    INSERT INTO readings (
+        device_uuid,
+        type,
+        value,
+        date_created
+    )
+    VALUES (?,?,?,?)
+'''
+
+
+class BatchError(ValueError):
+    pass
+
+
+def parse_batch(body, content_type=None):
+    """
+    Parses a batch body, either a JSON array of readings or NDJSON (one
+    JSON object per line). Returns a list of (item, error) pairs so a
+    malformed line only rejects itself.
+    """
+    try:
+        text = body.decode('utf8') if isinstance(body, bytes) else body
+    except UnicodeDecodeError as e:
+        raise BatchError('Body must be UTF-8: {}'.format(e))
+    stripped = text.strip()
+    if not stripped:
+        raise BatchError("Body can't be empty")
+
+    if stripped.startswith('[') and 'ndjson' not in (content_type or ''):
+        try:
+            items = json.loads(stripped)
+        except ValueError as e:
+            raise BatchError('Invalid JSON array: {}'.format(e))
+        return [(item, None) for item in items]
+
+    parsed = []
+    for line in stripped.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            parsed.append((json.loads(line), None))
+        except ValueError as e:
+            parsed.append((None, 'Invalid JSON: {}'.format(e)))
+    return parsed
+
+
+def validate_readings(items, device_uuid=None, date_created=None):
+    """
+    Validates every item with ReadingSerializer. When device_uuid is given
+    it overrides the one in the item, as the single POST does.
+    Returns the rows ready to insert and a list of per-item errors.
+    """
+    if date_created is None:
+        date_created = int(time.time())
+    serializer = ReadingSerializer()
+    rows = []
+    errors = []
+
+    for index, (item, error) in enumerate(items):
+        if error is None and not isinstance(item, dict):
+            error = 'Reading must be a JSON object'
+        if error is not None:
+            errors.append(dict(index=index, errors=error))
+            continue
+
+        data = dict(item)
+        if device_uuid is not None:
+            data['device_uuid'] = device_uuid
+        try:
+            valid_data = serializer.load(data)
+        except ValidationError as e:
+            errors.append(dict(index=index, errors=e.messages))
+            continue
+
+        row = [valid_data[e] for e in POST_FIELDS]
+        row.append(date_created)
+        rows.append(row)
+
+    return rows, errors
+
+
+def notify_written(app, rows):
+    """
+    Tells every extension keeping derived state, through its
+    readings_written method, that rows were committed.
+    """
+    for extension in list(app.extensions.values()):
+        if hasattr(extension, 'readings_written'):
+            extension.readings_written(rows)
+
+
+def write_readings(db, rows, router=None):
+    """
+    Inserts all rows with a single executemany inside one transaction.
+    With a PartitionRouter the rows go to their partitions instead, one
+    transaction per partition.
+    """
+    if not rows:
+        return 0
+    if router is not None:
+        for pool, group in router.split(rows):
+            conn = pool.acquire()
+            try:
+                with conn:
+                    conn.executemany(INSERT_SENTENCE, group)
+            finally:
+                pool.release(conn)
+        return len(rows)
+    with db:
+        db.executemany(INSERT_SENTENCE, rows)
+    return len(rows)
+
+
+class WriteBehindBuffer():
+    """
+    Bounded in-process queue of readings flushed by a background thread
+    in groups of `flush_size` readings or every `flush_interval` ms,
+    whichever comes first, each group in a single transaction.
+    `on_written` is called with the rows of every committed group, once
+    their futures are resolved; its errors are logged, never raised.
+
+    A group finding the database busy is retried up to `retries` times.
+    A group failing otherwise is written again row by row, so only the
+    failing rows are rejected.
+    """
+
+    def __init__(self, pool, max_size=100000, flush_size=500,
+                 flush_interval=50, on_written=None, router=None,
+                 retries=3):
+        self.pool = pool
+        self.router = router
+        self.on_written = on_written
+        self.retries = retries
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval / 1000.0
+        self.queue = queue.Queue(maxsize=max_size)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+
+        self.flushes = 0
+        self.flushed = 0
+        self.failed = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    def start(self):
+        with self.lock:
+            self._start()
+
+    def _start(self):
+        # Called with the lock held
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run,
+                                       name='write-behind', daemon=True)
+        self.thread.start()
+
+    def submit(self, row):
+        """
+        Queues a row and returns a future resolved once it is committed.
+        Raises queue.Full when the buffer is at capacity or stopped.
+
+        The check, the start and the put hold the lock stop() takes, so
+        no row is queued after the final drain has begun.
+        """
+        future = Future()
+        with self.lock:
+            if self.stopping.is_set():
+                raise queue.Full
+            self._start()
+            self.queue.put_nowait((row, future))
+        return future
+
+    def stop(self, timeout=None):
+        """
+        Stops accepting readings for good and waits for the queue to be
+        drained.
+        """
+        with self.lock:
+            self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _run(self):
+        db = self.pool.acquire()
+        try:
+            while not (self.stopping.is_set() and self.queue.empty()):
+                group = self._next_group()
+                if group:
+                    self._flush(db, group)
+        finally:
+            self.pool.release(db)
+
+    def _next_group(self):
+        group = []
+        deadline = None
+        while len(group) < self.flush_size:
+            timeout = self.flush_interval
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+            try:
+                group.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                if group or self.stopping.is_set():
+                    break
+                continue
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+        return group
+
+    def _flush(self, db, group):
+        started = time.monotonic()
+        written = []
+        for part in self._partitions(group):
+            written += self._write(db, part)
+        if not written:
+            return
+
+        latency = time.monotonic() - started
+        rows = [row for row, _ in written]
+        self.flushes += 1
+        self.flushed += len(written)
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self.total_flush_latency += latency
+        for _, future in written:
+            future.set_result(True)
+        if self.on_written is not None:
+            try:
+                self.on_written(rows)
+            except Exception:
+                logger.exception('Error notifying %d written readings',
+                                 len(rows))
+
+    def _partitions(self, group):
+        """
+        Splits a group by partition, so a partition failing doesn't fail
+        or duplicate the rows of the others.
+        """
+        if self.router is None:
+            return [group]
+        parts = {}
+        for row, future in group:
+            key = self.router.key(row[0], row[3])
+            parts.setdefault(key, []).append((row, future))
+        return list(parts.values())
+
+    def _write(self, db, group):
+        """
+        Commits a group, returning the (row, future) pairs written. The
+        futures of the rows that couldn't be written get the error.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                write_readings(db, [row for row, _ in group], self.router)
+                return group
+            except sqlite3.OperationalError as e:
+                error = e
+                if attempt < self.retries:
+                    time.sleep(self.flush_interval * 2 ** attempt)
+            except Exception as e:
+                error = e
+                break
+
+        if (len(group) > 1 and not isinstance(error, FrozenPartition)
+                and not isinstance(error, sqlite3.OperationalError)):
+            written = []
+            for entry in group:
+                written += self._write(db, [entry])
+            return written
+
+        self.failed += len(group)
+        for _, future in group:
+            future.set_exception(error)
+        return []
+
+    def stats(self):
+        mean = self.total_flush_latency / self.flushes if self.flushes else 0
+        return dict(
+            queue_depth=self.queue.qsize(),
+            queue_capacity=self.queue.maxsize,
+            flushes=self.flushes,
+            flushed=self.flushed,
+            failed=self.failed,
+            last_flush_latency_ms=self.last_flush_latency * 1000,
+            mean_flush_latency_ms=mean * 1000,
+            max_flush_latency_ms=self.max_flush_latency * 1000,
+        )
+
+
+def get_write_behind():
+    return current_app.extensions.get('write_behind')
+
+
+def init_app(app):
+    if not app.config['WRITE_BEHIND']:
+        return
+    buffer = WriteBehindBuffer(
+        get_pool(app),
+        max_size=app.config['WRITE_BEHIND_QUEUE_SIZE'],
+        flush_size=app.config['WRITE_BEHIND_FLUSH_SIZE'],
+        flush_interval=app.config['WRITE_BEHIND_FLUSH_INTERVAL'],
+        on_written=lambda rows: notify_written(app, rows),
+        router=get_router(app),
+        retries=app.config['WRITE_BEHIND_RETRIES'],
+    )
+    app.extensions['write_behind'] = buffer
+    atexit.register(buffer.stop)
@@ -0,0 +1,216 @@
+"""
+Per-request latency broken down by phase.
+
+Code timed with `phase(name)` adds its time, and optionally a row count, to
+the phase of the current request: 'db_connect' for getting a connection,
+'sql' for the queries, 'hot_store' for reads served from memory, 'stats'
+for the statistics computed in Python, 'serialize' for dumping readings
+and 'jsonify' for building the response.
+
+When a request ends, its total time and every phase are observed in
+histograms labelled by endpoint, rendered in the Prometheus text format
+by GET /metrics. A streamed response ends when its body is closed, once
+generated and sent. With JSON_LOGS, a line per request with the same
+breakdown is also logged as JSON, like old_project's json logger.
+"""
+import bisect
+import functools
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, request
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+ROWS_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+class Histogram():
+    """
+    Cumulative histogram of observations by label values, as Prometheus
+    defines them.
+    """
+
+    def __init__(self, name, documentation, labels, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # Label values -> [count per bucket, +Inf included], sum
+        self.series = {}
+
+    def observe(self, values, amount):
+        index = bisect.bisect_left(self.buckets, amount)
+        with self.lock:
+            counts, total = self.series.get(values,
+                                            ([0] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self.series[values] = (counts, total + amount)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            series = sorted(self.series.items())
+        for values, (counts, total) in series:
+            labels = ','.join('{}="{}"'.format(k, _escape(v))
+                              for k, v in zip(self.labels, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    self.name, labels, bound, cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, labels, total))
+            lines.append('{}_count{{{}}} {}'.format(self.name, labels,
+                                                    cumulative))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+class Instrumentation():
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.requests = Histogram(
+            'readings_request_seconds', 'Time to answer a request.',
+            ('endpoint', 'method', 'status'), SECONDS_BUCKETS)
+        self.phases = Histogram(
+            'readings_phase_seconds', 'Time spent in a phase of a request.',
+            ('endpoint', 'phase'), SECONDS_BUCKETS)
+        self.rows = Histogram(
+            'readings_phase_rows', 'Rows handled by a phase of a request.',
+            ('endpoint', 'phase'), ROWS_BUCKETS)
+
+    def request_started(self):
+        g.request_started = time.perf_counter()
+        g.phases = {}
+        g.phase_stack = []
+
+    def request_finished(self, response):
+        if 'request_started' not in g:
+            return response
+        finished = functools.partial(
+            self.observe, request.endpoint or 'unknown', request.method,
+            request.path, response.status_code, g.request_started, g.phases)
+        if response.is_streamed:
+            # The body, and the phases it runs, come after this hook
+            response.call_on_close(finished)
+        else:
+            finished()
+        return response
+
+    def observe(self, endpoint, method, path, status, started, phases):
+        seconds = time.perf_counter() - started
+        self.requests.observe((endpoint, method, str(status)), seconds)
+        for name, (elapsed, rows) in phases.items():
+            self.phases.observe((endpoint, name), elapsed)
+            if rows is not None:
+                self.rows.observe((endpoint, name), rows)
+
+        if self.logger is not None:
+            self.logger.info('request', extra=dict(
+                endpoint=endpoint,
+                method=method,
+                path=path,
+                status=status,
+                duration_ms=seconds * 1000,
+                phases={name: dict(ms=elapsed * 1000, rows=rows)
+                        for name, (elapsed, rows) in phases.items()},
+            ))
+
+    def render(self):
+        lines = []
+        for histogram in (self.requests, self.phases, self.rows):
+            lines += histogram.render()
+        return '\n'.join(lines) + '\n'
+
+
+class Timing():
+    __slots__ = ('rows', 'nested')
+
+    def __init__(self):
+        self.rows = None
+        self.nested = 0.0
+
+
+@contextmanager
+def phase(name):
+    """
+    Adds the time spent in the block to the phase `name` of the current
+    request. Setting `rows` on the yielded object counts rows too. Time
+    spent in a phase nested in the block only counts for the inner one.
+    """
+    timing = Timing()
+    if not has_app_context() or 'phases' not in g:
+        yield timing
+        return
+    g.phase_stack.append(timing)
+    started = time.perf_counter()
+    try:
+        yield timing
+    finally:
+        elapsed = time.perf_counter() - started
+        g.phase_stack.pop()
+        if g.phase_stack:
+            g.phase_stack[-1].nested += elapsed
+        record(name, elapsed - timing.nested, timing.rows)
+
+
+def record(name, seconds, rows=None):
+    """
+    Adds time, and rows, to the phase `name` of the current request.
+    """
+    phases = g.get('phases') if has_app_context() else None
+    if phases is None:
+        return
+    elapsed, counted = phases.get(name, (0, None))
+    if rows is not None:
+        counted = (counted or 0) + rows
+    phases[name] = (elapsed + seconds, counted)
+
+
+def get_instrumentation():
+    return current_app.extensions.get('instrumentation')
+
+
+def init_json_logger(app):
+    """
+    Logs one JSON object per line to stdout, with the request fields.
+    pythonjsonlogger is only needed when JSON_LOGS is set.
+    """
+    from pythonjsonlogger import jsonlogger
+
+    supported_keys = [
+        'asctime',
+        'levelname',
+        'message',
+        'name',
+        'process',
+        'thread',
+    ]
+    custom_format = ' '.join('%({0:s})'.format(i) for i in supported_keys)
+    logger = logging.getLogger('app.requests')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(jsonlogger.JsonFormatter(custom_format))
+    logger.handlers.clear()
+    logger.addHandler(handler)
+    return logger
+
+
+def init_app(app):
+    if not app.config['INSTRUMENTATION']:
+        return
+    logger = init_json_logger(app) if app.config['JSON_LOGS'] else None
+    instrumentation = Instrumentation(logger)
+    app.extensions['instrumentation'] = instrumentation
+    app.before_request(instrumentation.request_started)
+    app.after_request(instrumentation.request_finished)
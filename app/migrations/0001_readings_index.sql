@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS readings(
+    device_uuid TEXT,
+    type TEXT,
+    value INTEGER,
+    date_created INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS readings_device_type_date
+    ON readings(device_uuid, type, date_created, value);
@@ -0,0 +1,2 @@
+CREATE INDEX IF NOT EXISTS readings_device_date
+    ON readings(device_uuid, date_created);
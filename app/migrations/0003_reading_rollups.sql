@@ -0,0 +1,43 @@
+CREATE TABLE IF NOT EXISTS reading_rollups(
+    resolution INTEGER NOT NULL,
+    device_uuid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum NUMERIC NOT NULL,
+    min NUMERIC NOT NULL,
+    max NUMERIC NOT NULL,
+    PRIMARY KEY (resolution, device_uuid, type, bucket)
+) WITHOUT ROWID;
+
+-- One row per minute, hour and day bucket (date_created / resolution).
+CREATE TRIGGER IF NOT EXISTS readings_rollups AFTER INSERT ON readings
+BEGIN
+    INSERT INTO reading_rollups (
+        resolution, device_uuid, type, bucket, count, sum, min, max
+    )
+    VALUES
+        (60, NEW.device_uuid, NEW.type, NEW.date_created / 60,
+         1, NEW.value, NEW.value, NEW.value),
+        (3600, NEW.device_uuid, NEW.type, NEW.date_created / 3600,
+         1, NEW.value, NEW.value, NEW.value),
+        (86400, NEW.device_uuid, NEW.type, NEW.date_created / 86400,
+         1, NEW.value, NEW.value, NEW.value)
+    ON CONFLICT (resolution, device_uuid, type, bucket) DO UPDATE SET
+        count = count + 1,
+        sum = sum + excluded.sum,
+        min = MIN(min, excluded.min),
+        max = MAX(max, excluded.max);
+END;
+
+INSERT INTO reading_rollups (
+    resolution, device_uuid, type, bucket, count, sum, min, max
+)
+SELECT resolutions.resolution, device_uuid, type,
+       date_created / resolutions.resolution,
+       COUNT(value), SUM(value), MIN(value), MAX(value)
+FROM readings, (SELECT 60 AS resolution
+                UNION ALL SELECT 3600
+                UNION ALL SELECT 86400) AS resolutions
+GROUP BY resolutions.resolution, device_uuid, type,
+         date_created / resolutions.resolution;
@@ -0,0 +1,34 @@
+CREATE TABLE IF NOT EXISTS reading_histograms(
+    resolution INTEGER NOT NULL,
+    device_uuid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    value NUMERIC NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (resolution, device_uuid, type, bucket, value)
+) WITHOUT ROWID;
+
+-- How many readings had each value, per hour and day bucket.
+CREATE TRIGGER IF NOT EXISTS readings_histograms AFTER INSERT ON readings
+BEGIN
+    INSERT INTO reading_histograms (
+        resolution, device_uuid, type, bucket, value, count
+    )
+    VALUES
+        (3600, NEW.device_uuid, NEW.type, NEW.date_created / 3600,
+         NEW.value, 1),
+        (86400, NEW.device_uuid, NEW.type, NEW.date_created / 86400,
+         NEW.value, 1)
+    ON CONFLICT (resolution, device_uuid, type, bucket, value) DO UPDATE SET
+        count = count + 1;
+END;
+
+INSERT INTO reading_histograms (
+    resolution, device_uuid, type, bucket, value, count
+)
+SELECT resolutions.resolution, device_uuid, type,
+       date_created / resolutions.resolution, value, COUNT(*)
+FROM readings, (SELECT 3600 AS resolution
+                UNION ALL SELECT 86400) AS resolutions
+GROUP BY resolutions.resolution, device_uuid, type,
+         date_created / resolutions.resolution, value;
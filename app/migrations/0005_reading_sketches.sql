@@ -0,0 +1,19 @@
+CREATE TABLE IF NOT EXISTS reading_sketches(
+    device_uuid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    resolution INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    sketch BLOB NOT NULL,
+    PRIMARY KEY (device_uuid, type, resolution, bucket)
+) WITHOUT ROWID;
+
+-- Sketches are built lazily, a new reading only drops the stale ones.
+CREATE TRIGGER IF NOT EXISTS readings_sketches AFTER INSERT ON readings
+BEGIN
+    DELETE FROM reading_sketches
+    WHERE device_uuid = NEW.device_uuid AND type = NEW.type
+        AND resolution = 3600 AND bucket = NEW.date_created / 3600;
+    DELETE FROM reading_sketches
+    WHERE device_uuid = NEW.device_uuid AND type = NEW.type
+        AND resolution = 86400 AND bucket = NEW.date_created / 86400;
+END;
@@ -0,0 +1,17 @@
+CREATE TABLE IF NOT EXISTS device_versions(
+    device_uuid TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Every reading bumps its device version, the ETag of its responses.
+CREATE TRIGGER IF NOT EXISTS readings_versions AFTER INSERT ON readings
+BEGIN
+    INSERT INTO device_versions (device_uuid, version)
+    VALUES (NEW.device_uuid, 1)
+    ON CONFLICT (device_uuid) DO UPDATE SET version = version + 1;
+END;
+
+INSERT OR IGNORE INTO device_versions (device_uuid, version)
+SELECT device_uuid, COUNT(*)
+FROM readings
+GROUP BY device_uuid;
@@ -0,0 +1,44 @@
+CREATE TABLE IF NOT EXISTS device_summary(
+    device_uuid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    sum NUMERIC NOT NULL,
+    min NUMERIC NOT NULL,
+    max NUMERIC NOT NULL,
+    PRIMARY KEY (device_uuid, type)
+) WITHOUT ROWID;
+
+-- The value histogram of each device_summary row.
+CREATE TABLE IF NOT EXISTS device_summary_values(
+    device_uuid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    value NUMERIC NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (device_uuid, type, value)
+) WITHOUT ROWID;
+
+-- Whole-history totals per device and type, in the inserting transaction.
+CREATE TRIGGER IF NOT EXISTS readings_device_summary AFTER INSERT ON readings
+BEGIN
+    INSERT INTO device_summary (device_uuid, type, count, sum, min, max)
+    VALUES (NEW.device_uuid, NEW.type, 1, NEW.value, NEW.value, NEW.value)
+    ON CONFLICT (device_uuid, type) DO UPDATE SET
+        count = count + 1,
+        sum = sum + excluded.sum,
+        min = MIN(min, excluded.min),
+        max = MAX(max, excluded.max);
+    INSERT INTO device_summary_values (device_uuid, type, value, count)
+    VALUES (NEW.device_uuid, NEW.type, NEW.value, 1)
+    ON CONFLICT (device_uuid, type, value) DO UPDATE SET
+        count = count + 1;
+END;
+
+INSERT INTO device_summary (device_uuid, type, count, sum, min, max)
+SELECT device_uuid, type, COUNT(*), SUM(value), MIN(value), MAX(value)
+FROM readings
+GROUP BY device_uuid, type;
+
+INSERT INTO device_summary_values (device_uuid, type, value, count)
+SELECT device_uuid, type, value, COUNT(*)
+FROM readings
+GROUP BY device_uuid, type, value;
@@ -0,0 +1,143 @@
+"""
+Fleet summaries computed on a pool of processes.
+
+With SUMMARY_WORKERS set, MetricsDeviceView.summary lists the devices
+from device_versions, splits them in SHARDS_PER_WORKER shards per worker
+by a hash of their uuid, and hands every shard to a ProcessPoolExecutor.
+Each worker process reads the value histograms of its devices only, with
+index seeks on its own read-only connections, and computes their
+statistics, mode ties included. Shards are merged as they come back and
+sorted as the serial path sorts them.
+"""
+import atexit
+import sqlite3
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+from flask import current_app
+
+from app.histograms import device_value_counts
+from app.rollups import first_seen
+from app.stats import summarize_counts
+
+# More shards than workers evens out devices of very different sizes
+SHARDS_PER_WORKER = 4
+
+# Read-only connections of a worker process, by database path
+_connections = {}
+
+
+def device_shard(device_uuid, shards):
+    return zlib.crc32(device_uuid.encode('utf8')) % shards
+
+
+def _connect(path):
+    conn = _connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True,
+                               check_same_thread=False)
+        conn.execute('PRAGMA query_only = ON')
+        _connections[path] = conn
+    return conn
+
+
+def fleet_devices(dbs):
+    """
+    Returns the uuids of every device with readings in any of `dbs`.
+    """
+    devices = set()
+    for db in dbs:
+        cur = db.cursor()
+        cur.row_factory = None
+        devices.update(row[0] for row in cur.execute(
+            'SELECT device_uuid FROM device_versions'))
+    return devices
+
+
+def summarize_shard(paths, devices, sensor_type, lo, hi):
+    """
+    Runs in a worker: the summaries of `devices` read from the databases
+    at `paths`, in device order.
+    """
+    dbs = [_connect(path) for path in paths]
+    summaries = []
+    for device_uuid, values, counts in device_value_counts(
+            dbs, sensor_type, lo, hi, devices=devices):
+        data = dict(device_uuid=device_uuid)
+        data.update(summarize_counts(
+            values, counts, first_seen(dbs, device_uuid, sensor_type, lo,
+                                       hi)))
+        summaries.append(data)
+    return summaries
+
+
+class SummaryPool():
+    """
+    Worker processes are spawned on the first summary, not with the app,
+    and start fresh instead of forking the threads of the server.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.executor = None
+        self.summaries = 0
+        self.shards = 0
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    self.workers, mp_context=get_context('spawn'))
+            return self.executor
+
+    def summarize(self, paths, devices, sensor_type, lo, hi):
+        """
+        Returns the summaries of `devices` read from the databases at
+        `paths`, most readings first.
+        """
+        executor = self.get_executor()
+        shards = [[] for _ in range(self.workers * SHARDS_PER_WORKER)]
+        for device_uuid in devices:
+            shards[device_shard(device_uuid, len(shards))].append(device_uuid)
+        tasks = [executor.submit(summarize_shard, paths, sorted(shard),
+                                 sensor_type, lo, hi)
+                 for shard in shards if shard]
+        summaries = []
+        for task in as_completed(tasks):
+            summaries.extend(task.result())
+        self.summaries += 1
+        self.shards += len(tasks)
+
+        # The serial order: by count, then device order on ties
+        summaries.sort(key=lambda data: (-data['number_of_readings'],
+                                         data['device_uuid']))
+        return summaries
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def stats(self):
+        return dict(
+            workers=self.workers,
+            started=self.executor is not None,
+            summaries=self.summaries,
+            shards=self.shards,
+        )
+
+
+def get_summary_pool():
+    return current_app.extensions.get('summary_pool')
+
+
+def init_app(app):
+    if not app.config['SUMMARY_WORKERS']:
+        return
+    pool = SummaryPool(app.config['SUMMARY_WORKERS'])
+    app.extensions['summary_pool'] = pool
+    atexit.register(pool.close)
@@ -0,0 +1,192 @@
+"""
+Time-bucketed rollups of the readings table.
+
+reading_rollups keeps count, sum, min and max per (device_uuid, type) for
+minute, hour and day buckets. It is maintained by the readings_rollups
+trigger, so every insert path updates it in the same transaction.
+
+A date range is answered from the largest whole buckets it contains, with
+finer buckets and finally raw readings only at its partial edges.
+"""
+
+from collections import namedtuple
+
+DAY = 86400
+HOUR = 3600
+MINUTE = 60
+
+RESOLUTIONS = (DAY, HOUR, MINUTE)
+
+Aggregate = namedtuple('Aggregate', ['count', 'sum', 'min', 'max'])
+
+REBUILD_SENTENCE = '''
+    INSERT INTO reading_rollups (
+        resolution, device_uuid, type, bucket, count, sum, min, max
+    )
+    SELECT ?, device_uuid, type, date_created / ?,
+           COUNT(value), SUM(value), MIN(value), MAX(value)
+    FROM readings
+    GROUP BY device_uuid, type, date_created / ?
+'''
+
+
+def split_range(lo, hi, resolutions=RESOLUTIONS):
+    """
+    Splits the half-open range [lo, hi) of timestamps, where None is an
+    open end, into the largest whole buckets it contains and the raw
+    edges left over.
+
+    Returns a list of (resolution, start, end) pieces in time order. For
+    buckets start and end are bucket numbers (end excluded, None for an
+    open end); raw edges have a resolution of None and timestamp bounds.
+    """
+    if lo is not None and hi is not None and lo >= hi:
+        return []
+    if not resolutions:
+        return [(None, lo, hi)]
+
+    resolution = resolutions[0]
+    first = None if lo is None else -(-lo // resolution)
+    end = None if hi is None else hi // resolution
+    if first is not None and end is not None and first >= end:
+        return split_range(lo, hi, resolutions[1:])
+
+    pieces = []
+    if lo is not None:
+        pieces += split_range(lo, first * resolution, resolutions[1:])
+    pieces.append((resolution, first, end))
+    if hi is not None:
+        pieces += split_range(end * resolution, hi, resolutions[1:])
+    return pieces
+
+
+def _conditions(device_uuid, sensor_type):
+    conditions = ['device_uuid = ?']
+    params = [device_uuid]
+    if sensor_type is not None:
+        conditions.append('type = ?')
+        params.append(sensor_type)
+    return conditions, params
+
+
+def _bucket_query(fields, resolution, first, end, device_uuid, sensor_type):
+    conditions, params = _conditions(device_uuid, sensor_type)
+    conditions.insert(0, 'resolution = ?')
+    params.insert(0, resolution)
+    if first is not None:
+        conditions.append('bucket >= ?')
+        params.append(first)
+    if end is not None:
+        conditions.append('bucket < ?')
+        params.append(end)
+    query = 'SELECT {} FROM reading_rollups WHERE {}'.format(
+        fields, ' AND '.join(conditions))
+    return query, params
+
+
+def _raw_query(fields, lo, hi, device_uuid, sensor_type):
+    conditions, params = _conditions(device_uuid, sensor_type)
+    if lo is not None:
+        conditions.append('date_created >= ?')
+        params.append(lo)
+    if hi is not None:
+        conditions.append('date_created < ?')
+        params.append(hi)
+    query = 'SELECT {} FROM readings WHERE {}'.format(
+        fields, ' AND '.join(conditions))
+    return query, params
+
+
+def merge(a, b):
+    """
+    Merges an Aggregate with a (count, sum, min, max) row.
+    """
+    if not b[0]:
+        return a
+    if not a.count:
+        return Aggregate(*b)
+    return Aggregate(a.count + b[0], a.sum + b[1],
+                     min(a.min, b[2]), max(a.max, b[3]))
+
+
+def aggregate(db, device_uuid, sensor_type, lo, hi):
+    """
+    Returns the Aggregate of the device readings in [lo, hi).
+    """
+    result = Aggregate(0, 0, None, None)
+
+    for resolution, start, end in split_range(lo, hi):
+        if resolution is None:
+            query, params = _raw_query(
+                'COUNT(value), SUM(value), MIN(value), MAX(value)',
+                start, end, device_uuid, sensor_type)
+        else:
+            query, params = _bucket_query(
+                'SUM(count), SUM(sum), MIN(min), MAX(max)',
+                resolution, start, end, device_uuid, sensor_type)
+        result = merge(result, db.execute(query, params).fetchone())
+
+    return result
+
+
+def find_reading(db, device_uuid, sensor_type, lo, hi, value, fields,
+                 resolutions=RESOLUTIONS):
+    """
+    Returns the first reading in [lo, hi) holding `value`, in insertion
+    order, drilling down from the first bucket whose min or max is that
+    value.
+    """
+    for resolution, start, end in split_range(lo, hi, resolutions):
+        if resolution is None:
+            query, params = _raw_query(fields, start, end,
+                                       device_uuid, sensor_type)
+            query += (' AND value = ? ORDER BY date_created, rowid'
+                      ' LIMIT 1')
+            row = db.execute(query, params + [value]).fetchone()
+            if row is not None:
+                return row
+            continue
+
+        query, params = _bucket_query('bucket', resolution, start, end,
+                                      device_uuid, sensor_type)
+        query += ' AND (min = ? OR max = ?) ORDER BY bucket LIMIT 1'
+        row = db.execute(query, params + [value, value]).fetchone()
+        if row is not None:
+            bucket = row[0]
+            finer = resolutions[resolutions.index(resolution) + 1:]
+            return find_reading(db, device_uuid, sensor_type,
+                                bucket * resolution,
+                                (bucket + 1) * resolution,
+                                value, fields, finer)
+    return None
+
+
+def first_seen(dbs, device_uuid, sensor_type, lo, hi):
+    """
+    Returns a function telling which of some values the device readings
+    in [lo, hi) meet first in (date_created, rowid) order, that is
+    insertion order, to break ties between modes. The databases `dbs`
+    are read in time order.
+    """
+    query, params = _raw_query('value', lo, hi, device_uuid, sensor_type)
+
+    def first_seen(ties):
+        sentence = query + (
+            ' AND value IN ({}) ORDER BY date_created, rowid'
+            ' LIMIT 1').format(', '.join('?' * len(ties)))
+        for db in dbs:
+            row = db.execute(sentence, params + ties).fetchone()
+            if row is not None:
+                return row[0]
+
+    return first_seen
+
+
+def rebuild_rollups(db):
+    """
+    Recomputes every rollup from the raw readings.
+    """
+    with db:
+        db.execute('DELETE FROM reading_rollups')
+        for resolution in RESOLUTIONS:
+            db.execute(REBUILD_SENTENCE, (resolution, resolution, resolution))
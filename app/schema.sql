@@ -1,8 +1,151 @@
 DROP TABLE IF EXISTS readings;
+DROP TABLE IF EXISTS reading_rollups;
+DROP TABLE IF EXISTS reading_histograms;
+DROP TABLE IF EXISTS reading_sketches;
+DROP TABLE IF EXISTS device_versions;
+DROP TABLE IF EXISTS device_summary;
+DROP TABLE IF EXISTS device_summary_values;
 
 CREATE TABLE IF NOT EXISTS readings(
     device_uuid TEXT,
     type TEXT,
     value INTEGER,
     date_created INTEGER
-);
\ No newline at end of file
+);
+
+-- Serves every per-device query: the filters on device_uuid, type and
+-- date_created are index seeks and value is read from the index itself.
+CREATE INDEX IF NOT EXISTS readings_device_type_date
+    ON readings(device_uuid, type, date_created, value);
+
+-- Key order is (device_uuid, date_created, rowid), the keyset used to
+-- page through a device readings.
+CREATE INDEX IF NOT EXISTS readings_device_date
+    ON readings(device_uuid, date_created);
+
+CREATE TABLE IF NOT EXISTS reading_rollups(
+    resolution INTEGER NOT NULL,
+    device_uuid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum NUMERIC NOT NULL,
+    min NUMERIC NOT NULL,
+    max NUMERIC NOT NULL,
+    PRIMARY KEY (resolution, device_uuid, type, bucket)
+) WITHOUT ROWID;
+
+-- One row per minute, hour and day bucket (date_created / resolution).
+CREATE TRIGGER IF NOT EXISTS readings_rollups AFTER INSERT ON readings
+BEGIN
+    INSERT INTO reading_rollups (
+        resolution, device_uuid, type, bucket, count, sum, min, max
+    )
+    VALUES
+        (60, NEW.device_uuid, NEW.type, NEW.date_created / 60,
+         1, NEW.value, NEW.value, NEW.value),
+        (3600, NEW.device_uuid, NEW.type, NEW.date_created / 3600,
+         1, NEW.value, NEW.value, NEW.value),
+        (86400, NEW.device_uuid, NEW.type, NEW.date_created / 86400,
+         1, NEW.value, NEW.value, NEW.value)
+    ON CONFLICT (resolution, device_uuid, type, bucket) DO UPDATE SET
+        count = count + 1,
+        sum = sum + excluded.sum,
+        min = MIN(min, excluded.min),
+        max = MAX(max, excluded.max);
+END;
+
+CREATE TABLE IF NOT EXISTS reading_histograms(
+    resolution INTEGER NOT NULL,
+    device_uuid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    value NUMERIC NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (resolution, device_uuid, type, bucket, value)
+) WITHOUT ROWID;
+
+-- How many readings had each value, per hour and day bucket.
+CREATE TRIGGER IF NOT EXISTS readings_histograms AFTER INSERT ON readings
+BEGIN
+    INSERT INTO reading_histograms (
+        resolution, device_uuid, type, bucket, value, count
+    )
+    VALUES
+        (3600, NEW.device_uuid, NEW.type, NEW.date_created / 3600,
+         NEW.value, 1),
+        (86400, NEW.device_uuid, NEW.type, NEW.date_created / 86400,
+         NEW.value, 1)
+    ON CONFLICT (resolution, device_uuid, type, bucket, value) DO UPDATE SET
+        count = count + 1;
+END;
+
+CREATE TABLE IF NOT EXISTS reading_sketches(
+    device_uuid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    resolution INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    sketch BLOB NOT NULL,
+    PRIMARY KEY (device_uuid, type, resolution, bucket)
+) WITHOUT ROWID;
+
+-- Sketches are built lazily, a new reading only drops the stale ones.
+CREATE TRIGGER IF NOT EXISTS readings_sketches AFTER INSERT ON readings
+BEGIN
+    DELETE FROM reading_sketches
+    WHERE device_uuid = NEW.device_uuid AND type = NEW.type
+        AND resolution = 3600 AND bucket = NEW.date_created / 3600;
+    DELETE FROM reading_sketches
+    WHERE device_uuid = NEW.device_uuid AND type = NEW.type
+        AND resolution = 86400 AND bucket = NEW.date_created / 86400;
+END;
+
+CREATE TABLE IF NOT EXISTS device_versions(
+    device_uuid TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Every reading bumps its device version, the ETag of its responses.
+CREATE TRIGGER IF NOT EXISTS readings_versions AFTER INSERT ON readings
+BEGIN
+    INSERT INTO device_versions (device_uuid, version)
+    VALUES (NEW.device_uuid, 1)
+    ON CONFLICT (device_uuid) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TABLE IF NOT EXISTS device_summary(
+    device_uuid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    sum NUMERIC NOT NULL,
+    min NUMERIC NOT NULL,
+    max NUMERIC NOT NULL,
+    PRIMARY KEY (device_uuid, type)
+) WITHOUT ROWID;
+
+-- The value histogram of each device_summary row.
+CREATE TABLE IF NOT EXISTS device_summary_values(
+    device_uuid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    value NUMERIC NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (device_uuid, type, value)
+) WITHOUT ROWID;
+
+-- Whole-history totals per device and type, in the inserting transaction.
+CREATE TRIGGER IF NOT EXISTS readings_device_summary AFTER INSERT ON readings
+BEGIN
+    INSERT INTO device_summary (device_uuid, type, count, sum, min, max)
+    VALUES (NEW.device_uuid, NEW.type, 1, NEW.value, NEW.value, NEW.value)
+    ON CONFLICT (device_uuid, type) DO UPDATE SET
+        count = count + 1,
+        sum = sum + excluded.sum,
+        min = MIN(min, excluded.min),
+        max = MAX(max, excluded.max);
+    INSERT INTO device_summary_values (device_uuid, type, value, count)
+    VALUES (NEW.device_uuid, NEW.type, NEW.value, 1)
+    ON CONFLICT (device_uuid, type, value) DO UPDATE SET
+        count = count + 1;
+END;
+
+PRAGMA user_version = 7;
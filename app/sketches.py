@@ -0,0 +1,218 @@
+"""
+Mergeable approximate-quantile sketches of the readings table.
+
+reading_sketches stores a KLL sketch per (device_uuid, type) and hour or
+day bucket. Sketches are built lazily the first time a closed bucket is
+queried, day sketches by merging their hour sketches, and the
+readings_sketches trigger drops the sketches of a bucket that gets a new
+reading so they are rebuilt on the next query.
+
+With k = 200 the rank error of a quantile stays below 1.5% of the number
+of readings, whatever the number of readings or merges (Karnin, Lang and
+Liberty, "Optimal Quantile Approximation in Streams"). tests/test_sketches
+checks that bound against np.percentile on synthetic data.
+"""
+import math
+import random
+import sqlite3
+import struct
+import time
+from array import array
+
+from app.rollups import DAY, HOUR, split_range
+
+RESOLUTIONS = (DAY, HOUR)
+
+HEADER = struct.Struct('<IQI')
+
+
+class KLLSketch():
+    """
+    KLL quantile sketch: a stack of compactors where level h holds items
+    of weight 2 ** h. A full compactor sorts its items and promotes every
+    other one, chosen from a random offset, to the level above.
+    """
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.n = 0
+        self.rng = random.Random(seed)
+        self.compactors = []
+        self._set_levels(1)
+
+    def _set_levels(self, levels):
+        self.compactors += [[] for _ in range(levels - len(self.compactors))]
+        self.capacities = [
+            int(math.ceil(self.k * (2 / 3) ** (levels - level - 1))) + 1
+            for level in range(levels)
+        ]
+        self.max_size = sum(self.capacities)
+
+    def _grow(self):
+        self._set_levels(len(self.compactors) + 1)
+
+    def _size(self):
+        return sum(len(c) for c in self.compactors)
+
+    def _compress(self):
+        while self._size() >= self.max_size:
+            for level, items in enumerate(self.compactors):
+                if len(items) < self.capacities[level]:
+                    continue
+                if level + 1 == len(self.compactors):
+                    self._grow()
+                items.sort()
+                offset = self.rng.randint(0, 1)
+                end = len(items) - len(items) % 2
+                self.compactors[level + 1].extend(items[offset:end:2])
+                self.compactors[level] = items[end:]
+                break
+
+    def update(self, value):
+        self.compactors[0].append(value)
+        self.n += 1
+        if len(self.compactors[0]) >= self.capacities[0]:
+            self._compress()
+
+    def extend(self, values):
+        for value in values:
+            self.update(value)
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for level, items in enumerate(other.compactors):
+            self.compactors[level].extend(items)
+        self.n += other.n
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """
+        Returns the first item whose rank reaches q * (n - 1), 0 <= q <= 1.
+        """
+        if not self.n:
+            return None
+        weighted = sorted((value, 2 ** level)
+                          for level, items in enumerate(self.compactors)
+                          for value in items)
+        target = q * (self.n - 1)
+        seen = 0
+        for value, weight in weighted:
+            seen += weight
+            if seen > target:
+                return value
+        return weighted[-1][0]
+
+    def to_bytes(self):
+        chunks = [HEADER.pack(self.k, self.n, len(self.compactors))]
+        for items in self.compactors:
+            chunks.append(struct.pack('<I', len(items)))
+            chunks.append(array('d', items).tobytes())
+        return b''.join(chunks)
+
+    @classmethod
+    def from_bytes(cls, data):
+        k, n, levels = HEADER.unpack_from(data)
+        sketch = cls(k, seed=n)
+        sketch.compactors = []
+        offset = HEADER.size
+        for _ in range(levels):
+            count, = struct.unpack_from('<I', data, offset)
+            offset += 4
+            items = array('d')
+            items.frombytes(data[offset:offset + 8 * count])
+            offset += 8 * count
+            sketch.compactors.append(items.tolist())
+        sketch.n = n
+        sketch._set_levels(levels)
+        return sketch
+
+
+def _buckets(db, resolution, start, end, device_uuid, sensor_type):
+    """
+    Lists the (type, bucket) pairs holding readings, from the rollups.
+    """
+    conditions = ['resolution = ?', 'device_uuid = ?']
+    params = [resolution, device_uuid]
+    if sensor_type is not None:
+        conditions.append('type = ?')
+        params.append(sensor_type)
+    if start is not None:
+        conditions.append('bucket >= ?')
+        params.append(start)
+    if end is not None:
+        conditions.append('bucket < ?')
+        params.append(end)
+    query = 'SELECT type, bucket FROM reading_rollups WHERE {}'.format(
+        ' AND '.join(conditions))
+    return db.execute(query, params).fetchall()
+
+
+def _raw_values(db, device_uuid, sensor_type, lo, hi):
+    conditions = ['device_uuid = ?']
+    params = [device_uuid]
+    if sensor_type is not None:
+        conditions.append('type = ?')
+        params.append(sensor_type)
+    if lo is not None:
+        conditions.append('date_created >= ?')
+        params.append(lo)
+    if hi is not None:
+        conditions.append('date_created < ?')
+        params.append(hi)
+    query = 'SELECT value FROM readings WHERE {}'.format(
+        ' AND '.join(conditions))
+    return [r[0] for r in db.execute(query, params)]
+
+
+def bucket_sketch(db, device_uuid, sensor_type, resolution, bucket, k):
+    """
+    Returns the sketch of one bucket, stored once the bucket is closed.
+    """
+    row = db.execute(
+        'SELECT sketch FROM reading_sketches WHERE device_uuid = ?'
+        ' AND type = ? AND resolution = ? AND bucket = ?',
+        (device_uuid, sensor_type, resolution, bucket)).fetchone()
+    if row is not None:
+        return KLLSketch.from_bytes(row[0])
+
+    lo = bucket * resolution
+    hi = lo + resolution
+    sketch = KLLSketch(k, seed=bucket)
+    if resolution == HOUR:
+        sketch.extend(_raw_values(db, device_uuid, sensor_type, lo, hi))
+    else:
+        for _, hour in _buckets(db, HOUR, lo // HOUR, hi // HOUR,
+                                device_uuid, sensor_type):
+            sketch.merge(bucket_sketch(db, device_uuid, sensor_type,
+                                       HOUR, hour, k))
+
+    if hi <= time.time():
+        try:
+            with db:
+                db.execute('INSERT OR REPLACE INTO reading_sketches'
+                           ' VALUES (?, ?, ?, ?, ?)',
+                           (device_uuid, sensor_type, resolution, bucket,
+                            sketch.to_bytes()))
+        except sqlite3.OperationalError:
+            # Storing is only a cache, a busy database can skip it
+            pass
+    return sketch
+
+
+def range_sketch(db, device_uuid, sensor_type, lo, hi, k=200):
+    """
+    Returns the merged sketch of the device readings in [lo, hi).
+    """
+    sketch = KLLSketch(k)
+    for resolution, start, end in split_range(lo, hi, RESOLUTIONS):
+        if resolution is None:
+            sketch.extend(_raw_values(db, device_uuid, sensor_type,
+                                      start, end))
+            continue
+        for reading_type, bucket in _buckets(db, resolution, start, end,
+                                             device_uuid, sensor_type):
+            sketch.merge(bucket_sketch(db, device_uuid, reading_type,
+                                       resolution, bucket, k))
+    return sketch
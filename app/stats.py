@@ -0,0 +1,101 @@
+import math
+import statistics
+from bisect import bisect_right
+from itertools import accumulate
+
+
+def mean_from_sum(total, count):
+    """
+    Mean of `count` values adding up to `total`, typed as statistics.mean
+    would type it: an int when integer values divide exactly.
+    """
+    if not count:
+        return None
+    if isinstance(total, int) and total % count == 0:
+        return total // count
+    return total / count
+
+
+def _nth_from_counts(values, cumulative, index):
+    return values[bisect_right(cumulative, index)]
+
+
+def median_from_counts(values, counts):
+    """
+    statistics.median of the readings described by a histogram.
+    """
+    cumulative = list(accumulate(counts))
+    n = cumulative[-1]
+    middle = n // 2
+    if n % 2 == 1:
+        return _nth_from_counts(values, cumulative, middle)
+    return (_nth_from_counts(values, cumulative, middle - 1)
+            + _nth_from_counts(values, cumulative, middle)) / 2
+
+
+def percentile_from_counts(values, counts, q):
+    """
+    np.percentile(readings, q) of the readings described by a histogram,
+    using the same linear interpolation NumPy does.
+    """
+    cumulative = list(accumulate(counts))
+    n = cumulative[-1]
+    virtual = (n - 1) * (q / 100)
+    if virtual >= n - 1:
+        return float(values[-1])
+    previous = math.floor(virtual)
+    gamma = virtual - previous
+    a = _nth_from_counts(values, cumulative, previous)
+    b = _nth_from_counts(values, cumulative, previous + 1)
+    diff = b - a
+    if gamma >= 0.5:
+        return float(b - diff * (1 - gamma))
+    return float(a + diff * gamma)
+
+
+def modes_from_counts(values, counts):
+    """
+    The most common values of a histogram.
+    """
+    top = max(counts)
+    return [v for v, c in zip(values, counts) if c == top]
+
+
+def mode_of_ties(ties, first_seen):
+    """
+    statistics.mode of readings whose most common values are `ties`. The
+    value seen first wins, which `first_seen(ties)` has to tell; on
+    interpreters where ties raise, so does this.
+    """
+    if len(ties) == 1:
+        return ties[0]
+    first = first_seen(ties)
+    return statistics.mode([first] + [v for v in ties if v != first])
+
+
+def mean_from_counts(values, counts):
+    total = sum(v * c for v, c in zip(values, counts))
+    return mean_from_sum(total, sum(counts))
+
+
+def summarize_counts(values, counts, first_seen):
+    """
+    Returns the summary of a device from its (values, counts) histogram:
+    number of readings, max, min, median, mode, mean and quartiles, mode
+    ties broken by `first_seen`.
+    """
+    try:
+        mode = mode_of_ties(modes_from_counts(values, counts), first_seen)
+    except statistics.StatisticsError:
+        mode = 'Multiple Modes'
+
+    return {
+        'number_of_readings': sum(counts),
+        'max_reading_value': values[-1],
+        'min_reading_value': values[0],
+        'median_reading_value': median_from_counts(values, counts),
+        'mode_reading_value': mode,
+        'mean_reading_value': mean_from_counts(values, counts),
+        'quartile_1_value': percentile_from_counts(values, counts, 25),
+        'quartile_3_value': percentile_from_counts(values, counts, 75),
+    }
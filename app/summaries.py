@@ -0,0 +1,173 @@
+"""
+Whole-history summaries of every device.
+
+device_summary keeps count, sum, min and max per (device_uuid, type), and
+device_summary_values how many of its readings had each value. Both are
+maintained by the readings_device_summary trigger in the inserting
+transaction, so an unfiltered summary reads a few rows per device instead
+of every reading.
+
+Pages and top-K lists of the fleet summary rank the devices on their
+counts alone, streamed in device order through a heap holding one page, so
+only the devices of the page are summarized.
+"""
+import heapq
+import itertools
+import math
+from operator import itemgetter
+
+from app.rollups import split_range
+
+SUMMARY_SENTENCE = '''
+    SELECT device_uuid, type, COUNT(*), SUM(value), MIN(value), MAX(value)
+    FROM readings
+    GROUP BY device_uuid, type
+    ORDER BY device_uuid, type
+'''
+
+VALUES_SENTENCE = '''
+    SELECT device_uuid, type, value, COUNT(*)
+    FROM readings
+    GROUP BY device_uuid, type, value
+    ORDER BY device_uuid, type, value
+'''
+
+# Table, its rows in key order, what they should be, key length
+TABLES = (
+    ('device_summary',
+     'SELECT device_uuid, type, count, sum, min, max FROM device_summary'
+     ' ORDER BY device_uuid, type',
+     SUMMARY_SENTENCE, 2),
+    ('device_summary_values',
+     'SELECT device_uuid, type, value, count FROM device_summary_values'
+     ' ORDER BY device_uuid, type, value',
+     VALUES_SENTENCE, 3),
+)
+
+
+def _count_query(piece, sensor_type):
+    """
+    Returns the query counting the readings of every device in one piece
+    of a split range, in device order, and its parameters.
+    """
+    resolution, start, end = piece
+    if resolution is None:
+        table, count, column = 'readings', 'COUNT(*)', 'date_created'
+        conditions, params = [], []
+    else:
+        table, count, column = 'reading_rollups', 'SUM(count)', 'bucket'
+        conditions, params = ['resolution = ?'], [resolution]
+    if sensor_type is not None:
+        conditions.append('type = ?')
+        params.append(sensor_type)
+    if start is not None:
+        conditions.append('{} >= ?'.format(column))
+        params.append(start)
+    if end is not None:
+        conditions.append('{} < ?'.format(column))
+        params.append(end)
+    query = ('SELECT device_uuid, {} FROM {} WHERE {}'
+             ' GROUP BY device_uuid ORDER BY device_uuid').format(
+        count, table, ' AND '.join(conditions) or '1')
+    return query, params
+
+
+def device_counts(dbs, sensor_type, lo, hi):
+    """
+    Yields (device_uuid, count) for every device with readings in [lo, hi)
+    in any of the databases `dbs`, in device order. The whole history is
+    read from device_summary, a date range from the rollups with raw
+    readings only at its partial edges.
+    """
+    if lo is None and hi is None:
+        query = 'SELECT device_uuid, SUM(count) FROM device_summary'
+        params = []
+        if sensor_type is not None:
+            query += ' WHERE type = ?'
+            params.append(sensor_type)
+        queries = [(query + ' GROUP BY device_uuid ORDER BY device_uuid',
+                    params)]
+    else:
+        queries = [_count_query(piece, sensor_type)
+                   for piece in split_range(lo, hi)]
+
+    streams = []
+    for db, (query, params) in itertools.product(dbs, queries):
+        cur = db.cursor()
+        cur.row_factory = None
+        streams.append(cur.execute(query, params))
+
+    rows = heapq.merge(*streams, key=itemgetter(0))
+    for device_uuid, group in itertools.groupby(rows, key=itemgetter(0)):
+        yield device_uuid, sum(count for _, count in group)
+
+
+def rank(count, device_uuid):
+    """
+    The summary order: most readings first, then device order on ties.
+    """
+    return -count, device_uuid
+
+
+def top_devices(counts, k, after=None):
+    """
+    Returns the first `k` of the (device_uuid, count) pairs in summary
+    order, past the (count, device_uuid) key `after` when given. The
+    pairs are streamed through a heap of `k` entries, never sorted whole.
+    """
+    if after is not None:
+        last = rank(*after)
+        counts = (pair for pair in counts if rank(pair[1], pair[0]) > last)
+    return heapq.nsmallest(k, counts, key=lambda pair: rank(pair[1],
+                                                             pair[0]))
+
+
+def rebuild_summaries(db):
+    """
+    Recomputes the device summaries from the raw readings.
+    """
+    with db:
+        db.execute('DELETE FROM device_summary')
+        db.execute('DELETE FROM device_summary_values')
+        db.execute('INSERT INTO device_summary'
+                   ' (device_uuid, type, count, sum, min, max)'
+                   + SUMMARY_SENTENCE)
+        db.execute('INSERT INTO device_summary_values'
+                   ' (device_uuid, type, value, count)' + VALUES_SENTENCE)
+
+
+def _same(stored, expected):
+    return len(stored) == len(expected) and all(
+        math.isclose(a, b, rel_tol=1e-9) if isinstance(a, float)
+        or isinstance(b, float) else a == b
+        for a, b in zip(stored, expected))
+
+
+def diff_summaries(db):
+    """
+    Yields (table, key, stored, expected) for every row of the summary
+    tables that differs from the raw readings, with None for a missing or
+    extra row. Both sides are streamed in key order and merged, so memory
+    doesn't grow with the fleet. Float sums are compared with a relative
+    tolerance, as they add up in another order.
+    """
+    for table, stored_sentence, expected_sentence, n in TABLES:
+        stored_cur = db.cursor()
+        stored_cur.row_factory = None
+        expected_cur = db.cursor()
+        expected_cur.row_factory = None
+        stored = stored_cur.execute(stored_sentence)
+        expected = expected_cur.execute(expected_sentence)
+
+        a, b = next(stored, None), next(expected, None)
+        while a is not None or b is not None:
+            if b is None or (a is not None and a[:n] < b[:n]):
+                yield table, a[:n], a[n:], None
+                a = next(stored, None)
+            elif a is None or b[:n] < a[:n]:
+                yield table, b[:n], None, b[n:]
+                b = next(expected, None)
+            else:
+                if not _same(a[n:], b[n:]):
+                    yield table, a[:n], a[n:], b[n:]
+                a, b = next(stored, None), next(expected, None)
@@ -0,0 +1,356 @@
+"""
+Opt-in tracing of the statements run on pooled connections.
+
+With DB_TRACE, the pools open TracedConnections. A statement is timed from
+execute() until its last row is fetched, with the rows it returned or
+changed and the SQLite VM steps it ran, counted by a progress handler.
+A full scan shows up as many steps for few rows.
+
+A statement slower than DB_SLOW_QUERY_MS is logged to the 'app.queries'
+logger with its EXPLAIN QUERY PLAN and the endpoint that ran it. Per
+statement aggregates are merged every few seconds into DB_TRACE_PATH, a
+SQLite file shared by every worker, which `flask query-stats` reads.
+"""
+import atexit
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+import click
+from flask import current_app, has_request_context, request
+from flask.cli import with_appcontext
+
+# VM instructions between two calls of the progress handler
+STEPS = 1000
+
+SORTS = {
+    'total': 'seconds DESC',
+    'mean': 'seconds / count DESC',
+    'max': 'max_seconds DESC',
+    'count': 'count DESC',
+    'rows': 'rows DESC',
+    'steps': 'steps DESC',
+}
+
+logger = logging.getLogger('app.queries')
+
+
+class Execution():
+    __slots__ = ('sql', 'parameters', 'seconds', 'rows', 'steps')
+
+    def __init__(self, sql, parameters):
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = 0.0
+        self.rows = 0
+        self.steps = 0
+
+
+class TracedCursor(sqlite3.Cursor):
+    """
+    Cursor timing its statement across execute() and every fetch.
+    """
+
+    execution = None
+
+    def _timed(self, method, *args):
+        conn = self.connection
+        steps = conn.steps
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.execution.seconds += time.perf_counter() - started
+            self.execution.steps += conn.steps - steps
+
+    def _finish(self):
+        execution = self.execution
+        if execution is not None:
+            self.execution = None
+            self.connection.tracer.finish(self.connection, execution)
+
+    def execute(self, sql, parameters=()):
+        if self.connection.tracer is None:
+            return super().execute(sql, parameters)
+        self._finish()
+        self.execution = Execution(sql, parameters)
+        self._timed(super().execute, sql, parameters)
+        if self.description is None:
+            self.execution.rows = max(self.rowcount, 0)
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        if self.connection.tracer is None:
+            return super().executemany(sql, seq_of_parameters)
+        self._finish()
+        self.execution = Execution(sql, None)
+        self._timed(super().executemany, sql, seq_of_parameters)
+        self.execution.rows = max(self.rowcount, 0)
+        self._finish()
+        return self
+
+    def fetchone(self):
+        if self.execution is None:
+            return super().fetchone()
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._finish()
+        else:
+            self.execution.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        if self.execution is None:
+            return super().fetchmany(size)
+        rows = self._timed(super().fetchmany, size)
+        self.execution.rows += len(rows)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        if self.execution is None:
+            return super().fetchall()
+        rows = self._timed(super().fetchall)
+        self.execution.rows += len(rows)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        if self.execution is None:
+            return super().__next__()
+        try:
+            row = self._timed(super().__next__)
+        except StopIteration:
+            self._finish()
+            raise
+        self.execution.rows += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # Statements left before their last row end with their cursor
+        self._finish()
+
+
+class TracedConnection(sqlite3.Connection):
+    tracer = None
+    steps = 0
+
+    def step(self):
+        self.steps += STEPS
+        return 0
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def normalize(sql):
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def explain(conn, sql, parameters):
+    """
+    Returns the EXPLAIN QUERY PLAN of a statement as a list of lines.
+    """
+    if parameters is None:
+        return []
+    try:
+        cur = sqlite3.Cursor(conn)
+        cur.row_factory = None
+        rows = cur.execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+    except sqlite3.Error:
+        return []
+    return [row[3] for row in rows]
+
+
+class QueryTracer():
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS query_stats(
+            sql TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            seconds REAL NOT NULL,
+            max_seconds REAL NOT NULL,
+            rows INTEGER NOT NULL,
+            steps INTEGER NOT NULL,
+            slow INTEGER NOT NULL
+        );
+    '''
+
+    def __init__(self, path, slow_ms=100, flush_interval=5):
+        self.path = path
+        self.slow = slow_ms / 1000.0
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # sql -> [count, seconds, max_seconds, rows, steps, slow]
+        self.pending = {}
+        self.last_flush = time.monotonic()
+
+        self.statements = 0
+        self.slow_statements = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+
+    def attach(self, conn):
+        conn.tracer = self
+        conn.set_progress_handler(conn.step, STEPS)
+
+    def finish(self, conn, execution):
+        slow = execution.seconds >= self.slow
+        sql = normalize(execution.sql)
+        with self.lock:
+            self.statements += 1
+            entry = self.pending.setdefault(sql, [0, 0.0, 0.0, 0, 0, 0])
+            entry[0] += 1
+            entry[1] += execution.seconds
+            entry[2] = max(entry[2], execution.seconds)
+            entry[3] += execution.rows
+            entry[4] += execution.steps
+            if slow:
+                entry[5] += 1
+                self.slow_statements += 1
+            due = time.monotonic() - self.last_flush >= self.flush_interval
+
+        if slow:
+            self.log_slow(conn, sql, execution)
+        if due:
+            self.flush()
+
+    def log_slow(self, conn, sql, execution):
+        endpoint = request.endpoint if has_request_context() else None
+        plan = explain(conn, execution.sql, execution.parameters)
+        logger.warning(
+            'Slow query (%.1f ms, %d rows, %d steps) from %s: %s\n  %s',
+            execution.seconds * 1000, execution.rows, execution.steps,
+            endpoint, sql, '\n  '.join(plan),
+            extra=dict(sql=sql, duration_ms=execution.seconds * 1000,
+                       rows=execution.rows, steps=execution.steps,
+                       plan=plan, endpoint=endpoint))
+
+    def flush(self):
+        """
+        Merges the pending aggregates into the shared file. A busy file
+        keeps them for the next flush.
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            db = sqlite3.connect(self.path, timeout=1.0)
+            try:
+                with db:
+                    db.executescript(self.SCHEMA)
+                    db.executemany(
+                        'INSERT INTO query_stats VALUES (?, ?, ?, ?, ?, ?, ?)'
+                        ' ON CONFLICT (sql) DO UPDATE SET'
+                        ' count = count + excluded.count,'
+                        ' seconds = seconds + excluded.seconds,'
+                        ' max_seconds = MAX(max_seconds,'
+                        ' excluded.max_seconds),'
+                        ' rows = rows + excluded.rows,'
+                        ' steps = steps + excluded.steps,'
+                        ' slow = slow + excluded.slow',
+                        [(sql,) + tuple(entry)
+                         for sql, entry in pending.items()])
+            finally:
+                db.close()
+        except sqlite3.OperationalError:
+            with self.lock:
+                self.failed_flushes += 1
+                for sql, entry in pending.items():
+                    current = self.pending.setdefault(sql,
+                                                      [0, 0.0, 0.0, 0, 0, 0])
+                    for i, amount in enumerate(entry):
+                        current[i] = (max(current[i], amount) if i == 2
+                                      else current[i] + amount)
+            return
+        self.flushes += 1
+
+    def read(self, sort='total', limit=20):
+        """
+        Returns the aggregates of the shared file, slowest first.
+        """
+        self.flush()
+        db = sqlite3.connect(self.path)
+        try:
+            db.executescript(self.SCHEMA)
+            return db.execute(
+                'SELECT sql, count, seconds, max_seconds, rows, steps, slow'
+                ' FROM query_stats ORDER BY {} LIMIT ?'.format(SORTS[sort]),
+                (limit,)).fetchall()
+        finally:
+            db.close()
+
+    def reset(self):
+        with self.lock:
+            self.pending = {}
+        db = sqlite3.connect(self.path)
+        try:
+            with db:
+                db.executescript(self.SCHEMA)
+                db.execute('DELETE FROM query_stats')
+        finally:
+            db.close()
+
+    def stats(self):
+        return dict(
+            statements=self.statements,
+            slow_statements=self.slow_statements,
+            slow_ms=self.slow * 1000,
+            pending=len(self.pending),
+            flushes=self.flushes,
+            failed_flushes=self.failed_flushes,
+        )
+
+
+@click.command('query-stats')
+@click.option('--sort', type=click.Choice(sorted(SORTS)), default='total',
+              help='Order of the statements.')
+@click.option('--limit', type=int, default=20)
+@click.option('--reset', is_flag=True, help='Clear the statistics.')
+@with_appcontext
+def query_stats_command(sort, limit, reset):
+    """
+    Shows the statements traced with DB_TRACE, by total time by default.
+    """
+    tracer = (current_app.extensions.get('query_tracer')
+              or QueryTracer(current_app.config['DB_TRACE_PATH']))
+    if reset:
+        tracer.reset()
+        click.echo('Cleared the query statistics.')
+        return
+    click.echo('{:>8} {:>10} {:>9} {:>9} {:>10} {:>12} {:>6}  {}'.format(
+        'count', 'total ms', 'mean ms', 'max ms', 'rows', 'steps', 'slow',
+        'statement'))
+    for sql, count, seconds, max_seconds, rows, steps, slow in tracer.read(
+            sort, limit):
+        click.echo('{:>8} {:>10.1f} {:>9.2f} {:>9.2f} {:>10} {:>12} {:>6}'
+                   '  {}'.format(count, seconds * 1000, seconds * 1000 / count,
+                                 max_seconds * 1000, rows, steps, slow, sql))
+
+
+def init_app(app):
+    if not app.config['DB_TRACE']:
+        return None
+    tracer = QueryTracer(app.config['DB_TRACE_PATH'],
+                         slow_ms=app.config['DB_SLOW_QUERY_MS'])
+    app.extensions['query_tracer'] = tracer
+    atexit.register(tracer.flush)
+    return tracer
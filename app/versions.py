@@ -0,0 +1,20 @@
+"""
+Per-device write versions of the readings table.
+
+device_versions keeps a version per device, bumped by the
+readings_versions trigger on every reading inserted, so any change to a
+device readings changes its version. Versions only grow, and their sum is
+the version of the whole fleet.
+"""
+
+
+def device_version(db, device_uuid):
+    row = db.execute(
+        'SELECT version FROM device_versions WHERE device_uuid = ?',
+        (device_uuid,)).fetchone()
+    return row[0] if row else 0
+
+
+def fleet_version(db):
+    return db.execute(
+        'SELECT COALESCE(SUM(version), 0) FROM device_versions').fetchone()[0]
@@ -0,0 +1,56 @@
+"""
+Seeded generator of synthetic fleets.
+
+A fleet of `devices` devices, each with `readings` readings spread over
+the `days` days before `end`. The same seed always gives the same fleet,
+so runs of the benchmarks are comparable.
+"""
+import random
+import time
+
+from app.db import get_db, get_router
+from app.ingest import write_readings
+from app.rollups import DAY
+
+TYPES = ('temperature', 'humidity')
+
+
+def device_uuids(devices):
+    return ['device-%05d' % i for i in range(devices)]
+
+
+def generate_fleet(devices, readings, days=30, end=None, seed=0,
+                   chunk_size=50000):
+    """
+    Yields the readings of the fleet as lists of model rows,
+    (device_uuid, type, value, date_created), `chunk_size` at a time.
+    """
+    rng = random.Random(seed)
+    if end is None:
+        end = int(time.time()) // DAY * DAY
+    span = days * DAY
+    chunk = []
+    for device_uuid in device_uuids(devices):
+        # Every device has its own level and noise, around its own mean
+        level = rng.uniform(10, 90)
+        spread = rng.uniform(1, 15)
+        for _ in range(readings):
+            value = min(100, max(0, round(rng.gauss(level, spread))))
+            chunk.append([device_uuid, rng.choice(TYPES), value,
+                          end - rng.randrange(1, span)])
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_fleet(devices, readings, **kwargs):
+    """
+    Writes a generated fleet into the database of the current app.
+    Returns the number of readings written.
+    """
+    written = 0
+    for rows in generate_fleet(devices, readings, **kwargs):
+        written += write_readings(get_db(), rows, get_router())
+    return written
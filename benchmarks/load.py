@@ -0,0 +1,278 @@
+"""
+Load generator replaying device upload traffic against a running server.
+
+`--devices` devices post single readings at `--rate` readings per second in
+total while `--readers` clients query the readings and metric endpoints
+of random devices, for `--duration` seconds. Unless --url is given, the
+app is started locally on a threaded server, over a generated fleet.
+
+    python -m benchmarks.load --devices 100000 --rate 2000 --readers 8
+
+Throughput, p50/p95/p99 latency and the error and lock contention rates
+are reported per endpoint. Writes are paced on a fixed schedule and their
+latency is measured from their scheduled time, so a server falling behind
+shows up in the percentiles instead of just slowing the generator down.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+from flask import jsonify
+from werkzeug.serving import make_server
+
+from app import create_app
+from app.api.readings import MetricsDeviceView
+from app.db import init_db
+
+from benchmarks.fleet import device_uuids, load_fleet
+
+LOCKED = ('database is locked', 'database table is locked')
+
+
+class Recorder():
+    """
+    Latencies and outcomes of the requests, by endpoint.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = Counter()
+        self.locked = Counter()
+
+    def record(self, endpoint, seconds, status, body=b''):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            self.statuses.setdefault(endpoint, Counter())[status] += 1
+            if status is None or status >= 400:
+                self.errors[endpoint] += 1
+            if any(message.encode() in body for message in LOCKED):
+                self.locked[endpoint] += 1
+
+    def summary(self, elapsed):
+        with self.lock:
+            endpoints = {}
+            for endpoint, latencies in sorted(self.latencies.items()):
+                requests = len(latencies)
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+                endpoints[endpoint] = dict(
+                    requests=requests,
+                    throughput=requests / elapsed,
+                    p50_ms=p50,
+                    p95_ms=p95,
+                    p99_ms=p99,
+                    error_rate=self.errors[endpoint] / requests,
+                    lock_rate=self.locked[endpoint] / requests,
+                    statuses={str(k): v for k, v
+                              in self.statuses[endpoint].items()},
+                )
+            return endpoints
+
+
+class Client():
+    """
+    Keep-alive HTTP connections to the server, one per thread.
+    """
+
+    def __init__(self, url, recorder):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.recorder = recorder
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = http.client.HTTPConnection(self.host, self.port,
+                                              timeout=30)
+            self.local.conn = conn
+        return conn
+
+    def request(self, endpoint, method, path, body=None, started=None):
+        """
+        Sends a request and records it under `endpoint`, its latency
+        counted from `started` when the request was due earlier.
+        """
+        if started is None:
+            started = time.perf_counter()
+        conn = self.connection()
+        try:
+            conn.request(method, path, body=body)
+            response = conn.getresponse()
+            data = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self.local.conn = None
+            data, status = b'', None
+        self.recorder.record(endpoint, time.perf_counter() - started, status,
+                             data)
+
+
+class Pacer():
+    """
+    Hands out the times of a fixed schedule of `rate` events per second.
+    """
+
+    def __init__(self, rate, start):
+        self.interval = 1.0 / rate
+        self.next = start
+        self.lock = threading.Lock()
+
+    def slot(self):
+        with self.lock:
+            slot = self.next
+            self.next += self.interval
+        return slot
+
+
+def writer(client, pacer, devices, deadline, rng):
+    while True:
+        slot = pacer.slot()
+        if slot >= deadline:
+            return
+        delay = slot - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        data = json.dumps(dict(type=rng.choice(['temperature', 'humidity']),
+                               value=rng.randint(0, 100)))
+        client.request('POST /devices/<uuid>/readings', 'POST',
+                       '/devices/{}/readings'.format(rng.choice(devices)),
+                       data, started=slot)
+
+
+def reader(client, devices, deadline, rng, paths):
+    while time.perf_counter() < deadline:
+        path = rng.choice(paths)
+        url = '/devices/{}/readings{}'.format(rng.choice(devices), path)
+        client.request('GET /devices/<uuid>/readings' + path, 'GET', url)
+
+
+def start_server(config):
+    """
+    Starts the app on a threaded local server. Returns the app, the server
+    and its URL.
+    """
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app = create_app(config)
+    # Surface the database error in the body so lock contention is counted
+    app.register_error_handler(
+        sqlite3.OperationalError,
+        lambda e: (jsonify(dict(error=str(e))), 500))
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return app, server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def run(url=None, devices=1000, rate=200, readers=4, duration=10,
+        fleet_readings=100, seed=0, config=None, summary=False):
+    """
+    Runs the load and returns the report, by endpoint.
+    """
+    server = directory = None
+    # Readers query the devices with readings, at most the first 1000
+    fleet = device_uuids(min(devices, 1000))
+    if url is None:
+        directory = tempfile.mkdtemp()
+        app_config = {'DATABASE': os.path.join(directory, 'load.db')}
+        app_config.update(config or {})
+        app, server, url = start_server(app_config)
+        with app.app_context():
+            init_db()
+            load_fleet(len(fleet), fleet_readings, seed=seed)
+
+    rng = random.Random(seed)
+    uuids = device_uuids(devices)
+    paths = [''] + ['/' + name for name in MetricsDeviceView.METRICS
+                    if summary or name != 'summary']
+    recorder = Recorder()
+    client = Client(url, recorder)
+    # One writer thread per 50 readings/s lets a slow request not hold up
+    # the schedule
+    writers = max(1, min(64, rate // 50))
+    start = time.perf_counter()
+    deadline = start + duration
+    pacer = Pacer(rate, start)
+    try:
+        with ThreadPoolExecutor(writers + readers) as pool:
+            tasks = [pool.submit(writer, client, pacer, uuids, deadline,
+                                 random.Random(rng.random()))
+                     for _ in range(writers)]
+            tasks += [pool.submit(reader, client, fleet, deadline,
+                                  random.Random(rng.random()), paths)
+                      for _ in range(readers)]
+            for task in tasks:
+                task.result()
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.shutdown()
+            shutil.rmtree(directory)
+    return dict(
+        config=dict(devices=devices, rate=rate, readers=readers,
+                    duration=duration, writers=writers),
+        elapsed=elapsed,
+        endpoints=recorder.summary(elapsed),
+    )
+
+
+def report(results):
+    print('{:<40} {:>8} {:>9} {:>9} {:>9} {:>9} {:>7} {:>7}'.format(
+        'endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'errors', 'locked'))
+    for endpoint, result in results['endpoints'].items():
+        print('{:<40} {:>8} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>7.2%}'
+              ' {:>7.2%}'.format(endpoint, result['requests'],
+                                 result['throughput'], result['p50_ms'],
+                                 result['p95_ms'], result['p99_ms'],
+                                 result['error_rate'], result['lock_rate']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', help='Server to load, instead of a local '
+                                      'one.')
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--rate', type=int, default=200,
+                        help='Readings posted per second, in total.')
+    parser.add_argument('--readers', type=int, default=4,
+                        help='Concurrent clients querying metrics.')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds of load.')
+    parser.add_argument('--fleet-readings', type=int, default=100,
+                        help='Readings per device loaded beforehand.')
+    parser.add_argument('--summary', action='store_true',
+                        help='Readers query the fleet summary too.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--config', type=json.loads, default={},
+                        help='App config overrides, as a JSON object.')
+    parser.add_argument('--output', help='Write the report to this file.')
+    args = parser.parse_args(argv)
+
+    results = run(args.url, args.devices, args.rate, args.readers,
+                  args.duration, args.fleet_readings, args.seed, args.config,
+                  args.summary)
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+Rows per second of the two ways to dump readings: the marshmallow path,
+a dict and a datetime per row through ReadingSerializer(many=True), and
+the precompiled RowEncoder used by the readings GETs.
+
+    python -m benchmarks.serialization --rows 200000
+"""
+import argparse
+import random
+import time
+from datetime import datetime
+
+from app.api.serializers import ReadingSerializer, RowEncoder
+
+FIELDS = ['device_uuid', 'type', 'value']
+
+
+def make_rows(count, seed=0):
+    """
+    Returns (date_created, device_uuid, type, value) tuples, as read from
+    the cursor, a reading a minute over the last `count` minutes.
+    """
+    rng = random.Random(seed)
+    now = int(time.time())
+    return [(now - 60 * (count - i), 'device-%d' % rng.randrange(100),
+             rng.choice(['temperature', 'humidity']), rng.randint(0, 100))
+            for i in range(count)]
+
+
+def marshmallow_dump(rows):
+    rows_dict = []
+    for date_created, device_uuid, sensor_type, value in rows:
+        rows_dict.append(dict(device_uuid=device_uuid, type=sensor_type,
+                              value=value,
+                              date_created=datetime.fromtimestamp(
+                                  date_created)))
+    return ReadingSerializer(many=True).dump(rows_dict)
+
+
+def encoder_dump(rows):
+    return RowEncoder().encode_many(rows)
+
+
+def rows_per_second(dump, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        dump(rows)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(rows) / best
+
+
+def run(count=100000, repeat=3, seed=0):
+    rows = make_rows(count, seed)
+    if marshmallow_dump(rows) != encoder_dump(rows):
+        raise AssertionError('Both paths must dump the same readings')
+    return dict(
+        rows=count,
+        marshmallow_rows_per_sec=rows_per_second(marshmallow_dump, rows,
+                                                 repeat),
+        encoder_rows_per_sec=rows_per_second(encoder_dump, rows, repeat),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    result = run(args.rows, args.repeat)
+    for path in ('marshmallow', 'encoder'):
+        print('{:<12} {:>12,.0f} rows/s'.format(
+            path, result[path + '_rows_per_sec']))
+    print('speedup      {:>12.1f}x'.format(
+        result['encoder_rows_per_sec'] / result['marshmallow_rows_per_sec']))
+
+
+if __name__ == '__main__':
+    main()
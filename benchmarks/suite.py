@@ -0,0 +1,262 @@
+"""
+Benchmarks of ingest, readings GETs, every metric and the summary, over a
+generated fleet, through the Flask test client (http.*) and straight at
+the database layer (db.*).
+
+    python -m benchmarks.suite --devices 10000 --readings 1000 \
+        --output results.json --baseline baseline.json
+
+Results are written as JSON. Given a baseline, every case whose median
+got slower by more than --threshold is reported and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+from app import create_app
+from app import histograms, rollups
+from app.api.readings import MetricsDeviceView
+from app.db import get_db, init_db
+from app.ingest import write_readings
+
+from benchmarks.fleet import device_uuids, load_fleet
+
+Case = namedtuple('Case', 'name rows run')
+
+BATCH_SIZE = 1000
+
+
+class Fleet():
+    """
+    An app holding a generated fleet, with the state benchmark cases need.
+    """
+
+    def __init__(self, app, devices, seed):
+        self.app = app
+        self.client = app.test_client()
+        self.devices = device_uuids(devices)
+        self.rng = random.Random(seed)
+
+    def device(self):
+        return self.rng.choice(self.devices)
+
+    def readings(self, count, device_uuid=None):
+        now = int(time.time())
+        return [[device_uuid or self.device(),
+                 self.rng.choice(['temperature', 'humidity']),
+                 self.rng.randint(0, 100), now]
+                for _ in range(count)]
+
+    def get(self, url):
+        response = self.client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError('GET {} answered {}'.format(
+                url, response.status_code))
+        return response
+
+    def post(self, url, data):
+        response = self.client.post(url, data=json.dumps(data))
+        if response.status_code not in (201, 202):
+            raise RuntimeError('POST {} answered {}'.format(
+                url, response.status_code))
+        return response
+
+
+def http_cases(fleet):
+    def metric(name):
+        return lambda: fleet.get(
+            '/devices/{}/readings/{}'.format(fleet.device(), name))
+
+    def reading():
+        data = dict(type='temperature', value=fleet.rng.randint(0, 100))
+        fleet.post('/devices/{}/readings'.format(fleet.device()), data)
+
+    def batch():
+        rows = fleet.readings(BATCH_SIZE)
+        data = [dict(device_uuid=d, type=t, value=v) for d, t, v, _ in rows]
+        fleet.post('/readings/batch', data)
+
+    cases = [
+        Case('http.readings', None, lambda: fleet.get(
+            '/devices/{}/readings'.format(fleet.device()))),
+        Case('http.readings.page', None, lambda: fleet.get(
+            '/devices/{}/readings?limit=100'.format(fleet.device()))),
+    ]
+    for name in MetricsDeviceView.METRICS:
+        if name != 'summary':
+            cases.append(Case('http.' + name, None, metric(name)))
+    cases += [
+        Case('http.summary', None, lambda: fleet.get(
+            '/devices/{}/readings/summary'.format(fleet.device()))),
+        Case('http.ingest', 1, reading),
+        Case('http.ingest.batch', BATCH_SIZE, batch),
+    ]
+    return cases
+
+
+def db_cases(fleet):
+    def readings():
+        get_db().execute(
+            'SELECT date_created, device_uuid, type, value FROM readings'
+            ' WHERE device_uuid = ?', (fleet.device(),)).fetchall()
+
+    def summary():
+        for _ in histograms.device_value_counts([get_db()], None, None,
+                                                None):
+            pass
+
+    return [
+        Case('db.readings', None, readings),
+        Case('db.aggregate', None, lambda: rollups.aggregate(
+            get_db(), fleet.device(), None, None, None)),
+        Case('db.value_counts', None, lambda: histograms.value_counts(
+            get_db(), fleet.device(), None, None, None)),
+        Case('db.summary', None, summary),
+        Case('db.ingest.batch', BATCH_SIZE, lambda: write_readings(
+            get_db(), fleet.readings(BATCH_SIZE))),
+    ]
+
+
+def time_case(case, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        case.run()
+        timings.append(time.perf_counter() - started)
+    median = statistics.median(timings)
+    result = dict(
+        runs=repeat,
+        median_ms=median * 1000,
+        min_ms=min(timings) * 1000,
+        max_ms=max(timings) * 1000,
+    )
+    if case.rows:
+        result['rows_per_sec'] = case.rows / median
+    return result
+
+
+def run(devices=100, readings=1000, days=30, repeat=10, seed=0,
+        only=None, config=None):
+    """
+    Generates a fleet in a temporary database and times every case, or
+    only those whose name starts with one of `only`. Returns the results.
+    """
+    directory = tempfile.mkdtemp()
+    app_config = {
+        'DATABASE': os.path.join(directory, 'bench.db'),
+        'METRICS_CACHE': None,
+    }
+    app_config.update(config or {})
+    app = create_app(app_config)
+    results = dict(
+        config=dict(devices=devices, readings=readings, days=days,
+                    repeat=repeat, seed=seed,
+                    app={k: v for k, v in app_config.items()
+                         if k != 'DATABASE'}),
+        cases={},
+    )
+    try:
+        with app.app_context():
+            init_db()
+            started = time.perf_counter()
+            load_fleet(devices, readings, days=days, seed=seed)
+            elapsed = time.perf_counter() - started
+            results['load'] = dict(seconds=elapsed,
+                                   rows_per_sec=devices * readings / elapsed)
+
+            fleet = Fleet(app, devices, seed)
+            # Reads first, so ingest cases don't grow the fleet under them
+            for case in db_cases(fleet) + http_cases(fleet):
+                if only and not case.name.startswith(tuple(only)):
+                    continue
+                results['cases'][case.name] = time_case(case, repeat)
+    finally:
+        extension = app.extensions.get('write_behind')
+        if extension is not None:
+            extension.stop()
+        shutil.rmtree(directory)
+    return results
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Returns the cases whose median is more than `threshold` (a fraction)
+    slower than in the baseline, as (name, baseline_ms, median_ms) tuples.
+    """
+    regressions = []
+    for name, result in results['cases'].items():
+        before = baseline['cases'].get(name)
+        if before is None:
+            continue
+        if result['median_ms'] > before['median_ms'] * (1 + threshold):
+            regressions.append((name, before['median_ms'],
+                                result['median_ms']))
+    return regressions
+
+
+def report(results, baseline=None):
+    baseline_cases = (baseline or {}).get('cases', {})
+    print('{:<24} {:>12} {:>12} {:>14} {:>10}'.format(
+        'case', 'median ms', 'min ms', 'rows/s', 'change'))
+    for name, result in results['cases'].items():
+        change = ''
+        if name in baseline_cases:
+            ratio = result['median_ms'] / baseline_cases[name]['median_ms']
+            change = '{:+.0%}'.format(ratio - 1)
+        rows = result.get('rows_per_sec')
+        print('{:<24} {:>12.2f} {:>12.2f} {:>14} {:>10}'.format(
+            name, result['median_ms'], result['min_ms'],
+            '{:,.0f}'.format(rows) if rows else '', change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--readings', type=int, default=1000,
+                        help='Readings per device.')
+    parser.add_argument('--days', type=int, default=30,
+                        help='Days the readings are spread over.')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', action='append',
+                        help='Only run the cases starting with this.')
+    parser.add_argument('--config', type=json.loads, default={},
+                        help='App config overrides, as a JSON object.')
+    parser.add_argument('--output', help='Write the results to this file.')
+    parser.add_argument('--baseline', help='Results to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown reported as a regression, 0.2 = 20%%.')
+    args = parser.parse_args(argv)
+
+    results = run(args.devices, args.readings, args.days, args.repeat,
+                  args.seed, args.only, args.config)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if baseline is None:
+        return 0
+    if baseline['config'] != results['config']:
+        print('Warning: the baseline was run with another config.',
+              file=sys.stderr)
+    regressions = compare(results, baseline, args.threshold)
+    for name, before, after in regressions:
+        print('REGRESSION {}: {:.2f} ms -> {:.2f} ms'.format(
+            name, before, after), file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Speedup of the fleet summary computed on worker processes over the serial
+path, on a generated fleet.
+
+    python -m benchmarks.summary --devices 10000 --readings 100 --workers 1 2 4
+
+Every worker count runs against the same database, and has to return the
+same summaries as the serial path.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from app import create_app
+from app.db import init_db
+
+from benchmarks.fleet import load_fleet
+
+URL = '/devices/any/readings/summary'
+
+
+def time_summary(app, repeat):
+    client = app.test_client()
+    # The first one starts the worker processes
+    data = client.get(URL).data
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        client.get(URL)
+        timings.append(time.perf_counter() - started)
+    return json.loads(data), statistics.median(timings)
+
+
+def run(devices=1000, readings=100, workers=(1, 2, 4), repeat=3, seed=0):
+    directory = tempfile.mkdtemp()
+    config = {
+        'DATABASE': os.path.join(directory, 'summary.db'),
+        'METRICS_CACHE': None,
+        'INSTRUMENTATION': False,
+    }
+    try:
+        serial = create_app(config)
+        with serial.app_context():
+            init_db()
+            load_fleet(devices, readings, seed=seed)
+        expected, serial_seconds = time_summary(serial, repeat)
+        results = dict(devices=devices, readings=readings,
+                       serial_ms=serial_seconds * 1000, workers={})
+
+        for count in workers:
+            app = create_app(dict(config, SUMMARY_WORKERS=count))
+            try:
+                summaries, seconds = time_summary(app, repeat)
+            finally:
+                app.extensions['summary_pool'].close()
+            if summaries != expected:
+                raise AssertionError('Both paths must return the same '
+                                     'summaries')
+            results['workers'][count] = dict(
+                median_ms=seconds * 1000, speedup=serial_seconds / seconds)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--readings', type=int, default=100,
+                        help='Readings per device.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    results = run(args.devices, args.readings, args.workers, args.repeat)
+    print('{:<10} {:>10.1f} ms'.format('serial', results['serial_ms']))
+    for count, result in results['workers'].items():
+        print('{:<10} {:>10.1f} ms {:>6.2f}x'.format(
+            '{} workers'.format(count), result['median_ms'],
+            result['speedup']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+import asyncio
+import http.client
+import json
+import socket
+import sqlite3
+import threading
+import time
+import unittest
+from unittest import mock
+
+from app import app, create_app
+from app.aio import AioServer
+from app.db import init_db
+from tests import test_sensor_routes
+
+
+class Response():
+    def __init__(self, response):
+        self.status_code = response.status
+        self.headers = response.headers
+        self.data = response.read()
+        self.mimetype = (response.getheader('Content-Type') or '').split(
+            ';')[0]
+        self.is_streamed = response.getheader('Transfer-Encoding') == 'chunked'
+
+
+class Client():
+    """
+    Just enough of the Flask test client to run the route tests over HTTP.
+    """
+
+    def __init__(self, port):
+        self.port = port
+
+    def open(self, method, url, data=None, content_type=None, headers=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        headers = dict(headers or {})
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        try:
+            conn.request(method, url, body=data, headers=headers)
+            return Response(conn.getresponse())
+        finally:
+            conn.close()
+
+    def get(self, url, **kwargs):
+        return self.open('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.open('POST', url, data, **kwargs)
+
+
+class Loop():
+    """
+    An AioServer of `flask_app` on an event loop running in a thread.
+    """
+
+    def __init__(self, flask_app):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        self.server = AioServer(flask_app)
+        self.listening = self.call(self.server.start('127.0.0.1', 0))
+        self.port = self.listening.sockets[0].getsockname()[1]
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def cancel_connections(self):
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def close_listening(self):
+        self.listening.close()
+        await self.listening.wait_closed()
+
+    def stop(self):
+        self.call(self.close_listening())
+        # Executor threads hand their last chunks to the running loop
+        self.server.close()
+        self.call(self.cancel_connections())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class AioSensorRoutesTestCases(test_sensor_routes.SensorRoutesTestCases):
+    """
+    The route tests, against the asyncio front end.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Loop(app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.client = lambda: Client(self.server.port)
+
+
+class AioServerTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+        self.app = create_app({'TESTING': True, 'AIO_MAX_BODY_SIZE': 1024})
+        self.server = Loop(self.app)
+        self.addCleanup(self.server.stop)
+        self.client = Client(self.server.port)
+
+    def count(self, device_uuid):
+        conn = sqlite3.connect('test_database.db')
+        try:
+            return conn.execute('SELECT COUNT(*) FROM readings'
+                                ' WHERE device_uuid = ?',
+                                (device_uuid,)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_trickling_upload_does_not_block_others(self):
+        # Given a device sending its body a few bytes at a time
+        body = json.dumps(dict(type='temperature', value=50)).encode()
+        slow = socket.create_connection(('127.0.0.1', self.server.port))
+        self.addCleanup(slow.close)
+        slow.sendall(b'POST /devices/slow/readings HTTP/1.1\r\n'
+                     b'Host: localhost\r\nContent-Length: %d\r\n\r\n'
+                     % len(body) + body[:5])
+
+        # Then other devices are answered meanwhile
+        started = time.perf_counter()
+        for _ in range(5):
+            request = self.client.post('/devices/fast/readings',
+                                       data=json.dumps(dict(
+                                           type='temperature', value=1)))
+            self.assertEqual(request.status_code, 201)
+        self.assertLess(time.perf_counter() - started, 5)
+        self.assertEqual(self.count('fast'), 5)
+
+        # And the slow upload completes once its body is in
+        slow.sendall(body[5:])
+        self.assertIn(b'201 CREATED', slow.recv(4096))
+        self.assertEqual(self.count('slow'), 1)
+
+    def test_read_timeout_is_per_read(self):
+        self.server.server.read_timeout = 0.3
+        body = json.dumps(dict(type='temperature', value=50)).encode()
+        slow = socket.create_connection(('127.0.0.1', self.server.port))
+        self.addCleanup(slow.close)
+        slow.sendall(b'POST /devices/slow/readings HTTP/1.1\r\n'
+                     b'Host: localhost\r\nContent-Length: %d\r\n\r\n'
+                     % len(body))
+        # A body arriving slowly but steadily, well past the timeout
+        for i in range(0, len(body), 4):
+            slow.sendall(body[i:i + 4])
+            time.sleep(0.05)
+        self.assertIn(b'201 CREATED', slow.recv(4096))
+
+        # A connection going idle mid-body gets a 408
+        idle = socket.create_connection(('127.0.0.1', self.server.port))
+        self.addCleanup(idle.close)
+        idle.sendall(b'POST /devices/idle/readings HTTP/1.1\r\n'
+                     b'Host: localhost\r\nContent-Length: %d\r\n\r\n'
+                     % len(body) + body[:5])
+        idle.settimeout(5)
+        # Then the connection is closed
+        response = b''
+        while True:
+            data = idle.recv(4096)
+            if not data:
+                break
+            response += data
+        self.assertIn(b'408 REQUEST TIMEOUT', response)
+        self.assertEqual(self.count('idle'), 0)
+
+    def test_wsgi_write(self):
+        def legacy(environ, start_response):
+            write = start_response('200 OK', [('Content-Type',
+                                               'text/plain')])
+            write(b'written ')
+            return [b'returned']
+
+        sent = []
+        with mock.patch.object(self.server.server, 'app', legacy):
+            self.server.server.run_wsgi({}, sent.append)
+        self.assertEqual(sent, [('200 OK', [('Content-Type', 'text/plain')]),
+                                b'written ', b'returned', None])
+
+    def test_chunked_batch(self):
+        body = b'\n'.join(json.dumps(dict(
+            device_uuid='chunked', type='humidity', value=v)).encode()
+            for v in range(3))
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.port)
+        self.addCleanup(conn.close)
+        conn.request('POST', '/readings/batch', body=iter([body[:10],
+                                                          body[10:]]),
+                     headers={'Content-Type': 'application/x-ndjson'},
+                     encode_chunked=True)
+        response = conn.getresponse()
+        self.assertEqual(response.status, 201)
+        self.assertEqual(json.loads(response.read())['inserted'], 3)
+        self.assertEqual(self.count('chunked'), 3)
+
+    def test_keep_alive(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.port)
+        self.addCleanup(conn.close)
+        for value in range(3):
+            conn.request('POST', '/devices/kept/readings',
+                         body=json.dumps(dict(type='humidity', value=value)))
+            response = conn.getresponse()
+            response.read()
+            self.assertEqual(response.status, 201)
+        conn.request('GET', '/devices/kept/readings')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(len(json.loads(response.read())), 3)
+
+    def test_body_too_large(self):
+        request = self.client.post('/readings/batch', data='[' + ' ' * 2000
+                                   + ']')
+        self.assertEqual(request.status_code, 413)
+
+    def test_connection_limit(self):
+        self.server.server.max_connections = 0
+        request = self.client.get('/devices/any/readings')
+        self.assertEqual(request.status_code, 503)
+        self.assertEqual(self.server.server.rejected, 1)
+
+    def test_write_behind(self):
+        write_behind = create_app({'TESTING': True, 'WRITE_BEHIND': True})
+        self.addCleanup(write_behind.extensions['write_behind'].stop)
+        server = Loop(write_behind)
+        self.addCleanup(server.stop)
+        client = Client(server.port)
+        data = json.dumps(dict(type='temperature', value=3))
+        request = client.post('/devices/buffered/readings?durable=true',
+                              data=data)
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(self.count('buffered'), 1)
+        request = client.post('/devices/buffered/readings', data=data)
+        self.assertEqual(request.status_code, 202)
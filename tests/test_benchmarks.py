@@ -0,0 +1,39 @@
+import unittest
+
+from benchmarks import suite, summary
+from benchmarks.fleet import generate_fleet
+
+
+class BenchmarkTestCases(unittest.TestCase):
+
+    def test_fleet_is_seeded(self):
+        first = [row for rows in generate_fleet(20, 30, end=10 ** 9, seed=1,
+                                                chunk_size=100)
+                 for row in rows]
+        again = [row for rows in generate_fleet(20, 30, end=10 ** 9, seed=1)
+                 for row in rows]
+        self.assertEqual(len(first), 600)
+        self.assertEqual(first, again)
+        self.assertTrue(all(0 <= row[2] <= 100 for row in first))
+
+    def test_suite_runs_every_case(self):
+        results = suite.run(devices=5, readings=20, repeat=1)
+        self.assertIn('http.summary', results['cases'])
+        self.assertIn('db.ingest.batch', results['cases'])
+        self.assertIn('http.quartiles', results['cases'])
+        self.assertGreater(
+            results['cases']['http.ingest.batch']['rows_per_sec'], 0)
+
+    def test_summary_workers_match_serial(self):
+        results = summary.run(devices=10, readings=20, workers=(1,),
+                              repeat=1)
+        self.assertGreater(results['workers'][1]['speedup'], 0)
+
+    def test_slower_cases_are_regressions(self):
+        baseline = dict(cases={'http.max': dict(median_ms=10),
+                               'http.min': dict(median_ms=10)})
+        results = dict(cases={'http.max': dict(median_ms=13),
+                              'http.min': dict(median_ms=11),
+                              'http.mean': dict(median_ms=50)})
+        self.assertEqual(suite.compare(results, baseline, 0.2),
+                         [('http.max', 10, 13)])
@@ -0,0 +1,188 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from app import app
+from app.cache import MISS, LocalCache, SqliteCache
+from app.db import init_db
+
+
+class LocalCacheTestCases(unittest.TestCase):
+
+    def make_cache(self, **kwargs):
+        return LocalCache(**kwargs)
+
+    def test_get_and_set(self):
+        cache = self.make_cache()
+        self.assertIs(cache.get('a', 'k1'), MISS)
+        cache.set('a', 'k1', {'value': 1}, cache.generation('a'))
+        self.assertEqual(cache.get('a', 'k1'), {'value': 1})
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = self.make_cache(max_size=2)
+        cache.set('a', 'k1', 1, 0)
+        cache.set('a', 'k2', 2, 0)
+        cache.get('a', 'k1')
+        cache.set('a', 'k3', 3, 0)
+        self.assertIs(cache.get('a', 'k2'), MISS)
+        self.assertEqual(cache.get('a', 'k1'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        cache = self.make_cache(ttl=0.05)
+        cache.set('a', 'k1', 1, 0)
+        time.sleep(0.1)
+        self.assertIs(cache.get('a', 'k1'), MISS)
+
+    def test_invalidate_only_drops_the_device(self):
+        cache = self.make_cache()
+        cache.set('a', 'k1', 1, 0)
+        cache.set('b', 'k2', 2, 0)
+        cache.readings_written([['a', 'temperature', 10, 0]])
+        self.assertIs(cache.get('a', 'k1'), MISS)
+        self.assertEqual(cache.get('b', 'k2'), 2)
+
+    def test_stale_result_is_not_stored(self):
+        # Given a result computed before a write landed
+        cache = self.make_cache()
+        generation = cache.generation('a')
+        cache.invalidate(['a'])
+
+        # When it is stored
+        cache.set('a', 'k1', 1, generation)
+
+        # Then it is dropped
+        self.assertIs(cache.get('a', 'k1'), MISS)
+
+
+class LocalCacheBookkeepingTestCases(unittest.TestCase):
+
+    def test_bookkeeping_is_bounded(self):
+        cache = LocalCache(max_size=10)
+        for i in range(100):
+            device_uuid = 'device-%d' % i
+            generation = cache.generation(device_uuid)
+            cache.set(device_uuid, 'k%d' % i, i, generation)
+            cache.invalidate([device_uuid])
+            cache.set(device_uuid, 'k%d' % i, i, generation)
+            self.assertIs(cache.get(device_uuid, 'k%d' % i), MISS)
+            cache.set(device_uuid, 'k%d' % i, i,
+                      cache.generation(device_uuid))
+        self.assertEqual(len(cache.entries), 10)
+        self.assertEqual(len(cache.device_keys), 10)
+        self.assertEqual(len(cache.generations), 10)
+
+        # A device whose generation was dropped still rejects stale results
+        generation = cache.generation('device-0')
+        cache.invalidate(['device-0'])
+        cache.set('device-0', 'k0', 0, generation)
+        self.assertIs(cache.get('device-0', 'k0'), MISS)
+
+    def test_stale_result_is_not_stored_after_clear(self):
+        cache = LocalCache()
+        generation = cache.generation('a')
+        cache.clear()
+        cache.set('a', 'k1', 1, generation)
+        self.assertIs(cache.get('a', 'k1'), MISS)
+
+
+class SqliteCacheTestCases(LocalCacheTestCases):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def make_cache(self, **kwargs):
+        return SqliteCache(self.path, **kwargs)
+
+    def test_shared_between_instances(self):
+        first = self.make_cache()
+        second = self.make_cache()
+        first.set('a', 'k1', {'value': 1}, 0)
+        self.assertEqual(second.get('a', 'k1'), {'value': 1})
+        second.invalidate(['a'])
+        self.assertIs(first.get('a', 'k1'), MISS)
+
+    def test_busy_file_does_not_fail_invalidation(self):
+        cache = self.make_cache()
+        cache.set('a', 'k1', {'value': 1}, 0)
+        writer = sqlite3.connect(self.path, isolation_level=None)
+        writer.execute('BEGIN IMMEDIATE')
+        try:
+            cache.invalidate(['a'])
+        finally:
+            writer.execute('ROLLBACK')
+            writer.close()
+        self.assertEqual(cache.stats()['failed_invalidations'], 1)
+        self.assertFalse(cache.db.in_transaction)
+        # The cache is usable again once the file is free
+        cache.invalidate(['a'])
+        self.assertIs(cache.get('a', 'k1'), MISS)
+
+
+class MetricsCacheTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+
+        now = int(time.time())
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)', [
+            ('device_a', 'temperature', 20, now - 100),
+            ('device_b', 'temperature', 30, now - 100),
+        ])
+        conn.commit()
+        conn.close()
+
+        self.client = app.test_client
+
+    def get_max(self, device_uuid):
+        response = self.client().get(
+            '/devices/{}/readings/max?type=temperature'.format(device_uuid))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)['value']
+
+    def cache_stats(self):
+        response = self.client().get('/stats')
+        return json.loads(response.data)['metrics_cache']
+
+    def test_repeated_metric_is_served_from_cache(self):
+        self.get_max('device_a')
+        hits = self.cache_stats()['hits']
+        self.assertEqual(self.get_max('device_a'), 20)
+        self.assertEqual(self.cache_stats()['hits'], hits + 1)
+
+    def test_post_invalidates_only_that_device(self):
+        # Given both devices cached
+        self.get_max('device_a')
+        self.get_max('device_b')
+
+        # When device_a gets a higher reading
+        response = self.client().post(
+            '/devices/device_a/readings',
+            data=json.dumps({'type': 'temperature', 'value': 90}))
+        self.assertEqual(response.status_code, 201)
+
+        # Then device_a is recomputed and device_b still comes from cache
+        hits = self.cache_stats()['hits']
+        self.assertEqual(self.get_max('device_a'), 90)
+        self.assertEqual(self.cache_stats()['hits'], hits)
+        self.assertEqual(self.get_max('device_b'), 30)
+        self.assertEqual(self.cache_stats()['hits'], hits + 1)
+
+    def test_batch_invalidates_its_devices(self):
+        self.get_max('device_b')
+        response = self.client().post('/readings/batch', data=json.dumps([
+            {'device_uuid': 'device_b', 'type': 'temperature', 'value': 80},
+        ]))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.get_max('device_b'), 80)
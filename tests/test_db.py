@@ -0,0 +1,155 @@
+import sqlite3
+import threading
+import unittest
+
+from flask import request
+
+from app import app
+from app.db import ConnectionPool, init_db, migrate_db
+
+
+class ConnectionPoolTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+
+        self.pool = ConnectionPool('test_database.db', size=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_connections_are_configured(self):
+        conn = self.pool.acquire()
+        self.assertEqual(
+            conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        # NORMAL
+        self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+        self.assertEqual(
+            conn.execute('PRAGMA busy_timeout').fetchone()[0], 5000)
+        self.assertEqual(
+            conn.execute('PRAGMA cache_size').fetchone()[0], -20000)
+        self.pool.release(conn)
+
+    def test_connections_are_reused(self):
+        conn = self.pool.acquire()
+        conn.execute('INSERT INTO readings VALUES ("a", "temperature", 1, 1)')
+        self.pool.release(conn)
+
+        # The open transaction is rolled back before reuse
+        self.assertIs(self.pool.acquire(), conn)
+        self.assertEqual(
+            conn.execute('SELECT COUNT(*) FROM readings').fetchone()[0], 0)
+        self.pool.release(conn)
+        self.assertEqual(self.pool.stats()['created'], 1)
+
+    def test_overflow_connections_are_closed(self):
+        conns = [self.pool.acquire() for _ in range(3)]
+        for conn in conns:
+            self.pool.release(conn)
+        self.assertEqual(self.pool.stats()['idle'], 2)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conns[-1].execute('SELECT 1')
+
+    def test_threaded_writers(self):
+        errors = []
+
+        def write():
+            try:
+                for i in range(50):
+                    conn = self.pool.acquire()
+                    with conn:
+                        conn.execute('INSERT INTO readings VALUES '
+                                     '("a", "temperature", ?, ?)', (i, i))
+                    self.pool.release(conn)
+            except sqlite3.Error as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        conn = self.pool.acquire()
+        self.assertEqual(
+            conn.execute('SELECT COUNT(*) FROM readings').fetchone()[0], 400)
+        self.pool.release(conn)
+
+
+class SchemaTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+
+    def query_plan(self, url):
+        from app.api.readings import DeviceView
+        from app.api.serializers import QueryReadingsSerializer
+
+        with app.test_request_context(url):
+            view = DeviceView()
+            valid_data = QueryReadingsSerializer().load(request.args)
+            query, params = view.build_query('test_device', valid_data)
+            rows = view.db.execute('EXPLAIN QUERY PLAN ' + query, params)
+            return ' '.join(r['detail'] for r in rows)
+
+    def test_readings_queries_use_covering_index(self):
+        urls = [
+            '/devices/test_device/readings',
+            '/devices/test_device/readings?type=temperature',
+            '/devices/test_device/readings?type=temperature'
+            + '&date_from=2020-01-01&date_to=2020-02-01',
+        ]
+        for url in urls:
+            plan = self.query_plan(url)
+            self.assertIn('USING COVERING INDEX readings_device_type_date',
+                          plan, url)
+            self.assertNotIn('SCAN', plan, url)
+
+    def test_readings_pages_are_ordered_by_index(self):
+        from app.api.readings import DeviceView
+
+        with app.test_request_context('/'):
+            view = DeviceView()
+            for valid_data in ({}, {'type': 'temperature'}):
+                query, params = view.build_query('test_device', valid_data)
+                query += (' AND (date_created, rowid) > (?, ?)'
+                          ' ORDER BY date_created, rowid LIMIT ?')
+                rows = view.db.execute('EXPLAIN QUERY PLAN ' + query,
+                                       params + [0, 0, 10])
+                plan = ' '.join(r['detail'] for r in rows)
+                self.assertIn('USING INDEX readings_device_date', plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_summary_scan_is_ordered_by_index(self):
+        from app.api.readings import DeviceView
+
+        with app.test_request_context('/'):
+            view = DeviceView()
+            query, params = view.build_query(None, {}, 'device_uuid, value')
+            rows = view.db.execute(
+                'EXPLAIN QUERY PLAN ' + query + ' ORDER BY device_uuid',
+                params)
+            plan = ' '.join(r['detail'] for r in rows)
+        self.assertIn('USING COVERING INDEX readings_device_type_date', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_migrations_upgrade_ad_hoc_table(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT,'
+                     ' type TEXT, value INTEGER, date_created INTEGER)')
+        conn.execute('PRAGMA user_version = 0')
+        conn.commit()
+        conn.close()
+
+        with app.app_context():
+            applied = migrate_db()
+            self.assertEqual(applied[0], 1)
+            self.assertEqual(migrate_db(), [])
+
+        conn = sqlite3.connect('test_database.db')
+        indexes = [r[1] for r in conn.execute('PRAGMA index_list(readings)')]
+        self.assertIn('readings_device_type_date', indexes)
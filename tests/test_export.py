@@ -0,0 +1,190 @@
+import csv
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from app import app, create_app
+from app import export
+from app.api.serializers import encode_cursor
+from app.db import get_db, init_db
+from app.ingest import write_readings
+from app.rollups import DAY
+
+
+def make_readings(count, seed=4):
+    rng = random.Random(seed)
+    now = int(time.time())
+    return [
+        ['device-%d' % rng.randrange(20),
+         rng.choice(['temperature', 'humidity']),
+         rng.randint(0, 100), now - rng.randrange(0, 60 * DAY)]
+        for _ in range(count)
+    ]
+
+
+class ExportTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+
+        self.readings = make_readings(2500)
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)',
+                         self.readings)
+        conn.commit()
+        conn.close()
+
+        self.client = app.test_client
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def expected(self, sensor_type=None):
+        # Readings are inserted as (uuid, type, value, date_created)
+        return sorted((d, t, c, v) for d, t, v, c in self.readings
+                      if sensor_type in (None, t))
+
+    def parse_csv(self, text):
+        rows = list(csv.reader(io.StringIO(text)))
+        self.assertEqual(rows[0], list(export.FIELDS))
+        return [(d, t, int(c), int(v)) for d, t, c, v in rows[1:]]
+
+    def test_csv_export(self):
+        request = self.client().get('/readings/export')
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.mimetype, 'text/csv')
+        rows = self.parse_csv(request.data.decode('utf8'))
+        # In index order
+        self.assertEqual(rows, sorted(rows, key=lambda r: (r[0], r[2])))
+        self.assertEqual(sorted(rows), self.expected())
+
+    def test_ndjson_gzip_export(self):
+        request = self.client().get(
+            '/readings/export?format=ndjson&gzip=true&type=humidity')
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(request.data).decode('utf8').splitlines()
+        rows = [tuple(json.loads(line)[f] for f in export.FIELDS)
+                for line in lines]
+        self.assertEqual(sorted(rows), self.expected('humidity'))
+
+    def test_export_resumes_from_token(self):
+        url = '/readings/export?limit=700'
+        rows = []
+        pages = 0
+        while url:
+            request = self.client().get(url)
+            self.assertEqual(request.status_code, 200)
+            rows += self.parse_csv(request.data.decode('utf8'))
+            pages += 1
+            url = None
+            if 'X-Next-Cursor' in request.headers:
+                url = ('/readings/export?limit=700&after='
+                       + request.headers['X-Next-Cursor'])
+        self.assertEqual(pages, 4)
+        self.assertEqual(sorted(rows), self.expected())
+
+    def test_page_runs_to_its_boundary(self):
+        # A reading committed before the boundary, between the boundary
+        # query and the page, must not push a row past both pages
+        with app.app_context():
+            db = get_db()
+            job = export.Export([(('', 0), db)])
+            token = job.boundary(700)
+            write_readings(db, [['device-0', 'humidity', 50, 0]])
+            rows = [row for chunk, _ in job.chunks(token) for row in chunk]
+            self.assertEqual(len(rows), 701)
+            after = export.Export([(('', 0), db)], after=token)
+            rows += [row for chunk, _ in after.chunks() for row in chunk]
+        self.readings.append(['device-0', 'humidity', 50, 0])
+        self.assertEqual(sorted(rows), self.expected())
+
+    def test_invalid_token(self):
+        request = self.client().get('/readings/export?after=nope')
+        self.assertEqual(request.status_code, 400)
+        token = encode_cursor([1, 2, 'device-1', 0, 0])
+        request = self.client().get('/readings/export?after=' + token)
+        self.assertEqual(request.status_code, 400)
+
+    def test_cli_resume_without_cursor(self):
+        output = os.path.join(self.directory, 'readings.csv')
+        result = app.test_cli_runner().invoke(
+            args=['export-readings', output, '--resume'])
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('No export to resume', result.output)
+
+    def test_cli_export_resumes_after_interruption(self):
+        output = os.path.join(self.directory, 'readings.csv.gz')
+        runner = app.test_cli_runner()
+        app.config['EXPORT_CHUNK_SIZE'] = 200
+        format_rows = export.format_rows
+        calls = []
+
+        def failing(rows, fmt):
+            calls.append(1)
+            if len(calls) == 4:
+                raise RuntimeError('interrupted')
+            return format_rows(rows, fmt)
+
+        try:
+            with mock.patch('app.export.format_rows', failing):
+                result = runner.invoke(args=['export-readings', output,
+                                             '--gzip'])
+            self.assertIsInstance(result.exception, RuntimeError)
+            self.assertTrue(os.path.exists(output + '.cursor'))
+
+            result = runner.invoke(args=['export-readings', output,
+                                         '--gzip', '--resume'])
+            self.assertEqual(result.exit_code, 0, result.output)
+        finally:
+            app.config['EXPORT_CHUNK_SIZE'] = 1000
+
+        self.assertFalse(os.path.exists(output + '.cursor'))
+        with gzip.open(output, 'rt') as f:
+            rows = self.parse_csv(f.read())
+        self.assertEqual(sorted(rows), self.expected())
+
+
+class PartitionedExportTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app({
+            'TESTING': True,
+            'DATABASE': os.path.join(self.directory, 'readings.db'),
+            'DB_PARTITION_BY_MONTH': True,
+            'DB_SHARDS': 2,
+        })
+        self.readings = make_readings(1500, seed=6)
+        with self.app.app_context():
+            init_db()
+            write_readings(get_db(), self.readings,
+                           self.app.extensions['db_router'])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pages_run_across_partitions(self):
+        url = '/readings/export?format=ndjson&limit=400'
+        rows = []
+        while url:
+            request = self.app.test_client().get(url)
+            rows += [json.loads(line) for line in
+                     request.data.decode('utf8').splitlines()]
+            url = None
+            if 'X-Next-Cursor' in request.headers:
+                url = ('/readings/export?format=ndjson&limit=400&after='
+                       + request.headers['X-Next-Cursor'])
+        rows = sorted(tuple(r[f] for f in export.FIELDS) for r in rows)
+        self.assertEqual(rows, sorted((d, t, c, v)
+                                      for d, t, v, c in self.readings))
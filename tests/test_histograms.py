@@ -0,0 +1,118 @@
+import datetime
+import json
+import random
+import sqlite3
+import statistics
+import time
+import unittest
+from collections import Counter
+
+import numpy as np
+
+from app import app
+from app.db import get_db, init_db
+from app.histograms import rebuild_histograms
+from app.rollups import DAY
+from app.stats import (median_from_counts, percentile_from_counts,
+                       mean_from_counts)
+
+
+class HistogramStatsTestCases(unittest.TestCase):
+
+    def test_stats_match_numpy_and_statistics(self):
+        rng = random.Random(3)
+        for _ in range(500):
+            readings = [rng.randint(0, 100)
+                        for _ in range(rng.randint(1, 50))]
+            if rng.random() < 0.3:
+                readings.append(rng.randint(0, 99) + 0.5)
+            histogram = Counter(readings)
+            values = sorted(histogram)
+            counts = [histogram[v] for v in values]
+
+            self.assertEqual(median_from_counts(values, counts),
+                             statistics.median(readings))
+            self.assertEqual(mean_from_counts(values, counts),
+                             statistics.mean(readings))
+            for q in (25, 50, 75):
+                self.assertEqual(percentile_from_counts(values, counts, q),
+                                 np.percentile(readings, q))
+
+
+class HistogramMetricsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+
+        self.device_uuid = 'test_device'
+        rng = random.Random(11)
+        now = int(time.time())
+        self.readings = [
+            (rng.choice([self.device_uuid, 'other_uuid']),
+             rng.choice(['temperature', 'humidity']),
+             rng.randint(0, 100), now - rng.randrange(0, 10 * DAY))
+            for _ in range(3000)
+        ]
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)',
+                         self.readings)
+        conn.commit()
+        conn.close()
+
+        self.client = app.test_client
+        date_from = datetime.date.today() - datetime.timedelta(days=6)
+        date_to = datetime.date.today() - datetime.timedelta(days=2)
+        self.query = f'?date_from={date_from}&date_to={date_to}&type=humidity'
+        self.lo = int(time.mktime(
+            (date_from - datetime.timedelta(days=1)).timetuple())) + 1
+        self.hi = int(time.mktime(
+            (date_to + datetime.timedelta(days=1)).timetuple()))
+
+    def raw_values(self, device_uuid):
+        conn = sqlite3.connect('test_database.db')
+        rows = conn.execute(
+            'SELECT value FROM readings WHERE device_uuid = ? AND type = ?'
+            ' AND date_created < ? AND date_created >= ?',
+            (device_uuid, 'humidity', self.hi, self.lo)).fetchall()
+        conn.close()
+        return [r[0] for r in rows]
+
+    def get(self, metric):
+        url = f'/devices/{self.device_uuid}/readings/{metric}{self.query}'
+        request = self.client().get(url)
+        self.assertEqual(request.status_code, 200)
+        return json.loads(request.data)
+
+    def test_metrics_match_raw_readings(self):
+        values = self.raw_values(self.device_uuid)
+        self.assertEqual(self.get('median')['value'],
+                         statistics.median(values))
+        self.assertEqual(self.get('mode')['value'], statistics.mode(values))
+        quartiles = self.get('quartiles')
+        self.assertEqual(quartiles['quartile_1'], np.percentile(values, 25))
+        self.assertEqual(quartiles['quartile_3'], np.percentile(values, 75))
+
+    def test_summary_matches_raw_readings(self):
+        summaries = self.get('summary')
+        self.assertEqual(len(summaries), 2)
+        for data in summaries:
+            values = self.raw_values(data['device_uuid'])
+            self.assertEqual(data['number_of_readings'], len(values))
+            self.assertEqual(data['median_reading_value'],
+                             statistics.median(values))
+            self.assertEqual(data['mode_reading_value'],
+                             statistics.mode(values))
+            self.assertEqual(data['mean_reading_value'],
+                             statistics.mean(values))
+            self.assertEqual(data['quartile_3_value'],
+                             np.percentile(values, 75))
+
+    def test_rebuild_matches_trigger_maintained_histograms(self):
+        with app.app_context():
+            db = get_db()
+            query = 'SELECT * FROM reading_histograms ORDER BY 1, 2, 3, 4, 5'
+            maintained = [tuple(r) for r in db.execute(query)]
+            rebuild_histograms(db)
+            rebuilt = [tuple(r) for r in db.execute(query)]
+        self.assertEqual(maintained, rebuilt)
@@ -0,0 +1,132 @@
+import json
+import random
+import sqlite3
+import time
+import unittest
+from datetime import date, timedelta
+
+import numpy as np
+
+from app import app, create_app
+from app.db import get_db, init_db
+from app.hotstore import HotStore
+from app.rollups import DAY
+
+
+class HotStoreTestCases(unittest.TestCase):
+
+    def test_series_stay_in_index_order(self):
+        store = HotStore()
+        store.add([('d', 'temperature', 100, 5), ('d', 'temperature', 90, 1)])
+        # Late and same-second readings are merged in
+        store.add([('d', 'temperature', 95, 3), ('d', 'temperature', 100, 2)])
+        rows = store.rows('d', None, None, None)
+        self.assertEqual([(r['date_created'], r['value']) for r in rows],
+                         [(90, 1), (95, 3), (100, 2), (100, 5)])
+        self.assertEqual([r['date_created'] for r in
+                          store.rows('d', 'temperature', 95, 100)], [95])
+
+    def test_memory_per_million_readings(self):
+        store = HotStore()
+        rng = np.random.default_rng(3)
+        per_device = 10000
+        for device in range(100):
+            dates = np.sort(rng.integers(0, 7 * DAY, per_device))
+            values = rng.integers(0, 101, per_device)
+            # Appended in ten chunks to exercise the growth headroom
+            for chunk in range(10):
+                part = slice(chunk * 1000, (chunk + 1) * 1000)
+                store.add(zip(['device-%d' % device] * 1000,
+                              ['temperature'] * 1000,
+                              dates[part].tolist(), values[part].tolist()))
+
+        self.assertEqual(store.stats()['readings'], 10 ** 6)
+        # 16 bytes per reading plus at most 25% of headroom
+        self.assertGreaterEqual(store.memory_bytes(), 16 * 10 ** 6)
+        self.assertLessEqual(store.memory_bytes(), 20 * 10 ** 6)
+
+
+class HotStoreRoutesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+
+        self.device_uuid = 'test_device'
+        rng = random.Random(21)
+        now = int(time.time())
+        readings = [
+            (self.device_uuid, rng.choice(['temperature', 'humidity']),
+             rng.randint(0, 100), now - rng.randrange(0, 20 * DAY))
+            for _ in range(3000)
+        ]
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)', readings)
+        conn.commit()
+        conn.close()
+
+        self.hot_app = create_app({
+            'TESTING': True,
+            'HOT_STORE': True,
+            'METRICS_CACHE': None,
+        })
+        self.store = self.hot_app.extensions['hot_store']
+        self.sqlite_app = create_app({
+            'TESTING': True,
+            'METRICS_CACHE': None,
+        })
+
+    def get(self, client, url):
+        request = client.get(url)
+        self.assertEqual(request.status_code, 200, url)
+        return json.loads(request.data)
+
+    def assertSameAsSqlite(self, query):
+        hot_client = self.hot_app.test_client()
+        client = self.sqlite_app.test_client()
+        for path in ('', '/max', '/min', '/count', '/mean', '/median',
+                     '/mode', '/quartiles'):
+            url = f'/devices/{self.device_uuid}/readings{path}?{query}'
+            hot = self.get(hot_client, url)
+            expected = self.get(client, url)
+            if not path:
+                # Readings have no defined order
+                hot, expected = (sorted(sorted(r.items()) for r in hot),
+                                 sorted(sorted(r.items()) for r in expected))
+            self.assertEqual(hot, expected, url)
+
+    def test_recent_queries_are_answered_from_memory(self):
+        date_from = (date.today() - timedelta(days=3)).isoformat()
+        self.assertSameAsSqlite(f'date_from={date_from}')
+        self.assertSameAsSqlite(f'date_from={date_from}&type=humidity')
+        self.assertEqual(self.store.stats()['misses'], 0)
+        self.assertGreater(self.store.stats()['hits'], 0)
+
+    def test_older_queries_fall_back_to_sqlite(self):
+        date_from = (date.today() - timedelta(days=15)).isoformat()
+        self.assertSameAsSqlite(f'date_from={date_from}')
+        self.assertSameAsSqlite('type=temperature')
+        self.assertEqual(self.store.stats()['hits'], 0)
+
+    def test_store_catches_up_with_new_readings(self):
+        date_from = (date.today() - timedelta(days=1)).isoformat()
+        self.assertSameAsSqlite(f'date_from={date_from}')
+
+        # Written straight to SQLite, as another worker would
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('INSERT INTO readings VALUES (?,?,?,?)',
+                     (self.device_uuid, 'temperature', 100, int(time.time())))
+        conn.commit()
+        conn.close()
+
+        self.assertSameAsSqlite(f'date_from={date_from}')
+        url = (f'/devices/{self.device_uuid}/readings/max'
+               f'?date_from={date_from}')
+        self.assertEqual(self.get(self.hot_app.test_client(), url)['value'],
+                         100)
+
+    def test_old_readings_are_not_loaded(self):
+        with self.hot_app.app_context():
+            self.store.refresh(get_db())
+        self.assertLess(self.store.stats()['readings'], 3000)
+        self.assertGreater(self.store.stats()['readings'], 0)
@@ -0,0 +1,95 @@
+import json
+import sqlite3
+import time
+import unittest
+from unittest import mock
+
+from app import app, create_app
+from app.db import init_db
+from app.api import readings
+from app.instrumentation import Histogram
+
+
+class HistogramTestCases(unittest.TestCase):
+
+    def test_buckets_are_cumulative(self):
+        histogram = Histogram('latency', 'Latency.', ('endpoint',), (1, 5))
+        for amount in (0.5, 1, 3, 10):
+            histogram.observe(('a',), amount)
+        lines = histogram.render()
+        self.assertIn('latency_bucket{endpoint="a",le="1"} 2', lines)
+        self.assertIn('latency_bucket{endpoint="a",le="5"} 3', lines)
+        self.assertIn('latency_bucket{endpoint="a",le="+Inf"} 4', lines)
+        self.assertIn('latency_sum{endpoint="a"} 14.5', lines)
+        self.assertIn('latency_count{endpoint="a"} 4', lines)
+
+
+class MetricsEndpointTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)', [
+            ('test_device', 'temperature', value, int(time.time()))
+            for value in (10, 20, 20)])
+        conn.commit()
+        conn.close()
+        self.app = create_app({'TESTING': True, 'METRICS_CACHE': None})
+        self.client = self.app.test_client()
+
+    def test_phases_are_exposed_as_histograms(self):
+        self.client.get('/devices/test_device/readings')
+        self.client.get('/devices/test_device/readings/mode')
+        request = self.client.get('/metrics')
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.mimetype, 'text/plain')
+        text = request.data.decode('utf8')
+
+        self.assertIn('readings_request_seconds_count{endpoint="api.readings"'
+                      ',method="GET",status="200"} 1', text)
+        for phase in ('db_connect', 'sql', 'serialize', 'jsonify'):
+            self.assertIn('readings_phase_seconds_count{endpoint='
+                          '"api.readings",phase="%s"} 1' % phase, text)
+        self.assertIn('readings_phase_rows_sum{endpoint="api.readings",'
+                      'phase="sql"} 3', text)
+        self.assertIn('readings_phase_seconds_count{endpoint='
+                      '"api.root_device",phase="stats"} 1', text)
+
+    def test_disabled(self):
+        disabled = create_app({'TESTING': True, 'INSTRUMENTATION': False})
+        request = disabled.test_client().get('/metrics')
+        self.assertEqual(request.status_code, 404)
+        request = disabled.test_client().get(
+            '/devices/test_device/readings/count')
+        self.assertEqual(json.loads(request.data)['value'], 3)
+
+    def test_streamed_response_is_timed_to_its_end(self):
+        encode_many = readings.ROW_ENCODER.encode_many
+
+        def slow(rows):
+            time.sleep(0.1)
+            return encode_many(rows)
+
+        with mock.patch.object(readings.ROW_ENCODER, 'encode_many', slow):
+            request = self.client.get(
+                '/devices/test_device/readings?stream=ndjson')
+            self.assertEqual(len(request.data.splitlines()), 3)
+            request.close()
+        text = self.client.get('/metrics').data.decode('utf8')
+        seconds = [float(line.split()[-1]) for line in text.splitlines()
+                   if line.startswith('readings_request_seconds_sum{'
+                                      'endpoint="api.readings"')]
+        self.assertGreaterEqual(seconds, [0.1])
+        self.assertIn('readings_phase_rows_sum{endpoint="api.readings",'
+                      'phase="sql"} 3', text)
+        self.assertIn('readings_phase_seconds_count{endpoint='
+                      '"api.readings",phase="serialize"} 1', text)
+
+    def test_json_logs(self):
+        logged = create_app({'TESTING': True, 'JSON_LOGS': True})
+        with self.assertLogs('app.requests') as logs:
+            logged.test_client().get('/devices/test_device/readings/max')
+        record = logs.records[0]
+        self.assertEqual(record.status, 200)
+        self.assertIn('sql', record.phases)
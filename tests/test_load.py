@@ -0,0 +1,31 @@
+import unittest
+
+from benchmarks import load
+
+
+class LoadTestCases(unittest.TestCase):
+
+    def test_recorder_counts_errors_and_locks(self):
+        recorder = load.Recorder()
+        recorder.record('GET /x', 0.010, 200)
+        recorder.record('GET /x', 0.020, 500,
+                        b'{"error": "database is locked"}')
+        recorder.record('GET /x', 0.030, None)
+        recorder.record('GET /x', 0.040, 200)
+        result = recorder.summary(2.0)['GET /x']
+        self.assertEqual(result['requests'], 4)
+        self.assertEqual(result['throughput'], 2.0)
+        self.assertEqual(result['error_rate'], 0.5)
+        self.assertEqual(result['lock_rate'], 0.25)
+        self.assertAlmostEqual(result['p50_ms'], 25)
+
+    def test_local_run_reports_every_endpoint(self):
+        results = load.run(devices=50, rate=50, readers=2, duration=1,
+                           fleet_readings=10)
+        endpoints = results['endpoints']
+        posts = endpoints['POST /devices/<uuid>/readings']
+        self.assertGreaterEqual(posts['requests'], 45)
+        self.assertEqual(posts['error_rate'], 0)
+        self.assertIn('GET /devices/<uuid>/readings', endpoints)
+        for result in endpoints.values():
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
@@ -0,0 +1,80 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import date
+
+from app import create_app
+from app.db import get_db, get_router, init_db
+from app.ingest import write_readings
+from app.parallel import device_shard
+
+from benchmarks.fleet import load_fleet
+
+
+class ParallelSummaryTestCases(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.apps = {}
+        for partitioned in (False, True):
+            config = {
+                'TESTING': True,
+                'DATABASE': os.path.join(cls.directory, '{}.db'.format(
+                    'partitioned' if partitioned else 'readings')),
+                'DB_PARTITION_BY_MONTH': partitioned,
+                'DB_SHARDS': 3 if partitioned else 1,
+            }
+            serial = create_app(config)
+            with serial.app_context():
+                init_db()
+                load_fleet(40, 30, days=60, seed=1)
+                # Ties between modes, broken by insertion order
+                now = int(time.time())
+                write_readings(get_db(), [
+                    ['tie', 'temperature', 30, now],
+                    ['tie', 'humidity', 10, now],
+                    ['tie', 'humidity', 20, now - 5],
+                    ['tie', 'humidity', 30, now - 5],
+                ], get_router())
+            config['SUMMARY_WORKERS'] = 2
+            cls.apps[partitioned] = (serial, create_app(config))
+
+    @classmethod
+    def tearDownClass(cls):
+        for _, parallel in cls.apps.values():
+            parallel.extensions['summary_pool'].close()
+        shutil.rmtree(cls.directory)
+
+    def get(self, app, query=''):
+        request = app.test_client().get(
+            '/devices/any/readings/summary' + query)
+        self.assertEqual(request.status_code, 200)
+        return json.loads(request.data)
+
+    def test_same_summaries_as_serial(self):
+        today = date.today()
+        for partitioned, (serial, parallel) in self.apps.items():
+            for query in ('', '?type=humidity',
+                          '?date_from={}'.format(today.replace(day=1)),
+                          '?type=temperature&date_to={}'.format(today),
+                          '?top=5', '?limit=7&type=humidity'):
+                expected = self.get(serial, query)
+                self.assertTrue(expected)
+                self.assertEqual(self.get(parallel, query), expected,
+                                 (partitioned, query))
+
+    def test_pool_stats(self):
+        _, parallel = self.apps[False]
+        self.get(parallel)
+        stats = parallel.test_client().get('/stats').json['summary_pool']
+        self.assertEqual(stats['workers'], 2)
+        self.assertTrue(stats['started'])
+        self.assertGreater(stats['shards'], 0)
+
+    def test_device_shard(self):
+        self.assertEqual({device_shard('device-%d' % i, 4)
+                          for i in range(100)}, {0, 1, 2, 3})
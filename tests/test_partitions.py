@@ -0,0 +1,184 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import date, timedelta
+
+from app import create_app
+from app.db import FrozenPartition, PartitionRouter, get_db, init_db
+from app.ingest import write_readings
+from app.rollups import DAY
+
+
+class PartitionRouterTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.router = PartitionRouter(
+            os.path.join(self.directory, 'readings.db'),
+            os.path.join(os.path.dirname(__file__), '..', 'app'),
+            by_month=True, shards=4)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_rows_are_routed_by_month_and_shard(self):
+        october = 1790812800  # 2026-10-01 UTC
+        month, shard = self.router.key('device', october)
+        self.assertEqual(month, '202610')
+        self.assertEqual(self.router.key('device', october - 1),
+                         ('202609', shard))
+        self.assertTrue(self.router.path((month, shard)).endswith(
+            'readings.202610.s{}.db'.format(shard)))
+
+    def test_range_queries_only_overlapping_partitions(self):
+        october = 1790812800
+        rows = [['device', 'temperature', 10, october - 10 * DAY],
+                ['device', 'temperature', 20, october + 10 * DAY],
+                ['other', 'temperature', 30, october + 10 * DAY]]
+        write_readings(None, rows, self.router)
+        shard = self.router.shard('device')
+
+        self.assertEqual(self.router.route('device', october, None),
+                         [('202610', shard)])
+        self.assertEqual(self.router.route('device', None, october),
+                         [('202609', shard)])
+        self.assertEqual(len(self.router.route('device', None, None)), 2)
+        self.assertEqual(len(self.router.route(None, october, None)),
+                         len({shard, self.router.shard('other')}))
+
+    def test_frozen_partitions_reject_writes(self):
+        october = 1790812800
+        write_readings(None, [['device', 'temperature', 10, october]],
+                       self.router)
+        key = self.router.key('device', october)
+        self.router.freeze(key)
+
+        self.assertTrue(self.router.is_frozen(key))
+        with self.assertRaises(FrozenPartition):
+            write_readings(None, [['device', 'humidity', 10, october]],
+                           self.router)
+        pool = self.router.pool(key)
+        conn = pool.acquire()
+        self.assertEqual(
+            conn.execute('SELECT COUNT(*) FROM readings').fetchone()[0], 1)
+        pool.release(conn)
+
+
+class PartitionedRoutesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.partitioned = create_app({
+            'TESTING': True,
+            'DATABASE': os.path.join(self.directory, 'partitioned.db'),
+            'DB_PARTITION_BY_MONTH': True,
+            'DB_SHARDS': 3,
+            'METRICS_CACHE': None,
+        })
+        self.single = create_app({
+            'TESTING': True,
+            'DATABASE': os.path.join(self.directory, 'single.db'),
+            'METRICS_CACHE': None,
+        })
+
+        rng = random.Random(8)
+        now = int(time.time())
+        self.devices = ['device-%d' % i for i in range(6)]
+        rows = [
+            [rng.choice(self.devices), rng.choice(['temperature', 'humidity']),
+             rng.randint(0, 100), now - rng.randrange(0, 100 * DAY)]
+            for _ in range(4000)
+        ]
+        for app in (self.partitioned, self.single):
+            with app.app_context():
+                init_db()
+                router = app.extensions.get('db_router')
+                write_readings(get_db(), rows, router)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get(self, app, url):
+        request = app.test_client().get(url)
+        self.assertEqual(request.status_code, 200, url)
+        return json.loads(request.data)
+
+    def assertSameAnswers(self, url):
+        partitioned = self.get(self.partitioned, url)
+        single = self.get(self.single, url)
+        if '/readings?' in url:
+            # Readings have no defined order
+            partitioned = sorted(sorted(r.items()) for r in partitioned)
+            single = sorted(sorted(r.items()) for r in single)
+        self.assertEqual(partitioned, single, url)
+
+    def test_partitioned_answers_match_single_file(self):
+        router = self.partitioned.extensions['db_router']
+        self.assertGreater(len(router.keys()), 3)
+
+        date_from = (date.today() - timedelta(days=40)).isoformat()
+        for query in ('', f'date_from={date_from}', 'type=humidity'):
+            for path in ('', '/max', '/min', '/count', '/mean', '/median',
+                         '/mode', '/quartiles', '/summary'):
+                self.assertSameAnswers(
+                    f'/devices/device-1/readings{path}?{query}')
+
+    def test_pages_run_across_partitions(self):
+        url = '/devices/device-2/readings?limit=100'
+        readings = []
+        while url:
+            request = self.partitioned.test_client().get(url)
+            readings += json.loads(request.data)
+            url = None
+            if 'X-Next-Cursor' in request.headers:
+                url = ('/devices/device-2/readings?limit=100&cursor='
+                       + request.headers['X-Next-Cursor'])
+
+        expected = self.get(self.single, '/devices/device-2/readings')
+        self.assertEqual(len(readings), len(expected))
+        dates = [r['date_created'] for r in readings]
+        self.assertEqual(dates, sorted(dates))
+
+    def test_post_goes_to_current_partition(self):
+        request = self.partitioned.test_client().post(
+            '/devices/device-9/readings',
+            data=json.dumps({'type': 'temperature', 'value': 42}))
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(self.get(self.partitioned,
+                                  '/devices/device-9/readings/max')['value'],
+                         42)
+
+    def test_freeze_command(self):
+        month = date.today().replace(day=1).isoformat()[:7]
+        runner = self.partitioned.test_cli_runner()
+        result = runner.invoke(args=['freeze-partitions', month])
+        self.assertIn('Froze', result.output)
+
+        router = self.partitioned.extensions['db_router']
+        frozen = [key for key in router.keys() if router.is_frozen(key)]
+        self.assertTrue(frozen)
+        self.assertTrue(all(key[0] < month.replace('-', '')
+                            for key in frozen))
+        # Frozen partitions are still read
+        self.assertSameAnswers('/devices/device-1/readings/count')
+
+    def test_rebuild_command_covers_every_partition(self):
+        router = self.partitioned.extensions['db_router']
+        for key in router.keys():
+            pool = router.pool(key)
+            conn = pool.acquire()
+            with conn:
+                conn.execute('DELETE FROM reading_rollups')
+                conn.execute('DELETE FROM reading_histograms')
+            pool.release(conn)
+
+        runner = self.partitioned.test_cli_runner()
+        result = runner.invoke(args=['rebuild-rollups'])
+        self.assertIn('of {} partitions'.format(len(router.keys())),
+                      result.output)
+        for path in ('/count', '/mean', '/median', '/summary'):
+            self.assertSameAnswers(f'/devices/device-1/readings{path}')
@@ -0,0 +1,121 @@
+import datetime
+import json
+import random
+import sqlite3
+import statistics
+import time
+import unittest
+
+from app import app
+from app.db import get_db, init_db
+from app.rollups import DAY, HOUR, MINUTE, split_range, rebuild_rollups
+
+
+class SplitRangeTestCases(unittest.TestCase):
+
+    def test_open_range_is_whole_days(self):
+        self.assertEqual(split_range(None, None), [(DAY, None, None)])
+
+    def test_edges_use_finer_buckets(self):
+        pieces = split_range(DAY - HOUR - 30, 2 * DAY + MINUTE + 5)
+        self.assertEqual(pieces, [
+            (None, DAY - HOUR - 30, DAY - HOUR),
+            (HOUR, 23, 24),
+            (DAY, 1, 2),
+            (MINUTE, 2 * DAY // MINUTE, 2 * DAY // MINUTE + 1),
+            (None, 2 * DAY + MINUTE, 2 * DAY + MINUTE + 5),
+        ])
+
+    def test_pieces_cover_the_range(self):
+        for _ in range(100):
+            lo = random.randrange(0, 10 * DAY)
+            hi = lo + random.randrange(0, 5 * DAY)
+            covered = []
+            for resolution, start, end in split_range(lo, hi):
+                if resolution is None:
+                    covered.append((start, end))
+                else:
+                    covered.append((start * resolution, end * resolution))
+            self.assertEqual(sum(end - start for start, end in covered),
+                             hi - lo)
+            for (_, end), (start, _) in zip(covered, covered[1:]):
+                self.assertEqual(end, start)
+
+
+class RollupMetricsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+
+        self.device_uuid = 'test_device'
+        rng = random.Random(7)
+        now = int(time.time())
+        self.readings = [
+            (self.device_uuid, rng.choice(['temperature', 'humidity']),
+             rng.randint(0, 100), now - rng.randrange(0, 10 * DAY))
+            for _ in range(2000)
+        ]
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)',
+                         self.readings)
+        conn.commit()
+        conn.close()
+
+        self.client = app.test_client
+
+    def raw_values(self, lo, hi, sensor_type=None):
+        return [r[2] for r in self.readings
+                if lo <= r[3] < hi
+                and (sensor_type is None or r[1] == sensor_type)]
+
+    def test_metrics_match_raw_readings(self):
+        today = datetime.date.today()
+        for days_from, days_to, sensor_type in [(8, 2, None),
+                                                (5, 5, 'humidity'),
+                                                (20, 0, 'temperature')]:
+            date_from = today - datetime.timedelta(days=days_from)
+            date_to = today - datetime.timedelta(days=days_to)
+            lo = int(time.mktime(
+                (date_from - datetime.timedelta(days=1)).timetuple())) + 1
+            hi = int(time.mktime(
+                (date_to + datetime.timedelta(days=1)).timetuple()))
+            values = self.raw_values(lo, hi, sensor_type)
+
+            query = f'?date_from={date_from}&date_to={date_to}'
+            if sensor_type:
+                query += f'&type={sensor_type}'
+            url = f'/devices/{self.device_uuid}/readings/'
+            get = lambda m: json.loads(self.client().get(url + m + query).data)
+
+            self.assertEqual(get('count')['value'], len(values))
+            self.assertEqual(get('max')['value'], max(values))
+            self.assertEqual(get('min')['value'], min(values))
+            self.assertEqual(get('mean')['value'], statistics.mean(values))
+
+    def test_extreme_ties_are_broken_by_insertion_order(self):
+        now = int(time.time())
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)', [
+            ('tie', 'temperature', 100, now),
+            ('tie', 'humidity', 100, now),
+            ('tie', 'humidity', 0, now),
+            ('tie', 'temperature', 0, now),
+        ])
+        conn.commit()
+        conn.close()
+        url = '/devices/tie/readings/'
+        for metric, sensor_type in (('max', 'temperature'),
+                                    ('min', 'humidity')):
+            data = json.loads(self.client().get(url + metric).data)
+            self.assertEqual(data['type'], sensor_type, metric)
+
+    def test_rebuild_matches_trigger_maintained_rollups(self):
+        with app.app_context():
+            db = get_db()
+            query = 'SELECT * FROM reading_rollups ORDER BY 1, 2, 3, 4'
+            maintained = [tuple(r) for r in db.execute(query)]
+            rebuild_rollups(db)
+            rebuilt = [tuple(r) for r in db.execute(query)]
+        self.assertEqual(len(maintained), len(rebuilt))
+        self.assertEqual(maintained, rebuilt)
@@ -8,15 +8,17 @@ import sqlite3
 import time
 import unittest
 
-from app import app
+from app import app, create_app
+from app.api.serializers import encode_cursor
+from app.db import init_db
 
 class SensorRoutesTestCases(unittest.TestCase):
 
     def setUp(self):
         # Setup the SQLite DB
+        with app.app_context():
+            init_db()
         conn = sqlite3.connect('test_database.db')
-        conn.execute('DROP TABLE IF EXISTS readings')
-        conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
         
         self.device_uuid = 'test_device'
 
@@ -243,6 +245,25 @@ class SensorRoutesTestCases(unittest.TestCase):
             self.assertEqual("Multiple Modes",
                              json.loads(request.data)['value'])
 
+    def test_device_readings_mode_ties_follow_insertion_order(self):
+        # Given two modes in the same second, 10 inserted first
+        conn = sqlite3.connect('test_database.db')
+        now = int(time.time())
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)',
+                         [('tie_device', 'temperature', 10, now),
+                          ('tie_device', 'humidity', 20, now)])
+        conn.commit()
+        conn.close()
+
+        # Then every path picks it, whether or not the range is in memory
+        today = datetime.date.today().isoformat()
+        hot_app = create_app({'TESTING': True, 'HOT_STORE': True})
+        for client in (self.client(), hot_app.test_client()):
+            for query in ('', f'?date_from={today}'):
+                url = f'/devices/tie_device/readings/mode{query}'
+                request = client.get(url)
+                self.assertEqual(json.loads(request.data)['value'], 10, url)
+
     def test_device_readings_quartiles(self):
         """
         This test should be implemented. The goal is to test that
@@ -312,3 +333,184 @@ class SensorRoutesTestCases(unittest.TestCase):
             rows = cur.fetchall()
 
             self.assertEqual(data['number_of_readings'], len(rows))
+
+    def test_device_readings_batch_post(self):
+        # Given a batch of readings for a device
+        data = [
+            {'type': 'temperature', 'value': 10},
+            {'type': 'humidity', 'value': 20},
+        ]
+        # When we post it to the batch endpoint
+        request = self.client().post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=json.dumps(data))
+
+        # Then we should receive a 201 and every reading inserted
+        self.assertEqual(request.status_code, 201)
+        json_data = json.loads(request.data)
+        self.assertEqual(json_data['inserted'], 2)
+        self.assertEqual(json_data['errors'], [])
+
+        conn = sqlite3.connect('test_database.db')
+        cur = conn.cursor()
+        cur.execute('select count(*) from readings where device_uuid = ?',
+                    (self.device_uuid,))
+        self.assertEqual(cur.fetchone()[0], 5)
+
+    def test_device_readings_batch_ndjson_partial(self):
+        # Given an NDJSON batch with one invalid reading and one bad line
+        body = '\n'.join([
+            json.dumps({'type': 'temperature', 'value': 10}),
+            json.dumps({'type': 'pressure', 'value': 10}),
+            '{not json',
+            json.dumps({'type': 'humidity', 'value': 30}),
+        ])
+        request = self.client().post(
+            f'/devices/{self.device_uuid}/readings/batch', data=body,
+            content_type='application/x-ndjson')
+
+        # Then the valid readings are stored and the bad ones reported
+        self.assertEqual(request.status_code, 201)
+        json_data = json.loads(request.data)
+        self.assertEqual(json_data['inserted'], 2)
+        self.assertEqual([e['index'] for e in json_data['errors']], [1, 2])
+
+    def test_fleet_readings_batch_post(self):
+        # Given a batch mixing several devices
+        data = [
+            {'device_uuid': 'a', 'type': 'temperature', 'value': 10},
+            {'device_uuid': 'b', 'type': 'temperature', 'value': 20},
+            {'type': 'temperature', 'value': 20},
+        ]
+        request = self.client().post('/readings/batch', data=json.dumps(data))
+        self.assertEqual(request.status_code, 201)
+        json_data = json.loads(request.data)
+        self.assertEqual(json_data['inserted'], 2)
+        self.assertIn('device_uuid', json_data['errors'][0]['errors'])
+
+        # And a batch with no valid readings is rejected
+        request = self.client().post('/readings/batch', data='[{}]')
+        self.assertEqual(request.status_code, 400)
+
+        # And so is a body that isn't UTF-8
+        request = self.client().post('/readings/batch', data=b'\xff\xfe')
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_max_returns_reading(self):
+        # The max is the whole reading, not only its value
+        url = f'/devices/{self.device_uuid}/readings/max?type=temperature'
+        request = self.client().get(url)
+        self.assertEqual(request.status_code, 200)
+        json_data = json.loads(request.data)
+        self.assertEqual(json_data['value'], 100)
+        self.assertEqual(json_data['device_uuid'], self.device_uuid)
+        self.assertEqual(json_data['type'], 'temperature')
+        self.assertIn('date_created', json_data)
+
+        # And no readings means no value
+        url = f'/devices/{self.device_uuid}/readings/max?type=humidity'
+        request = self.client().get(url)
+        self.assertEqual(json.loads(request.data), {'value': None})
+
+    def test_device_readings_count(self):
+        url = f'/devices/{self.device_uuid}/readings/count'
+        request = self.client().get(url)
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(json.loads(request.data)['value'], 3)
+
+    def test_device_readings_unknown_metric(self):
+        url = f'/devices/{self.device_uuid}/readings/build_query'
+        request = self.client().get(url)
+        self.assertEqual(request.status_code, 404)
+
+    def test_summary_per_device_values(self):
+        """
+        Every summary is computed from its own device readings and the
+        list is sorted by number of readings.
+        """
+        url = f'/devices/{self.device_uuid}/readings/summary'
+        request = self.client().get(url)
+        self.assertEqual(request.status_code, 200)
+        json_data = json.loads(request.data)
+        self.assertEqual([d['device_uuid'] for d in json_data],
+                         [self.device_uuid, 'other_uuid'])
+
+        conn = sqlite3.connect('test_database.db')
+        for data in json_data:
+            rows = conn.execute('SELECT value FROM readings '
+                                + 'WHERE device_uuid = ?',
+                                (data['device_uuid'],)).fetchall()
+            values = [r[0] for r in rows]
+            self.assertEqual(data['number_of_readings'], len(values))
+            self.assertEqual(data['max_reading_value'], max(values))
+            self.assertEqual(data['min_reading_value'], min(values))
+            self.assertEqual(data['mean_reading_value'],
+                             statistics.mean(values))
+            self.assertEqual(data['median_reading_value'],
+                             statistics.median(values))
+            self.assertEqual(data['mode_reading_value'],
+                             statistics.mode(values))
+            self.assertEqual(data['quartile_1_value'],
+                             np.percentile(values, 25))
+            self.assertEqual(data['quartile_3_value'],
+                             np.percentile(values, 75))
+
+    def test_summary_filtered_by_type(self):
+        url = f'/devices/{self.device_uuid}/readings/summary?type=humidity'
+        request = self.client().get(url)
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(json.loads(request.data), [])
+
+    def test_device_readings_get_stream(self):
+        # Given the readings streamed as a JSON array, in several chunks
+        app.config['STREAM_CHUNK_SIZE'] = 2
+        self.addCleanup(app.config.__setitem__, 'STREAM_CHUNK_SIZE', 1000)
+        url = f'/devices/{self.device_uuid}/readings?stream=json'
+        request = self.client().get(url)
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue(request.is_streamed)
+        streamed = json.loads(request.data)
+
+        # Then they are the same as the plain response
+        url = f'/devices/{self.device_uuid}/readings'
+        expected = json.loads(self.client().get(url).data)
+        self.assertEqual(streamed, expected)
+
+        # And NDJSON gives one reading per line
+        url = f'/devices/{self.device_uuid}/readings?stream=ndjson'
+        request = self.client().get(url)
+        self.assertEqual(request.mimetype, 'application/x-ndjson')
+        lines = request.data.decode('utf8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], expected)
+
+        # And an empty result is still a valid JSON array
+        url = (f'/devices/{self.device_uuid}/readings'
+               '?stream=json&type=humidity')
+        self.assertEqual(json.loads(self.client().get(url).data), [])
+
+    def test_device_readings_get_pages(self):
+        # Given pages of two readings
+        url = f'/devices/{self.device_uuid}/readings?limit=2'
+        pages = []
+        while url:
+            request = self.client().get(url)
+            self.assertEqual(request.status_code, 200)
+            pages.append(json.loads(request.data))
+            link = request.headers.get('Link')
+            url = link[1:link.index('>')] if link else None
+
+        # Then every reading is returned once, oldest first
+        self.assertEqual([len(page) for page in pages], [2, 1])
+        values = [r['value'] for page in pages for r in page]
+        self.assertEqual(values, [22, 50, 100])
+
+    def test_device_readings_get_invalid_cursor(self):
+        url = f'/devices/{self.device_uuid}/readings?limit=2&cursor=nope'
+        request = self.client().get(url)
+        self.assertEqual(request.status_code, 400)
+
+        # A well formed cursor holding anything but integers too
+        url = (f'/devices/{self.device_uuid}/readings?limit=2&cursor='
+               + encode_cursor(['a', 'b']))
+        request = self.client().get(url)
+        self.assertEqual(request.status_code, 400)
@@ -0,0 +1,36 @@
+import random
+import unittest
+from datetime import datetime
+
+from marshmallow import Schema, fields
+
+from app.api.serializers import ReadingSerializer, RowEncoder
+
+
+class RowEncoderTestCases(unittest.TestCase):
+
+    def test_matches_reading_serializer(self):
+        rng = random.Random(5)
+        # Random instants over five years, so days and DST changes vary
+        rows = [(rng.randrange(1500000000, 1660000000),
+                 'device-%d' % rng.randrange(10),
+                 rng.choice(['temperature', 'humidity']),
+                 rng.choice([rng.randint(0, 100), rng.random() * 100]))
+                for _ in range(5000)]
+        rows += sorted(rows)
+        expected = ReadingSerializer(many=True).dump([
+            dict(device_uuid=d, type=t, value=v,
+                 date_created=datetime.fromtimestamp(c))
+            for c, d, t, v in rows])
+        self.assertEqual(RowEncoder().encode_many(rows), expected)
+
+    def test_schema_is_checked_up_front(self):
+        class Changed(ReadingSerializer):
+            date_created = fields.DateTime()
+
+        class Extended(ReadingSerializer):
+            unit = fields.String()
+
+        for schema in (Changed(), Extended(), Schema()):
+            with self.assertRaises(TypeError):
+                RowEncoder(schema)
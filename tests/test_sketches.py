@@ -0,0 +1,113 @@
+import json
+import random
+import sqlite3
+import time
+import unittest
+
+import numpy as np
+
+from app import app
+from app.db import init_db
+from app.rollups import DAY
+from app.sketches import KLLSketch
+
+# Documented rank error bound for k = 200
+MAX_RANK_ERROR = 0.015
+
+
+class KLLSketchTestCases(unittest.TestCase):
+
+    def assertRankError(self, sketch, data):
+        data = np.sort(data)
+        for q in (0.1, 0.25, 0.5, 0.75, 0.9):
+            value = sketch.quantile(q)
+            exact = np.percentile(data, q * 100)
+            rank = np.searchsorted(data, value) / len(data)
+            exact_rank = np.searchsorted(data, exact) / len(data)
+            self.assertLessEqual(abs(rank - exact_rank), MAX_RANK_ERROR,
+                                 (q, value, exact))
+
+    def test_quantiles_match_numpy(self):
+        rng = np.random.default_rng(5)
+        for data in (rng.normal(50, 15, 100000),
+                     rng.integers(0, 101, 100000),
+                     rng.exponential(10, 50000)):
+            sketch = KLLSketch(200)
+            sketch.extend(data.tolist())
+            self.assertEqual(sketch.n, len(data))
+            self.assertRankError(sketch, data)
+
+    def test_merged_sketches_match_numpy(self):
+        rng = np.random.default_rng(9)
+        data = rng.normal(50, 15, 100000)
+        sketch = KLLSketch(200)
+        for i, part in enumerate(np.array_split(data, 300)):
+            partial = KLLSketch(200, seed=i)
+            partial.extend(part.tolist())
+            sketch.merge(KLLSketch.from_bytes(partial.to_bytes()))
+        self.assertEqual(sketch.n, len(data))
+        self.assertRankError(sketch, data)
+        # And the merged sketch stays small
+        self.assertLess(sum(len(c) for c in sketch.compactors), 1000)
+
+    def test_small_sketch_is_exact(self):
+        sketch = KLLSketch(200)
+        sketch.extend([5, 1, 3])
+        self.assertEqual(sketch.quantile(0.5), 3)
+        self.assertIsNone(KLLSketch(200).quantile(0.5))
+
+
+class ApproxMetricsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+
+        self.device_uuid = 'test_device'
+        rng = random.Random(13)
+        now = int(time.time())
+        readings = [
+            (self.device_uuid, 'temperature', rng.randint(0, 100),
+             now - rng.randrange(0, 30 * DAY))
+            for _ in range(20000)
+        ]
+        self.values = np.sort([r[2] for r in readings])
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)', readings)
+        conn.commit()
+        conn.close()
+
+        self.client = app.test_client
+
+    def rank(self, value):
+        return np.searchsorted(self.values, value) / len(self.values)
+
+    def test_approx_median_and_quartiles(self):
+        url = f'/devices/{self.device_uuid}/readings/median?approx=true'
+        median = json.loads(self.client().get(url).data)['value']
+        self.assertLessEqual(
+            abs(self.rank(median) - self.rank(np.median(self.values))),
+            MAX_RANK_ERROR)
+
+        url = f'/devices/{self.device_uuid}/readings/quartiles?approx=true'
+        quartiles = json.loads(self.client().get(url).data)
+        self.assertLessEqual(
+            abs(self.rank(quartiles['quartile_1'])
+                - self.rank(np.percentile(self.values, 25))),
+            MAX_RANK_ERROR)
+
+        # Closed buckets are stored for the next query
+        conn = sqlite3.connect('test_database.db')
+        stored = conn.execute(
+            'SELECT COUNT(*) FROM reading_sketches').fetchone()[0]
+        self.assertGreater(stored, 0)
+
+        # And a late reading drops the sketches of its buckets
+        conn.execute('INSERT INTO readings VALUES (?,?,?,?)',
+                     (self.device_uuid, 'temperature', 1,
+                      int(time.time()) - 10 * DAY))
+        conn.commit()
+        self.assertEqual(conn.execute(
+            'SELECT COUNT(*) FROM reading_sketches').fetchone()[0],
+            stored - 2)
+        conn.close()
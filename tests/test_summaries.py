@@ -0,0 +1,239 @@
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from app import app, create_app
+from app.db import get_db, init_db, migrate_db
+from app.histograms import device_value_counts
+from app.rollups import DAY
+from app.summaries import device_counts, diff_summaries, top_devices
+
+
+class DeviceSummaryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+        rng = random.Random(5)
+        now = int(time.time())
+        self.readings = [
+            (rng.choice(['a', 'b', 'c']),
+             rng.choice(['temperature', 'humidity']),
+             rng.choice([rng.randint(0, 100), rng.randint(0, 99) + 0.5]),
+             now - rng.randrange(0, 40 * DAY))
+            for _ in range(2000)
+        ]
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)',
+                         self.readings)
+        conn.commit()
+        conn.close()
+        self.client = app.test_client()
+
+    def summary(self, query=''):
+        request = self.client.get('/devices/a/readings/summary' + query)
+        self.assertEqual(request.status_code, 200)
+        return json.loads(request.data)
+
+    def test_trigger_keeps_the_summary(self):
+        conn = sqlite3.connect('test_database.db')
+        row = conn.execute('SELECT count, sum, min, max FROM device_summary'
+                           ' WHERE device_uuid = ? AND type = ?',
+                           ('a', 'humidity')).fetchone()
+        values = [v for d, t, v, _ in self.readings
+                  if d == 'a' and t == 'humidity']
+        self.assertEqual(row[0], len(values))
+        self.assertAlmostEqual(row[1], sum(values))
+        self.assertEqual(row[2:], (min(values), max(values)))
+        with app.app_context():
+            self.assertEqual(list(diff_summaries(get_db())), [])
+
+    def test_unfiltered_summary_reads_the_summary_table(self):
+        with app.app_context():
+            db = get_db()
+            whole = list(device_value_counts([db], None, None, None))
+            # The same histograms as the day buckets over the whole history
+            buckets = list(device_value_counts([db], None, 0, None))
+        self.assertEqual(whole, buckets)
+
+        # A summary row is all the unfiltered summary looks at
+        conn = sqlite3.connect('test_database.db')
+        conn.execute("UPDATE device_summary_values SET count = count + 1000"
+                     " WHERE device_uuid = 'a' AND type = 'humidity'"
+                     " AND value = (SELECT MIN(value)"
+                     " FROM device_summary_values WHERE device_uuid = 'a'"
+                     " AND type = 'humidity')")
+        conn.commit()
+        conn.close()
+        summaries = {s['device_uuid']: s for s in self.summary()}
+        filtered = {s['device_uuid']: s for s in self.summary('?date_from='
+                                                              '1970-01-02')}
+        self.assertEqual(summaries['a']['number_of_readings'],
+                         filtered['a']['number_of_readings'] + 1000)
+        self.assertEqual(summaries['b'], filtered['b'])
+
+    def test_check_and_repair(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute("DELETE FROM device_summary WHERE device_uuid = 'b'")
+        conn.execute("UPDATE device_summary_values SET count = 0"
+                     " WHERE device_uuid = 'c'")
+        conn.execute("INSERT INTO device_summary_values"
+                     " VALUES ('z', 'humidity', 1, 1)")
+        conn.commit()
+        conn.close()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['check-summaries', '--show', '1000'])
+        self.assertEqual(result.exit_code, 1, result.output)
+        self.assertIn("device_summary ['b', 'humidity']: stored None",
+                      result.output)
+        self.assertIn("device_summary_values ['z', 'humidity', 1]: "
+                      "stored (1,), expected None", result.output)
+
+        result = runner.invoke(args=['check-summaries', '--repair'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('rebuilt', result.output)
+        result = runner.invoke(args=['check-summaries'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+    def test_migration_backfills_the_summary(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.executescript('''
+            DROP TRIGGER readings_device_summary;
+            DROP TABLE device_summary;
+            DROP TABLE device_summary_values;
+            PRAGMA user_version = 6;
+        ''')
+        conn.close()
+        with app.app_context():
+            self.assertEqual(migrate_db(), [7])
+            self.assertEqual(list(diff_summaries(get_db())), [])
+
+
+class SummaryPageTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+        now = int(time.time())
+        # Ties on counts between b and c, and d and e
+        readings = []
+        for device_uuid, count in (('a', 3), ('b', 5), ('c', 5), ('d', 1),
+                                   ('e', 1), ('f', 4)):
+            for i in range(count):
+                sensor_type = ('temperature', 'humidity')[i % 2]
+                readings.append((device_uuid, sensor_type, 10 + i,
+                                 now - i * 10 * DAY))
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)', readings)
+        conn.commit()
+        conn.close()
+        self.client = app.test_client()
+
+    def get(self, query, status=200):
+        request = self.client.get('/devices/any/readings/summary' + query)
+        self.assertEqual(request.status_code, status)
+        return request
+
+    def walk(self, query):
+        pages = []
+        request = self.get(query)
+        pages.append(json.loads(request.data))
+        while 'Link' in request.headers:
+            url = request.headers['Link'][1:].split('>;')[0]
+            self.assertIn('cursor=' + request.headers['X-Next-Cursor'], url)
+            request = self.client.get(url)
+            self.assertEqual(request.status_code, 200)
+            pages.append(json.loads(request.data))
+        return pages
+
+    def test_top(self):
+        for query in ('', 'type=humidity&', 'date_from=1970-01-02&',
+                      'date_to={}&'.format(
+                          time.strftime('%Y-%m-%d',
+                                        time.localtime(time.time() - 25
+                                                       * DAY)))):
+            summaries = json.loads(self.get('?' + query).data)
+            request = self.get('?{}top=3'.format(query))
+            self.assertEqual(json.loads(request.data), summaries[:3], query)
+            self.assertNotIn('Link', request.headers)
+        self.assertEqual([s['device_uuid'] for s in json.loads(
+            self.get('?top=100').data)], ['b', 'c', 'f', 'a', 'd', 'e'])
+
+    def test_pages(self):
+        for query in ('', 'type=temperature&', 'date_from=1970-01-02&'):
+            summaries = json.loads(self.get('?' + query).data)
+            for limit in (1, 2, 4, 6, 10):
+                pages = self.walk('?{}limit={}'.format(query, limit))
+                self.assertEqual(sum(pages, []), summaries, (query, limit))
+                self.assertTrue(all(len(page) == limit
+                                    for page in pages[:-1]))
+
+    def test_invalid(self):
+        self.get('?top=2&limit=2', 400)
+        self.get('?top=0', 400)
+        self.get('?limit=2&cursor=bad', 400)
+        # A readings cursor isn't a summary cursor
+        self.get('?limit=2&cursor=WzEsMl0', 400)
+
+    def test_top_devices(self):
+        counts = iter([('a', 3), ('b', 5), ('c', 5), ('d', 1)])
+        self.assertEqual(top_devices(counts, 2), [('b', 5), ('c', 5)])
+        counts = iter([('a', 3), ('b', 5), ('c', 5), ('d', 1)])
+        self.assertEqual(top_devices(counts, 2, after=(5, 'b')),
+                         [('c', 5), ('a', 3)])
+        with app.app_context():
+            self.assertEqual(
+                list(device_counts([get_db()], 'humidity', None, None)),
+                [('a', 1), ('b', 2), ('c', 2), ('f', 2)])
+
+
+class PartitionedDeviceSummaryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app({
+            'TESTING': True,
+            'DATABASE': os.path.join(self.directory, 'readings.db'),
+            'DB_PARTITION_BY_MONTH': True,
+            'DB_SHARDS': 2,
+        })
+        with self.app.app_context():
+            init_db()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_summary_spans_partitions(self):
+        client = self.app.test_client()
+        now = int(time.time())
+        data = [dict(device_uuid=d, type='temperature', value=v)
+                for d in ('a', 'b') for v in (10, 20, 20)]
+        client.post('/readings/batch', data=json.dumps(data))
+        with self.app.app_context():
+            from app.db import get_partition_db, get_router
+            router = get_router()
+            # An older reading in last month's partitions
+            key = router.key('a', now - 40 * DAY)
+            db = get_partition_db(key)
+            with db:
+                db.execute('INSERT INTO readings VALUES (?,?,?,?)',
+                           ('a', 'temperature', 30, now - 40 * DAY))
+
+        summaries = json.loads(client.get(
+            '/devices/a/readings/summary').data)
+        self.assertEqual([(s['device_uuid'], s['number_of_readings'])
+                          for s in summaries], [('a', 4), ('b', 3)])
+        result = self.app.test_cli_runner().invoke(args=['check-summaries'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        request = client.get('/devices/a/readings/summary?limit=1')
+        self.assertEqual(json.loads(request.data), summaries[:1])
+        request = client.get(request.headers['Link'][1:].split('>;')[0])
+        self.assertEqual(json.loads(request.data), summaries[1:])
+        self.assertNotIn('Link', request.headers)
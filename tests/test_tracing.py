@@ -0,0 +1,116 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from app import app, create_app
+from app.db import get_db, init_db
+
+
+class TracingTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)', [
+            ('test_device', 'temperature', value, int(time.time()))
+            for value in (10, 20, 20)])
+        conn.commit()
+        conn.close()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'query_stats.db')
+        self.app = create_app({
+            'TESTING': True,
+            'METRICS_CACHE': None,
+            'DB_TRACE': True,
+            'DB_SLOW_QUERY_MS': 0,
+            'DB_TRACE_PATH': self.path,
+        })
+        self.tracer = self.app.extensions['query_tracer']
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def aggregates(self):
+        return {row[0]: row for row in self.tracer.read('count', 100)}
+
+    def test_slow_statements_are_logged_with_plan_and_endpoint(self):
+        with self.assertLogs('app.queries', 'WARNING') as logs:
+            request = self.client.get('/devices/test_device/readings')
+        self.assertEqual(request.status_code, 200)
+        records = [r for r in logs.records if 'FROM readings' in r.sql]
+        self.assertTrue(records)
+        record = records[0]
+        self.assertEqual(record.endpoint, 'api.readings')
+        self.assertEqual(record.rows, 3)
+        self.assertTrue(record.plan)
+        self.assertIn('readings', ' '.join(record.plan))
+
+    def test_fast_statements_are_not_logged(self):
+        self.tracer.slow = 60.0
+        with self.assertNoLogs('app.queries', 'WARNING'):
+            self.client.get('/devices/test_device/readings')
+        self.assertEqual(self.tracer.slow_statements, 0)
+        self.assertGreater(self.tracer.statements, 0)
+
+    def test_aggregates_per_statement(self):
+        with self.assertLogs('app.queries'):
+            for _ in range(3):
+                self.client.get('/devices/test_device/readings')
+        aggregates = self.aggregates()
+        selects = [row for sql, row in aggregates.items()
+                   if sql.startswith('SELECT') and 'FROM readings' in sql]
+        self.assertTrue(selects)
+        sql, count, seconds, max_seconds, rows, steps, slow = selects[0]
+        self.assertEqual(count, 3)
+        self.assertEqual(rows, 9)
+        self.assertGreaterEqual(seconds, max_seconds)
+        self.assertEqual(slow, 3)
+
+    def test_writes_count_changed_rows(self):
+        with self.app.app_context(), self.assertLogs('app.queries'):
+            db = get_db()
+            with db:
+                db.executemany('INSERT INTO readings VALUES (?,?,?,?)', [
+                    ('other', 'humidity', v, 1) for v in range(5)])
+        inserts = [row for sql, row in self.aggregates().items()
+                   if sql.startswith('INSERT INTO readings')]
+        self.assertEqual(inserts[0][4], 5)
+
+    def test_partial_reads_end_with_their_cursor(self):
+        with self.app.app_context(), self.assertLogs('app.queries'):
+            cursor = get_db().execute('SELECT value FROM readings')
+            cursor.fetchone()
+            cursor.close()
+        rows = [row for sql, row in self.aggregates().items()
+                if sql == 'SELECT value FROM readings']
+        self.assertEqual(rows[0][1], 1)
+        self.assertEqual(rows[0][4], 1)
+
+    def test_cli(self):
+        with self.assertLogs('app.queries'):
+            self.client.get('/devices/test_device/readings')
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['query-stats', '--sort', 'max'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('FROM readings', result.output)
+
+        result = runner.invoke(args=['query-stats', '--reset'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(self.aggregates(), {})
+
+    def test_stats(self):
+        with self.assertLogs('app.queries'):
+            self.client.get('/devices/test_device/readings')
+        request = self.client.get('/stats')
+        self.assertIn('query_tracer', request.json)
+
+    def test_disabled(self):
+        disabled = create_app({'TESTING': True})
+        self.assertNotIn('query_tracer', disabled.extensions)
+        with disabled.app_context():
+            self.assertIs(type(get_db()), sqlite3.Connection)
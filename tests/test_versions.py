@@ -0,0 +1,104 @@
+import json
+import sqlite3
+import time
+import unittest
+
+from app import app
+from app.db import get_db, init_db
+from app.versions import device_version, fleet_version
+
+
+class VersionsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+
+        self.device_uuid = 'test_device'
+        now = int(time.time())
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('INSERT INTO readings VALUES (?,?,?,?)', [
+            (self.device_uuid, 'temperature', 22, now - 100),
+            (self.device_uuid, 'temperature', 50, now - 50),
+            ('other_device', 'humidity', 40, now - 50),
+        ])
+        conn.commit()
+        conn.close()
+
+        self.client = app.test_client
+
+    def post_reading(self, device_uuid):
+        request = self.client().post(
+            f'/devices/{device_uuid}/readings',
+            data=json.dumps({'type': 'temperature', 'value': 10}))
+        self.assertEqual(request.status_code, 201)
+
+    def test_inserts_bump_versions(self):
+        with app.app_context():
+            db = get_db()
+            self.assertEqual(device_version(db, self.device_uuid), 2)
+            self.assertEqual(device_version(db, 'unknown_device'), 0)
+            self.assertEqual(fleet_version(db), 3)
+
+    def test_matching_etag_is_not_modified(self):
+        for url in (f'/devices/{self.device_uuid}/readings',
+                    f'/devices/{self.device_uuid}/readings?type=temperature',
+                    f'/devices/{self.device_uuid}/readings/max',
+                    f'/devices/{self.device_uuid}/readings/quartiles',
+                    f'/devices/{self.device_uuid}/readings/summary'):
+            # Given a response with an ETag
+            request = self.client().get(url)
+            self.assertEqual(request.status_code, 200)
+            etag = request.headers['ETag']
+
+            # When it is sent back
+            request = self.client().get(url,
+                                        headers={'If-None-Match': etag})
+
+            # Then the body is not sent again
+            self.assertEqual(request.status_code, 304, url)
+            self.assertEqual(request.data, b'')
+            self.assertEqual(request.headers['ETag'], etag)
+
+    def test_not_modified_does_not_read_readings(self):
+        url = f'/devices/{self.device_uuid}/readings/mean'
+        etag = self.client().get(url).headers['ETag']
+
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('ALTER TABLE readings RENAME TO readings_hidden')
+        conn.commit()
+        try:
+            request = self.client().get(url,
+                                        headers={'If-None-Match': etag})
+            self.assertEqual(request.status_code, 304)
+        finally:
+            conn.execute('ALTER TABLE readings_hidden RENAME TO readings')
+            conn.commit()
+            conn.close()
+
+    def test_write_changes_device_etag(self):
+        url = f'/devices/{self.device_uuid}/readings/count'
+        etag = self.client().get(url).headers['ETag']
+        other_etag = self.client().get(
+            '/devices/other_device/readings/count').headers['ETag']
+
+        self.post_reading(self.device_uuid)
+
+        request = self.client().get(url, headers={'If-None-Match': etag})
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(json.loads(request.data)['value'], 3)
+        self.assertNotEqual(request.headers['ETag'], etag)
+
+        # The other device is unchanged
+        request = self.client().get('/devices/other_device/readings/count',
+                                    headers={'If-None-Match': other_etag})
+        self.assertEqual(request.status_code, 304)
+
+    def test_any_write_changes_summary_etag(self):
+        url = f'/devices/{self.device_uuid}/readings/summary'
+        etag = self.client().get(url).headers['ETag']
+
+        self.post_reading('other_device')
+
+        request = self.client().get(url, headers={'If-None-Match': etag})
+        self.assertEqual(request.status_code, 200)
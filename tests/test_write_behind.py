@@ -0,0 +1,143 @@
+import json
+import queue
+import sqlite3
+import unittest
+from unittest import mock
+
+from app import app, create_app
+from app import ingest
+from app.db import FrozenPartition, init_db
+
+
+class WriteBehindTestCases(unittest.TestCase):
+
+    def setUp(self):
+        with app.app_context():
+            init_db()
+
+        self.device_uuid = 'test_device'
+        self.app = create_app({
+            'TESTING': True,
+            'WRITE_BEHIND': True,
+            'WRITE_BEHIND_FLUSH_SIZE': 2,
+        })
+        self.buffer = self.app.extensions['write_behind']
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        self.buffer.stop()
+
+    def count_readings(self):
+        conn = sqlite3.connect('test_database.db')
+        count = conn.execute('SELECT COUNT(*) FROM readings').fetchone()[0]
+        conn.close()
+        return count
+
+    def test_buffered_post_is_flushed_on_stop(self):
+        data = {'type': 'temperature', 'value': 10}
+        for _ in range(5):
+            request = self.client().post(
+                f'/devices/{self.device_uuid}/readings', data=json.dumps(data))
+            self.assertEqual(request.status_code, 202)
+
+        # Stopping drains whatever is still queued
+        self.buffer.stop()
+        self.assertEqual(self.count_readings(), 5)
+        self.assertEqual(self.buffer.stats()['flushed'], 5)
+        self.assertEqual(self.buffer.stats()['queue_depth'], 0)
+
+    def test_durable_post_waits_for_commit(self):
+        data = {'type': 'temperature', 'value': 10}
+        request = self.client().post(
+            f'/devices/{self.device_uuid}/readings?durable=true',
+            data=json.dumps(data))
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(self.count_readings(), 1)
+
+        request = self.client().get('/stats')
+        stats = json.loads(request.data)['write_behind']
+        self.assertEqual(stats['flushed'], 1)
+        self.assertIn('max_flush_latency_ms', stats)
+
+    def test_flush_invalidates_cached_metrics(self):
+        url = f'/devices/{self.device_uuid}/readings/count'
+        request = self.client().get(url)
+        self.assertEqual(json.loads(request.data)['value'], 0)
+
+        data = {'type': 'temperature', 'value': 10}
+        request = self.client().post(
+            f'/devices/{self.device_uuid}/readings?durable=true',
+            data=json.dumps(data))
+        self.assertEqual(request.status_code, 201)
+
+        request = self.client().get(url)
+        self.assertEqual(json.loads(request.data)['value'], 1)
+
+    def test_busy_database_is_retried(self):
+        write_readings = ingest.write_readings
+        calls = []
+
+        def busy_twice(db, rows, router=None):
+            calls.append(len(rows))
+            if len(calls) <= 2:
+                raise sqlite3.OperationalError('database is locked')
+            return write_readings(db, rows, router)
+
+        with mock.patch('app.ingest.write_readings', busy_twice):
+            futures = [self.buffer.submit([self.device_uuid, 'temperature',
+                                           10, 1000 + i]) for i in range(2)]
+            self.assertTrue(all(f.result(5) for f in futures))
+        self.assertEqual(calls, [2, 2, 2])
+        self.assertEqual(self.count_readings(), 2)
+
+    def test_failing_row_does_not_fail_its_group(self):
+        write_readings = ingest.write_readings
+
+        def reject_bad(db, rows, router=None):
+            if any(row[2] == 'bad' for row in rows):
+                raise sqlite3.IntegrityError('bad value')
+            return write_readings(db, rows, router)
+
+        with mock.patch('app.ingest.write_readings', reject_bad):
+            good = self.buffer.submit([self.device_uuid, 'temperature', 10, 1])
+            bad = self.buffer.submit([self.device_uuid, 'temperature',
+                                      'bad', 2])
+            self.assertTrue(good.result(5))
+            self.assertIsInstance(bad.exception(5), sqlite3.IntegrityError)
+        self.assertEqual(self.count_readings(), 1)
+        self.assertEqual(self.buffer.stats()['failed'], 1)
+
+    def test_durable_post_reports_failed_flush(self):
+        data = json.dumps({'type': 'temperature', 'value': 10})
+        url = f'/devices/{self.device_uuid}/readings?durable=true'
+        self.buffer.retries = 0
+
+        frozen = FrozenPartition('Partition is read-only')
+        with mock.patch('app.ingest.write_readings', side_effect=frozen):
+            request = self.client().post(url, data=data)
+        self.assertEqual(request.status_code, 409)
+
+        locked = sqlite3.OperationalError('database is locked')
+        with mock.patch('app.ingest.write_readings', side_effect=locked):
+            request = self.client().post(url, data=data)
+        self.assertEqual(request.status_code, 503)
+        self.assertEqual(self.count_readings(), 0)
+
+    def test_failing_hook_does_not_fail_the_flush(self):
+        self.buffer.on_written = mock.Mock(side_effect=RuntimeError('hook'))
+        with self.assertLogs('app.ingest', 'ERROR'):
+            future = self.buffer.submit([self.device_uuid, 'temperature',
+                                         10, 1])
+            self.assertTrue(future.result(5))
+        # The flusher survives the hook
+        future = self.buffer.submit([self.device_uuid, 'temperature', 10, 2])
+        self.assertTrue(future.result(5))
+        self.assertEqual(self.count_readings(), 2)
+
+    def test_submit_after_stop_is_rejected(self):
+        self.buffer.submit([self.device_uuid, 'temperature', 10, 1])
+        self.buffer.stop()
+        with self.assertRaises(queue.Full):
+            self.buffer.submit([self.device_uuid, 'temperature', 10, 2])
+        self.assertFalse(self.buffer.thread.is_alive())
+        self.assertEqual(self.count_readings(), 1)